@@ -1,27 +1,497 @@
 import os
 import json
+import re
+import hashlib
 import uuid
+import socket
 import logging
+import sqlite3
+import argparse
+import time
+import queue
+import threading
+import asyncio
+import unicodedata
+import math
+import gzip
+import contextvars
+import functools
+import atexit
+import logging.handlers
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
 from datetime import datetime
-from flask import Flask, request, jsonify, render_template_string
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from types import MappingProxyType, SimpleNamespace
+import httpx
+from flask import Flask, request, jsonify, render_template_string, g
 from flask_cors import CORS
-from openai import AzureOpenAI
+from openai import (AzureOpenAI, AsyncAzureOpenAI, OpenAI, AsyncOpenAI, RateLimitError, APIConnectionError,
+                    APITimeoutError, InternalServerError)
 import random
 
-# 配置日志
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("hr_chatbot.log", encoding="utf-8"),
-        logging.StreamHandler()
-    ]
-)
+# 本地token计数的可选依赖（pip install tiktoken），未安装时按字符数估算
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 跨进程文件锁（仅类Unix系统），不可用时只在进程内加锁
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# 前端页面brotli压缩的可选依赖，未安装时只提供gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 快速JSON序列化的可选依赖（pip install orjson），未安装时使用标准库json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 异步服务模式的可选依赖（pip install starlette uvicorn a2wsgi）
+try:
+    import uvicorn
+    from a2wsgi import WSGIMiddleware
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse, StreamingResponse
+    from starlette.routing import Mount, Route
+except ImportError:
+    Starlette = None
+
+# 当前请求的追踪ID，写入该请求处理过程中（包括提交到后台线程的任务）的所有日志
+current_trace_id = contextvars.ContextVar("trace_id", default="-")
+
+# 日志配置
+LOG_CONFIG = {
+    "level": os.environ.get("LOG_LEVEL", "INFO"),
+    "file": "hr_chatbot.log",
+    # 文件日志格式：json（每行一条结构化记录）或text
+    "file_format": "json",
+    "console": True,
+    "console_format": "text",
+    # 日志先写入内存队列，由后台线程落盘；队列满时丢弃新记录而不是阻塞请求
+    "async": True,
+    "queue_size": 10000,
+    # 按大小和时间轮转（满足任一条件即轮转），保留的历史文件数
+    "max_bytes": 50 * 1024 * 1024,
+    "rotate_interval_seconds": 24 * 3600,
+    "backup_count": 10,
+    # 按类别（logger名称）控制级别和采样率；采样只作用于WARNING以下的记录，按追踪ID整体保留或丢弃
+    "categories": {
+        # 流式对话热路径
+        "HR_Chatbot.stream": {"level": "INFO", "sample_rate": 0.1},
+        # 完整的消息、患者回复和评价内容
+        "HR_Chatbot.content": {"level": "WARNING"},
+        "httpx": {"level": "WARNING"},
+        "httpcore": {"level": "WARNING"},
+        "openai": {"level": "WARNING"},
+        "werkzeug": {"level": "INFO", "sample_rate": 0.1}
+    }
+}
+TEXT_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s'
+
+
+class TraceIdFilter(logging.Filter):
+    """为日志记录附加当前请求的追踪ID"""
+
+    def filter(self, record):
+        record.trace_id = current_trace_id.get()
+        return True
+
+
+class CategorySampler(logging.Filter):
+    """按类别对WARNING以下的日志采样；同一追踪ID的记录采样结果一致，便于完整还原被保留的请求"""
+
+    def __init__(self, categories):
+        super().__init__()
+        self.rates = {name: options["sample_rate"] for name, options in categories.items()
+                      if options.get("sample_rate", 1.0) < 1.0}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        name = record.name
+        while name:
+            rate = self.rates.get(name)
+            if rate is not None:
+                trace_id = getattr(record, 'trace_id', '-')
+                if trace_id == '-':
+                    return random.random() < rate
+                return int(hashlib.md5(f"{name}:{trace_id}".encode()).hexdigest()[:8], 16) < rate * 0x100000000
+            name = name.rpartition('.')[0]
+        return True
+
+
+class JsonLogFormatter(logging.Formatter):
+    """每条日志输出为一行JSON"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "trace_id": getattr(record, 'trace_id', '-'),
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SizeAndTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """文件超过大小上限或距上次轮转超过时间间隔时轮转"""
+
+    def __init__(self, filename, max_bytes, interval_seconds, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.interval_seconds = interval_seconds
+        self.rollover_at = time.time() + interval_seconds if interval_seconds else None
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.rollover_at is not None:
+            self.rollover_at = time.time() + self.interval_seconds
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃日志并计数，保证调用方永不阻塞"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LoggingPipeline:
+    """根据LOG_CONFIG安装日志处理器，可重复调用以应用新配置"""
+
+    def __init__(self):
+        self.config = None
+        self.queue_handler = None
+        self._listener = None
+        atexit.register(self.stop)
+
+    def configure(self, config):
+        self.stop()
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+            handler.close()
+
+        sinks = []
+        if config.get("file"):
+            file_handler = SizeAndTimeRotatingFileHandler(config["file"], config["max_bytes"],
+                                                          config["rotate_interval_seconds"], config["backup_count"])
+            file_handler.setFormatter(JsonLogFormatter() if config["file_format"] == "json"
+                                      else logging.Formatter(TEXT_LOG_FORMAT))
+            sinks.append(file_handler)
+        if config.get("console"):
+            console_handler = logging.StreamHandler()
+            console_handler.setFormatter(JsonLogFormatter() if config["console_format"] == "json"
+                                         else logging.Formatter(TEXT_LOG_FORMAT))
+            sinks.append(console_handler)
+
+        # 追踪ID和采样在调用线程中完成，后台线程只负责格式化和落盘
+        filters = [TraceIdFilter(), CategorySampler(config["categories"])]
+        if config["async"]:
+            self.queue_handler = DroppingQueueHandler(queue.Queue(config["queue_size"]))
+            entry_handlers = [self.queue_handler]
+            self._listener = logging.handlers.QueueListener(self.queue_handler.queue, *sinks,
+                                                            respect_handler_level=True)
+            self._listener.start()
+        else:
+            self.queue_handler = None
+            entry_handlers = sinks
+        for handler in entry_handlers:
+            for log_filter in filters:
+                handler.addFilter(log_filter)
+            root.addHandler(handler)
+
+        root.setLevel(config["level"])
+        for name, options in config["categories"].items():
+            logging.getLogger(name).setLevel(options.get("level", logging.NOTSET))
+        self.config = config
+
+    def set_category(self, name, level=None, sample_rate=None):
+        """运行时调整某个类别的级别或采样率"""
+        options = self.config["categories"].setdefault(name, {})
+        if level is not None:
+            logging.getLogger(name).setLevel(level)
+            options["level"] = level
+        if sample_rate is not None:
+            options["sample_rate"] = sample_rate
+        for handler in logging.getLogger().handlers:
+            for log_filter in handler.filters:
+                if isinstance(log_filter, CategorySampler):
+                    log_filter.rates = CategorySampler(self.config["categories"]).rates
+
+    def snapshot(self):
+        return {
+            "level": self.config["level"],
+            "async": self.config["async"],
+            "queue_size": self.queue_handler.queue.qsize() if self.queue_handler else 0,
+            "dropped": self.queue_handler.dropped if self.queue_handler else 0,
+            "categories": self.config["categories"]
+        }
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+
+logging_pipeline = LoggingPipeline()
+logging_pipeline.configure(LOG_CONFIG)
 logger = logging.getLogger("HR_Chatbot")
+stream_logger = logging.getLogger("HR_Chatbot.stream")
+content_logger = logging.getLogger("HR_Chatbot.content")
+
+# JSON序列化配置
+JSON_CONFIG = {
+    # 安装了orjson时用它序列化SSE事件、会话存储和会话文件
+    "fast_json": True,
+    # 会话文件的缩进，None表示紧凑格式（更小更快，但不便人工查看）
+    "session_file_indent": 2
+}
+
+
+def use_fast_json():
+    return orjson is not None and JSON_CONFIG["fast_json"]
+
+
+def json_dumps(obj):
+    """序列化为JSON字符串，中文保留原文"""
+    if use_fast_json():
+        return orjson.dumps(obj).decode('utf-8')
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def json_loads(data):
+    """解析JSON字符串或UTF-8字节串"""
+    if use_fast_json():
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dump_json_file(obj, path, indent=None):
+    """将对象写入JSON文件，中文保留原文"""
+    if use_fast_json() and indent in (None, 2):
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0))
+        return
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=indent)
+
+
+def load_json_file(path):
+    with open(path, 'rb') as f:
+        return json_loads(f.read())
 
 app = Flask(__name__)
 CORS(app)
 
+# 指标与请求追踪配置
+METRICS_CONFIG = {
+    # 为每个请求分配追踪ID（优先使用请求头X-Request-ID），并在响应头中返回
+    "trace_ids": True,
+    # 直方图分桶（秒）
+    "buckets": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+}
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """Prometheus格式的直方图（进程内），按标签值分别统计"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets or METRICS_CONFIG["buckets"])
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+            series["counts"][index] += 1
+            series["sum"] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_items = [(key, list(series["counts"]), series["sum"]) for key, series in self._series.items()]
+        for key, counts, total in sorted(series_items):
+            labels = [f'{name}="{_escape_label(value)}"' for name, value in zip(self.labelnames, key)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = ",".join(labels + [f'le="{le}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            suffix = f'{{{",".join(labels)}}}' if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return "\n".join(lines)
+
+
+class Counter:
+    """Prometheus格式的计数器（进程内），按标签值分别累计"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            labels = ",".join(f'{name}="{_escape_label(v)}"' for name, v in zip(self.labelnames, key))
+            lines.append(f"{self.name}{{{labels}}} {value}" if labels else f"{self.name} {value}")
+        return "\n".join(lines)
+
+
+class MetricsRegistry:
+    """收集各项指标并导出为Prometheus文本格式"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def histogram(self, name, documentation, labelnames=()):
+        metric = Histogram(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+
+metrics = MetricsRegistry()
+REQUEST_SECONDS = metrics.histogram(
+    "hr_chatbot_request_duration_seconds", "非流式接口的处理耗时", ("endpoint", "status"))
+PROMPT_BUILD_SECONDS = metrics.histogram(
+    "hr_chatbot_prompt_build_seconds", "构建患者回复请求（对话历史窗口、token预算）的耗时", ("endpoint",))
+UPSTREAM_CONNECT_SECONDS = metrics.histogram(
+    "hr_chatbot_upstream_connect_seconds", "发起流式模型请求到收到响应头的耗时", ("endpoint",))
+TIME_TO_FIRST_TOKEN_SECONDS = metrics.histogram(
+    "hr_chatbot_time_to_first_token_seconds", "收到请求到推送第一个响应块的耗时", ("endpoint",))
+INTER_CHUNK_SECONDS = metrics.histogram(
+    "hr_chatbot_inter_chunk_gap_seconds", "相邻响应块之间的间隔", ("endpoint",))
+STREAM_DURATION_SECONDS = metrics.histogram(
+    "hr_chatbot_stream_duration_seconds", "流式响应的总时长", ("endpoint", "outcome"))
+GRADING_SECONDS = metrics.histogram(
+    "hr_chatbot_grading_seconds", "会话评分（模型调用及解析）的耗时", ("outcome",))
+TURN_GRADING_SECONDS = metrics.histogram(
+    "hr_chatbot_turn_grading_seconds", "逐轮评分（单条客服回复）的耗时", ("outcome",))
+PERSIST_SECONDS = metrics.histogram(
+    "hr_chatbot_persist_seconds", "会话持久化的耗时", ("target",))
+TURN_REQUESTS = metrics.counter(
+    "hr_chatbot_turn_requests_total", "发送消息请求按处理方式计数：新一轮、重连续传、重复提交回放", ("outcome",))
+CANCELLED_STREAMS = metrics.counter(
+    "hr_chatbot_cancelled_streams_total", "被取消的流式响应数（客户端断开、超过最长时长、上游停顿）",
+    ("endpoint", "reason"))
+CANCELLED_TOKENS = metrics.counter(
+    "hr_chatbot_cancelled_tokens_total", "被取消的流式响应在取消前已生成的token数（已计费）", ("reason",))
+ABORTED_TOKENS = metrics.counter(
+    "hr_chatbot_aborted_tokens_total", "取消时本轮剩余的max_tokens额度，即最多节省的生成token数", ("reason",))
+
+
+class StreamTimer:
+    """记录一次流式响应的上游连接耗时、首token时间、块间隔和总时长"""
+
+    def __init__(self, endpoint, request_start=None):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.request_start = request_start or self.start
+        self.first_token = None
+        self._last_chunk = None
+
+    def connected(self):
+        UPSTREAM_CONNECT_SECONDS.observe(time.perf_counter() - self.start, endpoint=self.endpoint)
+
+    def chunk(self):
+        now = time.perf_counter()
+        if self._last_chunk is None:
+            self.first_token = now - self.request_start
+            TIME_TO_FIRST_TOKEN_SECONDS.observe(self.first_token, endpoint=self.endpoint)
+        else:
+            INTER_CHUNK_SECONDS.observe(now - self._last_chunk, endpoint=self.endpoint)
+        self._last_chunk = now
+
+    def finish(self, outcome):
+        elapsed = time.perf_counter() - self.start
+        STREAM_DURATION_SECONDS.observe(elapsed, endpoint=self.endpoint, outcome=outcome)
+        return elapsed
+
+
+def start_trace(request_id=None):
+    """为当前请求设置追踪ID，未启用时不设置"""
+    if METRICS_CONFIG["trace_ids"]:
+        current_trace_id.set(request_id or uuid.uuid4().hex[:16])
+    return current_trace_id.get()
+
+
+@app.before_request
+def begin_request():
+    g.request_start = time.perf_counter()
+    g.trace_id = start_trace(request.headers.get('X-Request-ID'))
+
+
+@app.after_request
+def finish_request(response):
+    # 流式响应在返回后才开始推送，由StreamTimer单独统计
+    if response.mimetype != 'text/event-stream' and request.endpoint != 'get_metrics':
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start,
+                                endpoint=request.endpoint or 'unknown', status=response.status_code)
+    if METRICS_CONFIG["trace_ids"]:
+        response.headers['X-Request-ID'] = g.trace_id
+    return response
+
+
+@app.route('/metrics')
+def get_metrics():
+    """以Prometheus文本格式导出本进程的指标"""
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 logger.info("===============================================")
 logger.info("汇仁医药客服对话系统初始化开始")
 logger.info("===============================================")
@@ -35,45 +505,658 @@ AZURE_CONFIG = {
 }
 logger.info(f"Azure OpenAI配置: 模型={AZURE_CONFIG['model']}, API版本={AZURE_CONFIG['api_version']}")
 
-# 创建 Azure OpenAI 客户端
+# 模型部署列表：可通过环境变量AZURE_DEPLOYMENTS（JSON数组）配置多个部署或API Key，
+# 每项包含name、endpoint、api_key、api_version、model、weight；指定base_url时按OpenAI兼容接口访问（如本地桩服务），
+# 指定"mock": true时使用内置的离线模拟后端。环境变量MODEL_BACKEND=mock时全部使用模拟后端
+if os.environ.get("MODEL_BACKEND") == "mock":
+    AZURE_DEPLOYMENTS = [{"name": "mock", "mock": True}]
+elif os.environ.get("AZURE_DEPLOYMENTS"):
+    AZURE_DEPLOYMENTS = json.loads(os.environ["AZURE_DEPLOYMENTS"])
+else:
+    AZURE_DEPLOYMENTS = [dict(AZURE_CONFIG, name="default")]
+
+# 离线模拟后端配置：不访问Azure，按固定的速率流式返回确定性的内容，用于压测服务自身的开销
+MOCK_BACKEND_CONFIG = {
+    # 首个响应块前的延迟（秒）
+    "first_token_seconds": float(os.environ.get("MOCK_FIRST_TOKEN_SECONDS", 0.3)),
+    # 每秒输出的响应块数，每块按一个token计
+    "tokens_per_second": float(os.environ.get("MOCK_TOKENS_PER_SECOND", 50)),
+    "chunk_chars": int(os.environ.get("MOCK_CHUNK_CHARS", 2)),
+    "replies": (
+        "嗯，我最近确实老是腰酸，晚上还得起来好几次，白天也没什么精神，这种情况吃什么药比较好呀？",
+        "这个药一天吃几次？要吃多久才能见效？我平时还在吃降压药，一起吃会不会有影响？",
+        "价格大概多少钱一盒？一个疗程要几盒？有没有什么副作用需要注意的？",
+        "好的，听你这么说我心里有数了，那我先买一个疗程试试看吧。"
+    ),
+    "evaluation": {
+        "total_score": 80,
+        "professionalism": 82,
+        "communication": 80,
+        "problem_solving": 78,
+        "service_attitude": 80,
+        "strengths": ["回应及时", "产品介绍清楚"],
+        "improvements": ["可以更主动询问顾客的用药史"],
+        "overall_comment": "模拟后端返回的固定评价。"
+    },
+    "turn_evaluation": {
+        "product_accuracy": 82,
+        "empathy": 78,
+        "mentions_target_product": True,
+        "strength": "产品介绍清楚",
+        "improvement": "可以追问用药史"
+    }
+}
+
+
+class MockCompletions:
+    """离线模拟的chat.completions接口：评分和逐轮评分请求返回固定的评价JSON，其余请求按最后一条消息确定性地选取回复"""
+
+    def __init__(self, config, is_async=False):
+        self.config = config
+        self.is_async = is_async
+
+    def _content(self, messages):
+        if "逐轮评估" in messages[0]["content"]:
+            return json.dumps(self.config["turn_evaluation"], ensure_ascii=False)
+        if "评估" in messages[0]["content"]:
+            return json.dumps(self.config["evaluation"], ensure_ascii=False)
+        replies = self.config["replies"]
+        digest = hashlib.md5(messages[-1]["content"].encode('utf-8')).digest()
+        return replies[digest[0] % len(replies)]
+
+    def _build(self, messages, stream):
+        content = self._content(messages)
+        size = self.config["chunk_chars"]
+        pieces = [content[i:i + size] for i in range(0, len(content), size)]
+        usage = SimpleNamespace(prompt_tokens=count_message_tokens(messages), completion_tokens=len(pieces))
+        interval = 1.0 / self.config["tokens_per_second"]
+        delays = [self.config["first_token_seconds"]] + [interval] * (len(pieces) - 1)
+        if not stream:
+            message = SimpleNamespace(role="assistant", content=content)
+            response = SimpleNamespace(choices=[SimpleNamespace(index=0, finish_reason="stop", message=message)],
+                                       usage=usage)
+            return [sum(delays)], response
+        chunks = [SimpleNamespace(choices=[SimpleNamespace(index=0, finish_reason=None,
+                                                           delta=SimpleNamespace(content=piece))])
+                  for piece in pieces]
+        return delays, chunks
+
+    def create(self, model=None, messages=(), stream=False, **kwargs):
+        delays, result = self._build(messages, stream)
+        if self.is_async:
+            return self._acreate(delays, result, stream)
+        if not stream:
+            time.sleep(delays[0])
+            return result
+        return self._stream(delays, result)
+
+    @staticmethod
+    def _stream(delays, chunks):
+        for delay, chunk in zip(delays, chunks):
+            time.sleep(delay)
+            yield chunk
+
+    async def _acreate(self, delays, result, stream):
+        if not stream:
+            await asyncio.sleep(delays[0])
+            return result
+        return self._astream(delays, result)
+
+    @staticmethod
+    async def _astream(delays, chunks):
+        for delay, chunk in zip(delays, chunks):
+            await asyncio.sleep(delay)
+            yield chunk
+
+# 模型客户端池配置
+MODEL_POOL_CONFIG = {
+    # 路由策略：least_outstanding（在途请求最少）或 latency（按延迟加权）
+    "routing": "least_outstanding",
+    # 每个部署的HTTP连接池
+    "max_connections": 100,
+    "max_keepalive_connections": 40,
+    "keepalive_expiry_seconds": 60,
+    "connect_timeout_seconds": 5,
+    "read_timeout_seconds": 120,
+    # 限流、超时、服务端错误时换部署重试的次数及带抖动的指数退避参数
+    "max_retries": 3,
+    "backoff_base_seconds": 0.5,
+    "backoff_max_seconds": 8.0,
+    # 熔断：连续失败达到failure_threshold次，或最近window_size个请求中失败比例达到failure_ratio
+    # （至少有min_requests个样本）时暂停该部署，冷却结束后放行一个试探请求
+    "failure_threshold": 5,
+    "window_size": 20,
+    "min_requests": 10,
+    "failure_ratio": 0.5,
+    "cooldown_seconds": 30,
+    # 延迟的指数滑动平均系数
+    "latency_alpha": 0.2
+}
+RETRYABLE_API_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+
+def retry_after_seconds(error):
+    """读取错误响应中的Retry-After（秒），没有时返回None"""
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    try:
+        return float(retry_after) if retry_after else None
+    except ValueError:
+        return None
+
+
+class ModelBackend:
+    """一个模型部署（或API Key）的客户端，以及它的在途请求数、延迟和熔断状态"""
+
+    def __init__(self, spec, config):
+        self.name = spec.get("name") or spec.get("base_url") or spec.get("endpoint") or "mock"
+        self.model = spec.get("model", AZURE_CONFIG["model"])
+        self.weight = float(spec.get("weight", 1.0))
+        limits = httpx.Limits(max_connections=config["max_connections"],
+                              max_keepalive_connections=config["max_keepalive_connections"],
+                              keepalive_expiry=config["keepalive_expiry_seconds"])
+        timeout = httpx.Timeout(config["read_timeout_seconds"], connect=config["connect_timeout_seconds"])
+        # 重试由模型池统一处理，关闭客户端自带的重试
+        if spec.get("mock"):
+            self.client = SimpleNamespace(chat=SimpleNamespace(completions=MockCompletions(MOCK_BACKEND_CONFIG)))
+            self.async_client = SimpleNamespace(
+                chat=SimpleNamespace(completions=MockCompletions(MOCK_BACKEND_CONFIG, is_async=True)))
+        elif spec.get("base_url"):
+            common = dict(base_url=spec["base_url"], api_key=spec.get("api_key", "stub"), max_retries=0)
+            self.client = OpenAI(http_client=httpx.Client(limits=limits, timeout=timeout), **common)
+            self.async_client = AsyncOpenAI(http_client=httpx.AsyncClient(limits=limits, timeout=timeout), **common)
+        else:
+            common = dict(api_key=spec["api_key"], azure_endpoint=spec["endpoint"],
+                          api_version=spec.get("api_version", AZURE_CONFIG["api_version"]), max_retries=0)
+            self.client = AzureOpenAI(http_client=httpx.Client(limits=limits, timeout=timeout), **common)
+            self.async_client = AsyncAzureOpenAI(http_client=httpx.AsyncClient(limits=limits, timeout=timeout),
+                                                 **common)
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0
+        # 最近请求的结果（True为失败），用于按失败比例熔断
+        self.outcomes = deque(maxlen=config["window_size"])
+        self.circuit_open = False
+        self.open_until = 0.0
+        self.throttled_until = 0.0
+        self.probing = False
+        self.stats = {"requests": 0, "errors": 0, "throttled": 0, "circuit_opens": 0}
+
+    def available(self, now):
+        if now < self.throttled_until:
+            return False
+        if self.circuit_open:
+            # 冷却结束后只放行一个试探请求
+            return now >= self.open_until and not self.probing
+        return True
+
+    def error_ratio(self):
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def snapshot(self, now):
+        return dict(self.stats, name=self.name, model=self.model, weight=self.weight,
+                    outstanding=self.outstanding,
+                    latency_ms=round(self.latency * 1000, 1) if self.latency is not None else None,
+                    consecutive_failures=self.failures,
+                    recent_error_ratio=round(self.error_ratio(), 3) if self.outcomes else None,
+                    state="open" if self.circuit_open else "closed",
+                    available=self.available(now))
+
+
+class PooledStream:
+    """包装流式响应，迭代结束或出错时释放部署的在途计数"""
+
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+        self.closed = False
+
+    def close(self):
+        """提前关闭上游响应（可在其他线程调用），正在进行的读取随之结束，不计为部署故障"""
+        self.closed = True
+        close = getattr(self._stream, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                # 生成器正在其他线程中执行时无法关闭，读取方在下一块到达时检查取消标记
+                pass
+
+    def __iter__(self):
+        error = None
+        try:
+            for chunk in self._stream:
+                yield chunk
+        except Exception as e:
+            if not self.closed:
+                error = e
+                raise
+        finally:
+            self._on_close(error)
+
+
+class AsyncPooledStream(PooledStream):
+    """PooledStream的异步版本"""
+
+    async def aclose(self):
+        self.closed = True
+        close = getattr(self._stream, 'aclose', None) or getattr(self._stream, 'close', None)
+        if close is not None:
+            try:
+                result = close()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                pass
+
+    async def __aiter__(self):
+        error = None
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        except Exception as e:
+            if not self.closed:
+                error = e
+                raise
+        finally:
+            self._on_close(error)
+
+
+class ModelPool:
+    """在多个模型部署间分发请求：按在途请求数或延迟选择部署，熔断不健康的部署，限流时带抖动换部署重试
+
+    client.chat.completions.create 与 async_client.chat.completions.create 与OpenAI客户端接口一致，
+    调用方传入的model参数会被替换为所选部署的model。
+    """
+
+    def __init__(self, deployments, config):
+        if not deployments:
+            raise ValueError("至少需要配置一个模型部署")
+        self.config = config
+        self.backends = [ModelBackend(spec, config) for spec in deployments]
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "failures": 0}
+        self.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=self.create)))
+        self.async_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=self.acreate)))
+
+    def _score(self, backend):
+        if self.config["routing"] == "latency":
+            # 尚无延迟数据的部署视为最快，让它尽快获得样本
+            return (backend.latency or 0.0) * (backend.outstanding + 1) / backend.weight
+        return backend.outstanding / backend.weight
+
+    def _acquire(self, tried):
+        with self._lock:
+            now = time.monotonic()
+            candidates = [b for b in self.backends if b.available(now)]
+            untried = [b for b in candidates if b.name not in tried]
+            if untried:
+                candidates = untried
+            if not candidates:
+                # 全部部署都不可用时，选择最早恢复的部署继续尝试，而不是直接失败
+                candidates = [min(self.backends, key=lambda b: max(b.open_until, b.throttled_until))]
+            random.shuffle(candidates)
+            backend = min(candidates, key=self._score)
+            if backend.circuit_open:
+                backend.probing = True
+            backend.outstanding += 1
+            backend.stats["requests"] += 1
+            return backend
+
+    def _has_alternative(self, tried):
+        with self._lock:
+            now = time.monotonic()
+            return any(b.available(now) and b.name not in tried for b in self.backends)
+
+    def _release(self, backend, latency=None, error=None):
+        """请求结束时更新部署状态；error为可重试的错误时计入熔断"""
+        with self._lock:
+            now = time.monotonic()
+            backend.outstanding -= 1
+            backend.probing = False
+            if error is None:
+                backend.failures = 0
+                backend.outcomes.append(False)
+                if backend.circuit_open:
+                    backend.circuit_open = False
+                    backend.outcomes.clear()
+                    logger.info(f"模型部署[{backend.name}]试探请求成功，恢复使用")
+                if latency is not None:
+                    alpha = self.config["latency_alpha"]
+                    backend.latency = latency if backend.latency is None else \
+                        alpha * latency + (1 - alpha) * backend.latency
+                return
+            backend.failures += 1
+            backend.outcomes.append(True)
+            backend.stats["errors"] += 1
+            if isinstance(error, RateLimitError):
+                backend.stats["throttled"] += 1
+                backend.throttled_until = now + (retry_after_seconds(error) or self.config["backoff_base_seconds"])
+            # 只看连续失败时，失败与成功交替的部署永远不会熔断，因此同时按最近的失败比例判断
+            ratio_tripped = len(backend.outcomes) >= self.config["min_requests"] and \
+                backend.error_ratio() >= self.config["failure_ratio"]
+            if backend.circuit_open or backend.failures >= self.config["failure_threshold"] or ratio_tripped:
+                if not backend.circuit_open:
+                    backend.stats["circuit_opens"] += 1
+                    logger.warning(f"模型部署[{backend.name}]连续失败{backend.failures}次、最近{len(backend.outcomes)}个"
+                                   f"请求失败率{backend.error_ratio():.0%}，熔断{self.config['cooldown_seconds']}秒")
+                    # 恢复后重新积累样本
+                    backend.outcomes.clear()
+                backend.circuit_open = True
+                backend.open_until = now + self.config["cooldown_seconds"]
+
+    def _retry_delay(self, attempt, error, tried):
+        # 还有未尝试的可用部署时立即换部署，只加少量抖动；否则遵循Retry-After并做带抖动的指数退避
+        if self._has_alternative(tried):
+            return random.uniform(0, self.config["backoff_base_seconds"] / 4)
+        ceiling = min(self.config["backoff_max_seconds"], self.config["backoff_base_seconds"] * 2 ** attempt)
+        return max(retry_after_seconds(error) or 0.0, random.uniform(0, ceiling))
+
+    def _on_retryable_error(self, backend, attempt, error, tried):
+        """记录失败并返回重试前的等待秒数，重试次数用尽时返回None"""
+        self._release(backend, error=error)
+        if attempt == self.config["max_retries"]:
+            with self._lock:
+                self.stats["failures"] += 1
+            return None
+        delay = self._retry_delay(attempt, error, tried)
+        with self._lock:
+            self.stats["retries"] += 1
+        logger.warning(f"模型部署[{backend.name}]请求失败，{delay:.2f}秒后第{attempt + 1}次重试: {str(error)}")
+        return delay
+
+    def _stream_closer(self, backend, latency):
+        def on_close(error):
+            self._release(backend, latency, error if isinstance(error, RETRYABLE_API_ERRORS) else None)
+        return on_close
+
+    def create(self, **kwargs):
+        with self._lock:
+            self.stats["requests"] += 1
+        tried = set()
+        for attempt in range(self.config["max_retries"] + 1):
+            backend = self._acquire(tried)
+            tried.add(backend.name)
+            start = time.perf_counter()
+            try:
+                response = backend.client.chat.completions.create(**dict(kwargs, model=backend.model))
+            except RETRYABLE_API_ERRORS as e:
+                delay = self._on_retryable_error(backend, attempt, e, tried)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self._release(backend)
+                raise
+            latency = time.perf_counter() - start
+            if kwargs.get("stream"):
+                return PooledStream(response, self._stream_closer(backend, latency))
+            self._release(backend, latency)
+            return response
+
+    async def acreate(self, **kwargs):
+        with self._lock:
+            self.stats["requests"] += 1
+        tried = set()
+        for attempt in range(self.config["max_retries"] + 1):
+            backend = self._acquire(tried)
+            tried.add(backend.name)
+            start = time.perf_counter()
+            try:
+                response = await backend.async_client.chat.completions.create(**dict(kwargs, model=backend.model))
+            except RETRYABLE_API_ERRORS as e:
+                delay = self._on_retryable_error(backend, attempt, e, tried)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self._release(backend)
+                raise
+            latency = time.perf_counter() - start
+            if kwargs.get("stream"):
+                return AsyncPooledStream(response, self._stream_closer(backend, latency))
+            self._release(backend, latency)
+            return response
+
+    def snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            return dict(self.stats, routing=self.config["routing"],
+                        backends=[backend.snapshot(now) for backend in self.backends])
+
+
+# 创建模型客户端池
 try:
-    client = AzureOpenAI(
-        api_key=AZURE_CONFIG["api_key"],
-        azure_endpoint=AZURE_CONFIG["endpoint"],
-        api_version=AZURE_CONFIG["api_version"]
-    )
-    logger.info("Azure OpenAI客户端创建成功")
+    model_pool = ModelPool(AZURE_DEPLOYMENTS, MODEL_POOL_CONFIG)
+    client = model_pool.client
+    # 异步客户端供ASGI服务模式使用，单个进程即可同时承载大量流式连接
+    async_client = model_pool.async_client
+    logger.info(f"Azure OpenAI客户端池创建成功，共{len(model_pool.backends)}个部署，"
+                f"路由策略: {MODEL_POOL_CONFIG['routing']}")
 except Exception as e:
     logger.error(f"Azure OpenAI客户端创建失败: {str(e)}")
     raise
 
-# 加载产品配置
-try:
-    logger.info("开始加载产品配置文件")
-    with open('product_config.json', 'r', encoding='utf-8') as f:
-        PRODUCT_CONFIG = json.load(f)
-    logger.info(f"产品配置加载成功, 共有{len(PRODUCT_CONFIG['products'])}个产品")
-    for product_name in PRODUCT_CONFIG["products"].keys():
-        logger.info(f"产品: {product_name}")
-except Exception as e:
-    logger.error(f"产品配置加载失败: {str(e)}")
-    raise
+# token预算与用量统计配置
+TOKEN_BUDGET_CONFIG = {
+    # 模型上下文窗口（提示词+输出）
+    "context_window": 128000,
+    # tiktoken编码，gpt-4o系列使用o200k_base
+    "encoding": "o200k_base",
+    # 每条消息的格式开销及回复起始开销（与OpenAI的计数方式一致）
+    "tokens_per_message": 3,
+    "tokens_per_reply": 3,
+    # 裁剪后至少保留的输出token数
+    "min_completion_tokens": 200,
+    # 按会话统计用量时最多保留的会话数，每记录prune_every次清理一次更早的
+    "max_tracked_sessions": 5000,
+    "prune_every": 200
+}
 
-# 获取每个产品的初始症状
-INITIAL_SYMPTOMS = []
-try:
-    logger.info("开始提取产品初始症状")
-    for product_name, product_info in PRODUCT_CONFIG["products"].items():
-        if "initial_symptom" in product_info:
-            INITIAL_SYMPTOMS.append({
-                "product": product_name,
-                "symptom": product_info["initial_symptom"]
-            })
-            logger.info(f"产品[{product_name}]的初始症状: {product_info['initial_symptom']}")
-    logger.info(f"共提取了{len(INITIAL_SYMPTOMS)}个产品的初始症状")
-except Exception as e:
-    logger.error(f"提取产品初始症状失败: {str(e)}")
-    raise
+_token_encoder = None
+if tiktoken is not None:
+    try:
+        _token_encoder = tiktoken.get_encoding(TOKEN_BUDGET_CONFIG["encoding"])
+    except Exception as e:
+        logger.warning(f"tiktoken编码[{TOKEN_BUDGET_CONFIG['encoding']}]加载失败，改为按字符数估算: {str(e)}")
+logger.info(f"本地token计数方式: {'tiktoken' if _token_encoder else '字符数估算'}")
+
+
+def count_tokens(text):
+    """计算文本的token数；未安装tiktoken时中文字符按1个、其他字符按4个折合1个估算"""
+    if not text:
+        return 0
+    if _token_encoder is not None:
+        return len(_token_encoder.encode(text))
+    cjk = sum(1 for ch in text if '\u4e00' <= ch <= '\u9fff')
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(messages):
+    """计算chat消息列表作为提示词的token数"""
+    per_message = TOKEN_BUDGET_CONFIG["tokens_per_message"]
+    return sum(count_tokens(msg['content']) + per_message for msg in messages) + TOKEN_BUDGET_CONFIG["tokens_per_reply"]
+
+
+def fit_to_budget(messages, max_tokens):
+    """在上下文窗口内裁剪请求，返回(消息列表, 输出上限, 提示词token数, 是否裁剪)
+
+    超出时依次：丢弃最早的非系统消息（至少保留最后一条），从开头截断最后一条消息的内容，
+    最后才压缩输出上限，保证请求不会因超长被拒绝。
+    """
+    window = TOKEN_BUDGET_CONFIG["context_window"]
+    min_completion = TOKEN_BUDGET_CONFIG["min_completion_tokens"]
+    prompt_tokens = count_message_tokens(messages)
+    if prompt_tokens + max_tokens <= window:
+        return messages, max_tokens, prompt_tokens, False
+
+    budget = window - min(max_tokens, min_completion)
+    messages = list(messages)
+    while prompt_tokens > budget:
+        droppable = [i for i, msg in enumerate(messages[:-1]) if msg['role'] != 'system']
+        if not droppable:
+            break
+        prompt_tokens -= count_tokens(messages[droppable[0]]['content']) + TOKEN_BUDGET_CONFIG["tokens_per_message"]
+        del messages[droppable[0]]
+
+    if prompt_tokens > budget:
+        # 对话文本越靠后越重要，按比例从开头截断最后一条消息
+        last = messages[-1]
+        excess = prompt_tokens - budget
+        content_tokens = count_tokens(last['content'])
+        keep_chars = int(len(last['content']) * max(content_tokens - excess, 0) / max(content_tokens, 1))
+        while keep_chars > 0:
+            truncated = last['content'][-keep_chars:]
+            if prompt_tokens - content_tokens + count_tokens(truncated) <= budget:
+                break
+            keep_chars = int(keep_chars * 0.9)
+        truncated = last['content'][-keep_chars:] if keep_chars > 0 else ''
+        messages[-1] = dict(last, content=truncated)
+        prompt_tokens = prompt_tokens - content_tokens + count_tokens(truncated)
+
+    return messages, max(1, min(max_tokens, window - prompt_tokens)), prompt_tokens, True
+
+
+class TokenLedger:
+    """按调用端点、产品、会话统计token用量
+
+    汇总保存在共享的SQLite中，同一台机器上的多个工作进程合计统计，进程重启后仍保留；
+    本进程的按端点用量另外在内存中累计，自我对练等命令行任务用来报告本次运行的用量。
+    """
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self._lock = threading.Lock()
+        self._process_endpoints = {}
+        self._records = 0
+        self.started_at = datetime.now().isoformat()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS token_usage (
+                scope TEXT NOT NULL,
+                key TEXT NOT NULL,
+                calls INTEGER NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                trimmed_calls INTEGER NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (scope, key)
+            );
+            CREATE INDEX IF NOT EXISTS idx_token_usage_updated ON token_usage (scope, updated_at);
+            CREATE TABLE IF NOT EXISTS ledger_meta (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+        """)
+        self._conn.execute("INSERT OR IGNORE INTO ledger_meta (name, value) VALUES ('since', ?)", (self.started_at,))
+        self._conn.commit()
+        self.since = self._conn.execute("SELECT value FROM ledger_meta WHERE name = 'since'").fetchone()[0]
+
+    @staticmethod
+    def _usage(calls, prompt_tokens, completion_tokens, trimmed_calls):
+        return {"calls": calls, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens, "trimmed_calls": trimmed_calls}
+
+    def record(self, endpoint, prompt_tokens, completion_tokens, session_id=None, product=None, trimmed=False):
+        keys = [("endpoint", endpoint)]
+        if product:
+            keys.append(("product", product))
+        if session_id:
+            keys.append(("session", session_id))
+        now = time.time()
+        with self._lock:
+            usage = self._process_endpoints.setdefault(endpoint, self._usage(0, 0, 0, 0))
+            usage["calls"] += 1
+            usage["prompt_tokens"] += prompt_tokens
+            usage["completion_tokens"] += completion_tokens
+            usage["total_tokens"] += prompt_tokens + completion_tokens
+            usage["trimmed_calls"] += int(trimmed)
+            # 用量统计写入失败不影响模型调用本身
+            try:
+                self._conn.executemany(
+                    "INSERT INTO token_usage (scope, key, calls, prompt_tokens, completion_tokens, trimmed_calls, "
+                    "updated_at) VALUES (?, ?, 1, ?, ?, ?, ?) ON CONFLICT (scope, key) DO UPDATE SET "
+                    "calls = calls + 1, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                    "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                    "trimmed_calls = trimmed_calls + excluded.trimmed_calls, updated_at = excluded.updated_at",
+                    [(scope, key, prompt_tokens, completion_tokens, int(trimmed), now) for scope, key in keys])
+                self._records += 1
+                if self._records % self.config["prune_every"] == 0:
+                    # 按会话的统计只保留最近更新的若干个
+                    self._conn.execute(
+                        "DELETE FROM token_usage WHERE scope = 'session' AND key NOT IN ("
+                        "SELECT key FROM token_usage WHERE scope = 'session' ORDER BY updated_at DESC LIMIT ?)",
+                        (self.config["max_tracked_sessions"],))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._conn.rollback()
+                logger.error(f"记录token用量失败: {str(e)}")
+
+    def session_usage(self, session_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT calls, prompt_tokens, completion_tokens, trimmed_calls FROM token_usage "
+                "WHERE scope = 'session' AND key = ?", (session_id,)).fetchone()
+        return self._usage(*row) if row else None
+
+    def snapshot(self, top=20):
+        """所有工作进程合计的用量，process字段为本进程启动以来的按端点用量"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT scope, key, calls, prompt_tokens, completion_tokens, trimmed_calls FROM token_usage "
+                "WHERE scope != 'session' ORDER BY key").fetchall()
+            top_sessions = self._conn.execute(
+                "SELECT key, calls, prompt_tokens, completion_tokens, trimmed_calls FROM token_usage "
+                "WHERE scope = 'session' ORDER BY prompt_tokens + completion_tokens DESC LIMIT ?", (top,)).fetchall()
+            tracked = self._conn.execute("SELECT COUNT(*) FROM token_usage WHERE scope = 'session'").fetchone()[0]
+            process_endpoints = {key: dict(value) for key, value in self._process_endpoints.items()}
+        return {
+            "since": self.since,
+            "tokenizer": "tiktoken" if _token_encoder else "estimate",
+            "endpoints": {key: self._usage(*values) for scope, key, *values in rows if scope == "endpoint"},
+            "products": {key: self._usage(*values) for scope, key, *values in rows if scope == "product"},
+            "top_sessions": [dict(self._usage(*values), session_id=key) for key, *values in top_sessions],
+            "tracked_sessions": tracked,
+            "process": {"pid": os.getpid(), "since": self.started_at, "endpoints": process_endpoints}
+        }
+
+
+
+
+def budget_completion(endpoint, messages, params, session_id=None):
+    """调用模型前按上下文窗口裁剪请求，返回(消息列表, 调用参数, 提示词token数, 是否裁剪)"""
+    messages, max_tokens, prompt_tokens, trimmed = fit_to_budget(messages, params["max_tokens"])
+    if trimmed:
+        logger.warning(f"会话[{session_id}]的{endpoint}请求超出上下文窗口，已裁剪到{prompt_tokens}个提示词token，"
+                       f"输出上限{max_tokens}")
+    return messages, dict(params, max_tokens=max_tokens), prompt_tokens, trimmed
+
+
+def record_usage(endpoint, prompt_tokens, completion_text, response=None, session=None, session_id=None,
+                 product=None, trimmed=False):
+    """记录一次调用的token用量：优先使用接口返回的usage，流式调用按本地计数
+
+    传入session时用量同时累加到会话记录的token_usage字段，随会话保存持久化。
+    """
+    usage = getattr(response, 'usage', None)
+    if usage is not None:
+        prompt_tokens = usage.prompt_tokens
+        completion_tokens = usage.completion_tokens
+    else:
+        completion_tokens = count_tokens(completion_text)
+    if session is not None:
+        session_id = session['id']
+        product = product or session.get('target_product')
+    token_ledger.record(endpoint, prompt_tokens, completion_tokens, session_id, product, trimmed)
+    if session is not None:
+        totals = session.setdefault('token_usage', {})
+        endpoint_usage = totals.setdefault(endpoint, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+        endpoint_usage["calls"] += 1
+        endpoint_usage["prompt_tokens"] += prompt_tokens
+        endpoint_usage["completion_tokens"] += completion_tokens
+    return prompt_tokens, completion_tokens
 
 # 系统提示词配置
 PATIENT_SYSTEM_PROMPT = """你是一位正在寻求购药建议的普通患者。你的任务是模拟真实的患者行为，向药店在线客服咨询并购买药品。你应该：
@@ -94,8 +1177,8 @@ PATIENT_SYSTEM_PROMPT = """你是一位正在寻求购药建议的普通患者
 """
 logger.info("系统提示词配置完成")
 
-# 评分系统提示词模板
-EVALUATION_SYSTEM_PROMPT_TEMPLATE = """你是一位专业的客服质量评估专家，同时也是医药专业人士。请根据以下对话记录及产品信息，评估客服人员的表现。
+# 评分系统提示词模板：产品信息放在末尾，所有产品共用评分标准部分的前缀
+EVALUATION_SYSTEM_PROMPT_TEMPLATE = """你是一位专业的客服质量评估专家，同时也是医药专业人士。请根据对话记录及文末的目标产品信息，评估客服人员的表现。
 
 评分标准包括：
 1. 专业性（30分）：产品知识掌握程度、医学常识准确性、产品信息描述是否符合实际情况
@@ -103,9 +1186,6 @@ EVALUATION_SYSTEM_PROMPT_TEMPLATE = """你是一位专业的客服质量评估
 3. 解决问题能力（25分）：理解客户需求、提供合适建议、处理异议、是否正确推荐了目标产品
 4. 服务态度（20分）：礼貌程度、主动性、服务意识、回复速度
 
-目标产品信息：
-{product_info}
-
 请给出总分（满分100分）和具体评价，指出优点和需要改进的地方。尤其要注意客服对产品信息描述的准确性。
 如果客服描述的产品信息（如价格、用法用量、功效等）与实际不符，请在评价中指出并扣分。
 如果客服未能成功推荐目标产品或推荐了错误的产品，请扣除相应分数。
@@ -121,74 +1201,1238 @@ EVALUATION_SYSTEM_PROMPT_TEMPLATE = """你是一位专业的客服质量评估
     "improvements": ["可以更主动询问顾客需求", "解释可以更通俗易懂"],
     "overall_comment": "整体表现良好，专业知识扎实，建议加强主动服务意识。"
 }}
-"""
+
+目标产品信息：
+{product_info}"""
 logger.info("评分系统提示词模板配置完成")
 
-# 存储当前会话的数据
-sessions = {}
-logger.info("会话存储初始化完成")
+# 逐轮评分系统提示词模板：只评价一条客服回复，输出很短
+TURN_EVALUATION_SYSTEM_PROMPT_TEMPLATE = """你是一位专业的客服质量评估专家，同时也是医药专业人士。请逐轮评估客服的表现：只评价对话中最后一条客服回复，前文仅供理解上下文。
 
-# HTML模板（简单的单页面应用）
-HTML_TEMPLATE = '''
-<!DOCTYPE html>
-<html lang="zh-CN">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>汇仁医药客服对话系统</title>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Arial, sans-serif;
-            background-color: #f5f5f5;
-            height: 100vh;
-            display: flex;
-            flex-direction: column;
-        }
-        .header {
-            background-color: #2c3e50;
-            color: white;
-            padding: 15px 20px;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-        .container {
-            flex: 1;
-            display: flex;
-            max-width: 1200px;
-            margin: 0 auto;
-            width: 100%;
-            padding: 20px;
-            gap: 20px;
-        }
-        .sidebar {
-            width: 250px;
-            background: white;
-            border-radius: 8px;
-            padding: 20px;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }
-        .main-content {
-            flex: 1;
-            display: flex;
-            flex-direction: column;
-        }
-        .chat-container {
-            flex: 1;
-            background: white;
-            border-radius: 8px;
-            padding: 20px;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            display: flex;
-            flex-direction: column;
-        }
-        .messages {
-            flex: 1;
+评分项：
+1. product_accuracy（0-100）：本条回复中的产品信息（功效、用法用量、禁忌、价格等）是否与产品信息一致；本条回复没有涉及产品信息时为null
+2. empathy（0-100）：是否理解并回应了患者的感受和需求，语气是否耐心礼貌
+3. mentions_target_product（true/false）：本条回复是否向患者推荐或介绍了目标产品（目标产品信息见文末）
+
+只输出JSON，strength和improvement各不超过15个字，没有时为空字符串：
+{{"product_accuracy": 85, "empathy": 80, "mentions_target_product": true, "strength": "用法用量说明准确", "improvement": "可以追问用药史"}}
+
+目标产品信息：
+{product_info}"""
+
+# 目标产品提示词（追加在患者系统提示词之后）
+PATIENT_TARGET_PROMPT_TEMPLATE = """
+你的目标产品是：{target_product}。
+请自然地引导客服推荐这个产品，但不要直接说出产品名称。可以描述与这个产品相关的症状，询问类似效果的药品。
+"""
+
+
+def format_product_info(target_product, product_config):
+    """格式化目标产品的详细信息，用于评分提示词"""
+    product_info = ""
+    if target_product in product_config["products"]:
+        product_data = product_config["products"][target_product]
+
+        # 格式化产品详细信息
+        product_info = f"产品名称: {target_product}\n"
+
+        # 添加产品说明
+        if "产品说明" in product_data:
+            product_info += "产品说明:\n"
+            for key, value in product_data["产品说明"].items():
+                if isinstance(value, list):
+                    product_info += f"- {key}: \n"
+                    for item in value:
+                        product_info += f"  * {item}\n"
+                else:
+                    product_info += f"- {key}: {value}\n"
+
+        # 添加价目表
+        if "价目表" in product_data:
+            product_info += "价目表:\n"
+            for item in product_data["价目表"]:
+                product_info += f"- 规格: {item.get('商品规格', '未知')}，价格: {item.get('零售价', '未知')}元\n"
+    return product_info
+
+
+def render_product_prompts(target_product, product_config):
+    """渲染单个产品的患者系统提示词和评分系统提示词
+
+    提示词按"通用内容在前、产品相关内容在后"排列（评分提示词的产品信息在末尾），并且每次渲染结果逐字节一致，
+    对话历史紧跟其后，便于模型服务端的提示词前缀缓存命中。
+    """
+    patient_prompt = PATIENT_SYSTEM_PROMPT
+    if target_product:
+        patient_prompt += PATIENT_TARGET_PROMPT_TEMPLATE.format(target_product=target_product)
+    product_info = format_product_info(target_product, product_config)
+    return MappingProxyType({
+        "patient_system_prompt": patient_prompt,
+        "product_info": product_info,
+        "evaluation_system_prompt": EVALUATION_SYSTEM_PROMPT_TEMPLATE.format(product_info=product_info),
+        "turn_evaluation_system_prompt": TURN_EVALUATION_SYSTEM_PROMPT_TEMPLATE.format(product_info=product_info)
+    })
+
+
+def build_prompt_cache(product_config):
+    """加载配置时为所有产品预先渲染提示词，返回只读的 产品名 -> 提示词 映射"""
+    return MappingProxyType({
+        product_name: render_product_prompts(product_name, product_config)
+        for product_name in product_config["products"]
+    })
+
+
+def validate_product_config(product_config):
+    """校验产品配置结构，不合法时抛出ValueError"""
+    if not isinstance(product_config, dict) or not isinstance(product_config.get("products"), dict):
+        raise ValueError("产品配置缺少products字段或格式错误")
+    if not product_config["products"]:
+        raise ValueError("产品配置中没有任何产品")
+    for product_name, product_data in product_config["products"].items():
+        if not isinstance(product_data, dict):
+            raise ValueError(f"产品[{product_name}]的配置必须是对象")
+        if "initial_symptom" in product_data and (
+                not isinstance(product_data["initial_symptom"], str) or not product_data["initial_symptom"].strip()):
+            raise ValueError(f"产品[{product_name}]的initial_symptom必须是非空字符串")
+        if "产品说明" in product_data and not isinstance(product_data["产品说明"], dict):
+            raise ValueError(f"产品[{product_name}]的产品说明必须是对象")
+        if "价目表" in product_data and (
+                not isinstance(product_data["价目表"], list)
+                or not all(isinstance(item, dict) for item in product_data["价目表"])):
+            raise ValueError(f"产品[{product_name}]的价目表必须是对象列表")
+    if not any("initial_symptom" in product_data for product_data in product_config["products"].values()):
+        raise ValueError("产品配置中没有任何产品提供initial_symptom")
+
+
+class ProductCatalog:
+    """产品目录的一个只读版本：原始配置、初始症状及预渲染的提示词和查找表"""
+
+    def __init__(self, product_config, version):
+        self.version = version
+        self.config = product_config
+        self.initial_symptoms = tuple(
+            MappingProxyType({"product": product_name, "symptom": product_data["initial_symptom"]})
+            for product_name, product_data in product_config["products"].items()
+            if "initial_symptom" in product_data
+        )
+        self.product_by_symptom = MappingProxyType({
+            item["symptom"]: item["product"] for item in self.initial_symptoms
+        })
+        self.prompts = build_prompt_cache(product_config)
+
+    def get_prompts(self, target_product):
+        """获取产品的预渲染提示词，目录中不存在的产品临时渲染"""
+        prompts = self.prompts.get(target_product)
+        if prompts is None:
+            prompts = render_product_prompts(target_product, self.config)
+        return prompts
+
+
+def load_product_catalog(path):
+    """读取、校验产品配置文件并构建目录，版本号为文件内容的摘要"""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    product_config = json.loads(raw.decode('utf-8'))
+    validate_product_config(product_config)
+    return ProductCatalog(product_config, hashlib.sha1(raw).hexdigest()[:12])
+
+
+# 产品目录热加载配置
+CATALOG_CONFIG = {
+    "path": "product_config.json",
+    # 检查配置文件是否变化的间隔，0表示不监听，只能通过管理接口重新加载
+    "watch_interval_seconds": 5,
+    # 内存中保留的历史版本数；版本被淘汰或进程重启后，会话按开始时保存的产品信息快照重建该版本的目录
+    "max_versions": 4,
+    # 由快照重建的（版本, 产品）目录的缓存数
+    "max_restored": 256
+}
+
+
+class CatalogManager:
+    """管理产品目录版本：在后台校验并构建新版本，再以一次引用赋值原子替换"""
+
+    def __init__(self, config):
+        self.config = config
+        self._versions = OrderedDict()
+        self._restored = OrderedDict()
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._watcher = None
+        self._listeners = []
+        self.current = None
+        self.last_reload = None
+
+    def on_change(self, callback):
+        """注册目录版本切换后的回调，参数为新版本目录"""
+        self._listeners.append(callback)
+
+    def reload(self):
+        """从配置文件重新加载，校验失败时保留当前版本并抛出异常"""
+        start = time.perf_counter()
+        mtime = os.path.getmtime(self.config["path"])
+        catalog = load_product_catalog(self.config["path"])
+        with self._lock:
+            self._mtime = mtime
+            changed = self.current is None or catalog.version != self.current.version
+            if changed:
+                self._versions[catalog.version] = catalog
+                while len(self._versions) > self.config["max_versions"]:
+                    self._versions.popitem(last=False)
+                self.current = catalog
+            self.last_reload = {
+                "version": self.current.version,
+                "changed": changed,
+                "products": len(catalog.config["products"]),
+                "seconds": round(time.perf_counter() - start, 4),
+                "reloaded_at": datetime.now().isoformat()
+            }
+        if changed:
+            logger.info(f"产品目录已切换到版本[{catalog.version}]，共{len(catalog.config['products'])}个产品，"
+                        f"耗时{self.last_reload['seconds']}秒")
+            for callback in self._listeners:
+                callback(catalog)
+        return self.last_reload
+
+    def get(self, version):
+        """按版本号获取目录，未指定时返回当前版本，版本已淘汰或不在本进程中时返回None"""
+        with self._lock:
+            if version is None:
+                return self.current
+            return self._versions.get(version)
+
+    def restore(self, version, target_product, product_data):
+        """由会话保存的产品信息快照重建某个版本的单产品目录，提示词与该版本渲染的结果一致"""
+        key = (version, target_product)
+        with self._lock:
+            catalog = self._restored.get(key)
+            if catalog is not None:
+                self._restored.move_to_end(key)
+                return catalog
+        catalog = ProductCatalog({"products": {target_product: product_data}}, version)
+        with self._lock:
+            self._restored[key] = catalog
+            while len(self._restored) > self.config["max_restored"]:
+                self._restored.popitem(last=False)
+        logger.info(f"由会话快照重建了产品目录版本[{version}]中的产品[{target_product}]")
+        return catalog
+
+    def start_watching(self):
+        """启动后台线程，配置文件修改后自动重新加载（可重复调用）"""
+        if not self.config["watch_interval_seconds"] or self._watcher is not None:
+            return
+        self._watcher = threading.Thread(target=self._watch, name="catalog-watcher", daemon=True)
+        self._watcher.start()
+        logger.info("产品配置文件监听已启动")
+
+    def _watch(self):
+        while True:
+            time.sleep(self.config["watch_interval_seconds"])
+            try:
+                if os.path.getmtime(self.config["path"]) != self._mtime:
+                    logger.info("检测到产品配置文件变化，开始重新加载")
+                    self.reload()
+            except Exception as e:
+                logger.error(f"产品配置重新加载失败，继续使用版本[{self.current.version}]: {str(e)}")
+                # 记录本次修改时间，文件再次修改前不重复尝试
+                try:
+                    self._mtime = os.path.getmtime(self.config["path"])
+                except OSError:
+                    pass
+
+
+# 加载产品配置
+try:
+    logger.info("开始加载产品配置文件")
+    catalog_manager = CatalogManager(CATALOG_CONFIG)
+    catalog_manager.reload()
+    logger.info(f"产品配置加载成功, 共有{len(catalog_manager.current.config['products'])}个产品")
+    for item in catalog_manager.current.initial_symptoms:
+        logger.info(f"产品[{item['product']}]的初始症状: {item['symptom']}")
+    logger.info(f"共提取了{len(catalog_manager.current.initial_symptoms)}个产品的初始症状")
+    catalog_manager.start_watching()
+except Exception as e:
+    logger.error(f"产品配置加载失败: {str(e)}")
+    raise
+
+
+def catalog_for_session(session):
+    """获取会话开始时使用的产品目录版本；该版本已不在内存中时由会话的产品信息快照重建"""
+    version = session.get('catalog_version')
+    catalog = catalog_manager.get(version)
+    if catalog is not None:
+        return catalog
+    target_product = session.get('target_product')
+    snapshot = session.get('product_snapshot')
+    if snapshot is not None:
+        return catalog_manager.restore(version, target_product, snapshot)
+    logger.warning(f"会话[{session.get('id')}]的产品目录版本[{version}]已不可用且没有产品信息快照，"
+                   f"改用当前版本[{catalog_manager.current.version}]")
+    return catalog_manager.current
+
+
+# 会话数据目录及索引配置
+DATA_DIR = 'data'
+SESSION_INDEX_CONFIG = {
+    "path": os.path.join(DATA_DIR, "session_index.db"),
+    "default_page_size": 50,
+    "max_page_size": 500,
+    "payload_cache_size": 256
+}
+SESSION_SORT_FIELDS = ("timestamp", "score", "status", "target_product")
+
+# 会话归档配置：已完成的会话追加写入分段文件，代替每个会话一个JSON文件
+ARCHIVE_CONFIG = {
+    # 开启后新完成的会话直接写入归档；已有的会话文件可通过 python app.py archive 迁移
+    "enabled": os.environ.get("SESSION_ARCHIVE") == "1",
+    "dir": os.path.join(DATA_DIR, "archive"),
+    "segment_max_bytes": 64 * 1024 * 1024
+}
+ARCHIVE_LOCATION_PREFIX = "archive:"
+
+
+class SessionArchive:
+    """只追加的会话归档：每个分段文件每行一个紧凑JSON会话，旁边的.idx文件逐行记录偏移量和索引字段
+
+    会话在归档中的位置记为 "archive:<分段文件名>:<偏移>:<长度>"，与会话文件路径一样保存在会话索引中，
+    按ID读取时直接定位，无需扫描分段。同一会话再次写入时追加新版本，索引指向最新版本。
+    重新评分的结果不追加新版本，按(会话ID, tag)保存在归档目录的rescores.db中原地更新，读取时合并到会话的rescores字段。
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.dir = config["dir"]
+        self._lock = threading.Lock()
+        self._rescores_lock = threading.Lock()
+        self._rescores_conn = None
+
+    @staticmethod
+    def is_location(path):
+        return bool(path) and path.startswith(ARCHIVE_LOCATION_PREFIX)
+
+    def _segments(self):
+        if not os.path.isdir(self.dir):
+            return []
+        return sorted(name for name in os.listdir(self.dir) if name.startswith("segment_") and name.endswith(".jsonl"))
+
+    def _segment_path(self, name):
+        return os.path.join(self.dir, name)
+
+    def _current_segment(self, incoming):
+        segments = self._segments()
+        if segments:
+            size = os.path.getsize(self._segment_path(segments[-1]))
+            if size == 0 or size + incoming <= self.config["segment_max_bytes"]:
+                return segments[-1]
+            number = int(segments[-1][len("segment_"):-len(".jsonl")]) + 1
+        else:
+            number = 1
+        return f"segment_{number:06d}.jsonl"
+
+    def append(self, session):
+        """追加一个会话，返回它在归档中的位置"""
+        record = (json_dumps(session) + "\n").encode('utf-8')
+        os.makedirs(self.dir, exist_ok=True)
+        with self._lock, open(os.path.join(self.dir, ".lock"), 'a') as lock_file:
+            # 多个工作进程可能同时归档，分段选择和写入在文件锁内完成
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            name = self._current_segment(len(record))
+            with open(self._segment_path(name), 'ab') as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(record)
+            entry = {"id": session['id'], "offset": offset, "length": len(record),
+                     "timestamp": session.get('timestamp'), "score": session.get('score'),
+                     "status": session.get('status', 'completed'),
+                     "target_product": session.get('target_product', '未知产品')}
+            with open(self._segment_path(name)[:-len(".jsonl")] + ".idx", 'a', encoding='utf-8') as f:
+                f.write(json_dumps(entry) + "\n")
+        return f"{ARCHIVE_LOCATION_PREFIX}{name}:{offset}:{len(record)}"
+
+    def _rescores(self, create=False):
+        """打开重新评分结果库，库不存在且create为False时返回None；调用方需持有_rescores_lock"""
+        if self._rescores_conn is None:
+            path = os.path.join(self.dir, "rescores.db")
+            if not create and not os.path.exists(path):
+                return None
+            os.makedirs(self.dir, exist_ok=True)
+            conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS rescores ("
+                         "id TEXT NOT NULL, tag TEXT NOT NULL, evaluation TEXT NOT NULL, PRIMARY KEY (id, tag))")
+            conn.commit()
+            self._rescores_conn = conn
+        return self._rescores_conn
+
+    def set_rescore(self, session_id, tag, evaluation):
+        """保存会话按tag重新评分的结果，同一tag重复运行时覆盖"""
+        with self._rescores_lock:
+            conn = self._rescores(create=True)
+            conn.execute("INSERT OR REPLACE INTO rescores (id, tag, evaluation) VALUES (?, ?, ?)",
+                         (session_id, tag, json_dumps(evaluation)))
+            conn.commit()
+
+    def _merge_rescores(self, session, rescores):
+        if rescores:
+            session.setdefault('rescores', {}).update(
+                (tag, json_loads(evaluation)) for tag, evaluation in rescores)
+        return session
+
+    def read(self, location):
+        """按位置读取一个会话，合并重新评分的结果"""
+        name, offset, length = location[len(ARCHIVE_LOCATION_PREFIX):].rsplit(":", 2)
+        with open(self._segment_path(name), 'rb') as f:
+            f.seek(int(offset))
+            session = json_loads(f.read(int(length)))
+        with self._rescores_lock:
+            conn = self._rescores()
+            rescores = conn.execute("SELECT tag, evaluation FROM rescores WHERE id = ?",
+                                    (session['id'],)).fetchall() if conn else []
+        return self._merge_rescores(session, rescores)
+
+    def iter_index(self):
+        """按写入顺序产出(索引字段, 位置)；.idx缺少的尾部记录（写入中途退出）从分段文件补读"""
+        for name in self._segments():
+            covered = 0
+            idx_path = self._segment_path(name)[:-len(".jsonl")] + ".idx"
+            if os.path.exists(idx_path):
+                with open(idx_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json_loads(line)
+                        except ValueError:
+                            continue
+                        covered = max(covered, entry["offset"] + entry["length"])
+                        yield entry, f"{ARCHIVE_LOCATION_PREFIX}{name}:{entry['offset']}:{entry['length']}"
+            with open(self._segment_path(name), 'rb') as f:
+                f.seek(covered)
+                offset = covered
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    session = json_loads(line)
+                    entry = {"id": session['id'], "timestamp": session.get('timestamp'),
+                             "score": session.get('score'), "status": session.get('status', 'completed'),
+                             "target_product": session.get('target_product', '未知产品')}
+                    yield entry, f"{ARCHIVE_LOCATION_PREFIX}{name}:{offset}:{len(line)}"
+                    offset += len(line)
+
+    def iter_sessions(self):
+        """顺序读取所有分段中的会话（同一会话的旧版本也会产出），合并重新评分的结果"""
+        rescores = {}
+        with self._rescores_lock:
+            conn = self._rescores()
+            for session_id, tag, evaluation in (conn.execute("SELECT id, tag, evaluation FROM rescores")
+                                                if conn else []):
+                rescores.setdefault(session_id, []).append((tag, evaluation))
+        for name in self._segments():
+            with open(self._segment_path(name), 'rb') as f:
+                for line in f:
+                    if line.endswith(b"\n"):
+                        session = json_loads(line)
+                        yield self._merge_rescores(session, rescores.get(session['id']))
+
+    def disk_usage(self):
+        """返回(文件数, 字节数)"""
+        if not os.path.isdir(self.dir):
+            return 0, 0
+        names = [name for name in os.listdir(self.dir) if name.endswith((".jsonl", ".idx"))]
+        return len(names), sum(os.path.getsize(os.path.join(self.dir, name)) for name in names)
+
+
+session_archive = SessionArchive(ARCHIVE_CONFIG)
+
+
+def archive_for_data_dir(data_dir):
+    """返回data目录对应的归档，默认data目录使用全局归档"""
+    if os.path.abspath(data_dir) == os.path.abspath(DATA_DIR):
+        return session_archive
+    return SessionArchive(dict(ARCHIVE_CONFIG, dir=os.path.join(data_dir, "archive")))
+
+
+def read_session_location(path):
+    """按索引中记录的位置读取会话：归档位置或会话文件路径"""
+    if SessionArchive.is_location(path):
+        return session_archive.read(path)
+    return load_json_file(path)
+
+
+class SessionIndex:
+    """基于SQLite的会话索引，避免每次列表请求都全量扫描data目录"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        # 多个工作进程共享同一个索引文件
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                timestamp TEXT NOT NULL,
+                score NUMERIC,
+                status TEXT NOT NULL,
+                target_product TEXT,
+                path TEXT
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_timestamp ON sessions(timestamp)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_score ON sessions(score)")
+        self._conn.commit()
+
+    def upsert(self, session, path=None):
+        """写入或更新一条会话索引记录"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, timestamp, score, status, target_product, path) "
+                "VALUES (?, ?, ?, ?, ?, COALESCE(?, (SELECT path FROM sessions WHERE id = ?)))",
+                (session['id'], session['timestamp'], session.get('score'),
+                 session.get('status', 'active'), session.get('target_product', '未知产品'),
+                 path, session['id'])
+            )
+            self._conn.commit()
+
+    def delete_unpersisted(self, session_ids):
+        """删除没有对应文件的会话记录（已放弃的进行中会话）"""
+        with self._lock:
+            self._conn.executemany("DELETE FROM sessions WHERE id = ? AND path IS NULL",
+                                   [(session_id,) for session_id in session_ids])
+            self._conn.commit()
+
+    def find_by_status(self, status):
+        """返回指定状态且已保存的会话(id, 路径或归档位置)列表"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, path FROM sessions WHERE status = ? AND path IS NOT NULL", (status,)
+            ).fetchall()
+
+    def get_path(self, session_id):
+        """按会话ID精确查找已保存的会话文件路径或归档位置
+
+        每次按主键查询索引库而不在进程内缓存：其他工作进程可能已把会话迁入归档或追加了新版本。
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT path FROM sessions WHERE id = ? AND path IS NOT NULL", (session_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def query(self, page=1, page_size=50, sort='timestamp', order='desc'):
+        """分页、排序查询会话列表，返回(记录列表, 总数)"""
+        if sort not in SESSION_SORT_FIELDS:
+            sort = 'timestamp'
+        direction = 'ASC' if order == 'asc' else 'DESC'
+        offset = (page - 1) * page_size
+        with self._lock:
+            total = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            rows = self._conn.execute(
+                f"SELECT id, timestamp, score, status, target_product FROM sessions "
+                f"ORDER BY {sort} {direction}, id {direction} LIMIT ? OFFSET ?",
+                (page_size, offset)
+            ).fetchall()
+        return [
+            {'id': r[0], 'timestamp': r[1], 'score': r[2], 'status': r[3], 'target_product': r[4]}
+            for r in rows
+        ], total
+
+    def drop_unpersisted(self, keep_ids=(), before=None):
+        """删除没有对应文件的记录（进程重启后内存中的进行中会话已丢失），keep_ids中的会话保留
+
+        before限定只删除开始时间早于该时间的会话，其他工作进程在此之后创建的会话不受影响。
+        """
+        keep_ids = set(keep_ids)
+        with self._lock:
+            rows = self._conn.execute("SELECT id FROM sessions WHERE path IS NULL AND timestamp < ?",
+                                      (before or datetime.max.isoformat(),))
+            stale = [(row[0],) for row in rows if row[0] not in keep_ids]
+            self._conn.executemany("DELETE FROM sessions WHERE id = ?", stale)
+            self._conn.commit()
+        return len(stale)
+
+    def rebuild(self, data_dir):
+        """从data目录的会话文件和归档全量重建索引，返回写入的记录数"""
+        rows = []
+        for filename in os.listdir(data_dir):
+            if not (filename.endswith('.json') and filename.startswith('session_')):
+                continue
+            file_path = os.path.join(data_dir, filename)
+            try:
+                session_data = load_json_file(file_path)
+                rows.append((
+                    session_data['id'], session_data['timestamp'], session_data.get('score'),
+                    session_data.get('status', 'completed'),
+                    session_data.get('target_product', '未知产品'), file_path
+                ))
+            except Exception as e:
+                logger.error(f"重建索引时加载会话文件出错 {filename}: {str(e)}")
+        # 同一会话存在多个文件时按文件名排序，保留最后写入的一份
+        rows.sort(key=lambda r: r[5])
+        # 归档中的版本比会话文件新，按写入顺序排在后面覆盖
+        try:
+            for entry, location in session_archive.iter_index():
+                rows.append((entry['id'], entry['timestamp'], entry.get('score'), entry['status'],
+                             entry['target_product'], location))
+        except Exception as e:
+            logger.error(f"重建索引时读取会话归档出错: {str(e)}")
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions")
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sessions (id, timestamp, score, status, target_product, path) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+        return len(rows)
+
+
+# 会话存储配置
+SESSION_STORE_CONFIG = {
+    # memory: 进程内存储（只能单进程运行）; sqlite: 多个工作进程共享的SQLite存储
+    "backend": os.environ.get("SESSION_STORE_BACKEND", "memory"),
+    "sqlite_path": os.path.join(DATA_DIR, "sessions.db"),
+    # 内存中最多保留的会话数，超出后淘汰最久未访问的会话
+    "max_sessions": 2000,
+    # 超过该时间未访问的会话被淘汰
+    "idle_ttl_seconds": 1800,
+    "sweep_interval_seconds": 60,
+    # 被淘汰的进行中会话写入该目录，下次访问时自动恢复
+    "spill_dir": os.path.join(DATA_DIR, "spill"),
+    # 进行中的会话超过该时间未再访问视为已放弃，删除写出的会话（或会话库中的记录）及其索引记录
+    "spill_ttl_seconds": 3 * 86400
+}
+
+
+class SessionStoreBase(ABC):
+    """会话存储接口
+
+    get返回的会话可能是副本，修改后必须调用save写回，其他工作进程才能看到。
+    后台任务（逐轮评分、摘要等）在耗时的模型调用之后写回时使用update，只修改自己负责的字段，
+    避免用调用前读取的旧副本覆盖期间其他请求写入的消息。
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._expire_listeners = []
+
+    def on_expire(self, callback):
+        """注册已放弃的进行中会话被删除后的回调，参数为会话ID列表"""
+        self._expire_listeners.append(callback)
+
+    def _notify_expired(self, session_ids):
+        for callback in self._expire_listeners:
+            try:
+                callback(session_ids)
+            except Exception as e:
+                logger.error(f"处理已放弃会话的回调失败: {str(e)}")
+
+    @abstractmethod
+    def get(self, session_id):
+        """按ID获取会话，不存在时返回None"""
+
+    @abstractmethod
+    def save(self, session):
+        """保存（新建或覆盖）会话"""
+
+    @abstractmethod
+    def update(self, session_id, mutate):
+        """原子地读取会话、调用mutate(session)修改并写回，期间其他进程和线程的写入会等待；
+        返回修改后的会话，会话不存在时返回None（不调用mutate）"""
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+    def spilled_ids(self):
+        """返回未归档到文件、但进程重启后仍可恢复的会话ID"""
+        return []
+
+    def snapshot(self):
+        """返回存储的统计信息"""
+        return {}
+
+
+class InMemorySessionStore(SessionStoreBase):
+    """有容量上限的进程内会话存储
+
+    按LRU和空闲时间淘汰会话：已保存到文件的会话直接丢弃，进行中的会话
+    交给后台线程写入spill目录（write-behind），再次访问时从磁盘恢复。
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._sessions = OrderedDict()
+        self._last_access = {}
+        self._pending_spill = {}
+        self._spill_queue = queue.Queue()
+        self._lock = threading.RLock()
+        self.stats = {"evicted": 0, "spilled": 0, "rehydrated": 0, "spill_expired": 0}
+        os.makedirs(config["spill_dir"], exist_ok=True)
+        threading.Thread(target=self._spill_worker, name="session-spill", daemon=True).start()
+        threading.Thread(target=self._sweeper, name="session-sweeper", daemon=True).start()
+
+    def _spill_path(self, session_id):
+        return os.path.join(self.config["spill_dir"], f"{session_id}.json")
+
+    def save(self, session):
+        session_id = session['id']
+        with self._lock:
+            self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            self._last_access[session_id] = time.monotonic()
+            self._pending_spill.pop(session_id, None)
+            while len(self._sessions) > self.config["max_sessions"]:
+                self._evict(next(iter(self._sessions)))
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return self._rehydrate(session_id)
+            self._sessions.move_to_end(session_id)
+            self._last_access[session_id] = time.monotonic()
+            return session
+
+    def update(self, session_id, mutate):
+        with self._lock:
+            session = self.get(session_id)
+            if session is None:
+                return None
+            mutate(session)
+            self.save(session)
+            return session
+
+    def __contains__(self, session_id):
+        with self._lock:
+            return (session_id in self._sessions or session_id in self._pending_spill
+                    or os.path.exists(self._spill_path(session_id)))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def spilled_ids(self):
+        """返回spill目录中已写出的会话ID"""
+        return [name[:-len('.json')] for name in os.listdir(self.config["spill_dir"]) if name.endswith('.json')]
+
+    def snapshot(self):
+        on_disk = len(self.spilled_ids())
+        with self._lock:
+            return dict(self.stats, backend="memory", in_memory=len(self._sessions),
+                        pending_spill=len(self._pending_spill), spilled_on_disk=on_disk)
+
+    def _evict(self, session_id):
+        session = self._sessions.pop(session_id)
+        self._last_access.pop(session_id, None)
+        self.stats["evicted"] += 1
+        # 进行中的会话尚未保存到文件，需要写出以便之后恢复
+        if session.get('status', 'active') == 'active':
+            self._pending_spill[session_id] = session
+            self._spill_queue.put(session_id)
+
+    def _rehydrate(self, session_id):
+        session = self._pending_spill.pop(session_id, None)
+        if session is None:
+            spill_path = self._spill_path(session_id)
+            try:
+                session = load_json_file(spill_path)
+            except FileNotFoundError:
+                return None
+            os.remove(spill_path)
+        logger.info(f"会话[{session_id}]已从磁盘恢复到内存")
+        self.stats["rehydrated"] += 1
+        self.save(session)
+        return session
+
+    def _spill_worker(self):
+        while True:
+            session_id = self._spill_queue.get()
+            with self._lock:
+                session = self._pending_spill.get(session_id)
+            if session is None:
+                continue
+            spill_path = self._spill_path(session_id)
+            try:
+                write_json_atomic(spill_path, session)
+            except Exception as e:
+                logger.error(f"会话[{session_id}]写入spill目录失败: {str(e)}")
+                continue
+            with self._lock:
+                if self._pending_spill.get(session_id) is session:
+                    del self._pending_spill[session_id]
+                    self.stats["spilled"] += 1
+                elif session_id in self._sessions:
+                    # 写出期间会话已被重新访问，磁盘上的副本作废；删除失败只记录日志，写出线程继续运行
+                    try:
+                        os.remove(spill_path)
+                    except FileNotFoundError:
+                        pass
+                    except OSError as e:
+                        logger.error(f"会话[{session_id}]删除作废的spill文件失败 {spill_path}: {str(e)}")
+
+    def _sweeper(self):
+        while True:
+            time.sleep(self.config["sweep_interval_seconds"])
+            deadline = time.monotonic() - self.config["idle_ttl_seconds"]
+            with self._lock:
+                idle = [sid for sid in self._sessions if self._last_access.get(sid, 0) < deadline]
+                for session_id in idle:
+                    self._evict(session_id)
+            if idle:
+                logger.info(f"淘汰了{len(idle)}个空闲会话")
+            try:
+                expired = self._expire_spilled()
+            except OSError as e:
+                logger.error(f"清理spill目录失败: {str(e)}")
+                continue
+            if expired:
+                logger.info(f"删除了{len(expired)}个超过{self.config['spill_ttl_seconds']}秒未访问的已写出会话")
+                self._notify_expired(expired)
+
+    def _expire_spilled(self):
+        """删除超过spill_ttl_seconds未被恢复的已写出会话，返回会话ID列表"""
+        deadline = time.time() - self.config["spill_ttl_seconds"]
+        candidates = []
+        for session_id in self.spilled_ids():
+            try:
+                if os.path.getmtime(self._spill_path(session_id)) < deadline:
+                    candidates.append(session_id)
+            except FileNotFoundError:
+                continue
+        expired = []
+        with self._lock:
+            for session_id in candidates:
+                # 检查期间会话已被恢复
+                if session_id in self._sessions or session_id in self._pending_spill:
+                    continue
+                try:
+                    os.remove(self._spill_path(session_id))
+                except FileNotFoundError:
+                    continue
+                expired.append(session_id)
+            self.stats["spill_expired"] += len(expired)
+        return expired
+
+
+class SQLiteSessionStore(SessionStoreBase):
+    """基于SQLite（WAL模式）的会话存储，同一台机器上的多个工作进程共享
+
+    每个线程使用独立连接；已保存到文件的会话在空闲超时后从库中删除，
+    进行中的会话保留spill_ttl_seconds，期间学员随时可以继续对话。
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self._local = threading.local()
+        self.stats = {"expired": 0}
+        os.makedirs(os.path.dirname(config["sqlite_path"]) or '.', exist_ok=True)
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated_at ON sessions(updated_at)")
+        conn.commit()
+        threading.Thread(target=self._sweeper, name="session-sweeper", daemon=True).start()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.config["sqlite_path"], timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, session_id):
+        row = self._conn().execute("SELECT data FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return json_loads(row[0]) if row else None
+
+    def save(self, session):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (id, status, data, updated_at) VALUES (?, ?, ?, ?)",
+            (session['id'], session.get('status', 'active'), json_dumps(session), time.time())
+        )
+        conn.commit()
+
+    def update(self, session_id, mutate):
+        conn = self._conn()
+        # BEGIN IMMEDIATE立即取得写锁，读取到写回之间其他工作进程的写入会等待
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT data FROM sessions WHERE id = ?", (session_id,)).fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+            session = json_loads(row[0])
+            mutate(session)
+            conn.execute(
+                "UPDATE sessions SET status = ?, data = ?, updated_at = ? WHERE id = ?",
+                (session.get('status', 'active'), json_dumps(session), time.time(), session_id)
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return session
+
+    def spilled_ids(self):
+        """进行中的会话都保存在库中，进程重启后仍然有效"""
+        return [row[0] for row in self._conn().execute("SELECT id FROM sessions WHERE status = 'active'")]
+
+    def snapshot(self):
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM sessions GROUP BY status").fetchall()
+        return dict(self.stats, backend="sqlite", by_status=dict(rows))
+
+    def _sweeper(self):
+        while True:
+            time.sleep(self.config["sweep_interval_seconds"])
+            try:
+                conn = self._conn()
+                cursor = conn.execute(
+                    "DELETE FROM sessions WHERE status != 'active' AND updated_at < ?",
+                    (time.time() - self.config["idle_ttl_seconds"],)
+                )
+                conn.commit()
+                if cursor.rowcount:
+                    logger.info(f"从会话库中清理了{cursor.rowcount}个已归档的会话")
+                # 长时间未访问的进行中会话视为已放弃
+                expired = [row[0] for row in conn.execute(
+                    "SELECT id FROM sessions WHERE status = 'active' AND updated_at < ?",
+                    (time.time() - self.config["spill_ttl_seconds"],))]
+                if expired:
+                    conn.executemany("DELETE FROM sessions WHERE id = ? AND status = 'active'",
+                                     [(session_id,) for session_id in expired])
+                    conn.commit()
+                    self.stats["expired"] += len(expired)
+                    logger.info(f"从会话库中删除了{len(expired)}个超过{self.config['spill_ttl_seconds']}秒"
+                                f"未访问的进行中会话")
+                    self._notify_expired(expired)
+            except sqlite3.Error as e:
+                logger.error(f"清理会话库失败: {str(e)}")
+
+
+def create_session_store(config):
+    """按配置创建会话存储"""
+    if config["backend"] == "sqlite":
+        return SQLiteSessionStore(config)
+    if config["backend"] == "memory":
+        return InMemorySessionStore(config)
+    raise ValueError(f"未知的会话存储类型: {config['backend']}")
+
+
+# 存储当前会话的数据
+sessions = create_session_store(SESSION_STORE_CONFIG)
+logger.info(f"会话存储初始化完成: {SESSION_STORE_CONFIG['backend']}")
+
+PROCESS_STARTED_AT = datetime.now().isoformat()
+STARTUP_LOCK_PATH = os.path.join(DATA_DIR, ".startup.lock")
+
+
+@contextmanager
+def startup_lock():
+    """多个工作进程同时加载模块时，串行执行检查并重建索引等初始化步骤；不支持文件锁的平台直接执行"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    with open(STARTUP_LOCK_PATH, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+with startup_lock():
+    _index_is_new = not os.path.exists(SESSION_INDEX_CONFIG["path"])
+    session_index = SessionIndex(SESSION_INDEX_CONFIG["path"])
+    if _index_is_new:
+        logger.info("会话索引不存在，开始从data目录自动重建")
+        logger.info(f"会话索引重建完成，共{session_index.rebuild(DATA_DIR)}条记录")
+sessions.on_expire(session_index.delete_unpersisted)
+logger.info(f"会话索引初始化完成: {SESSION_INDEX_CONFIG['path']}")
+
+
+def drop_unpersisted_sessions():
+    """清理上次运行遗留的、没有对应文件的索引记录，由维护锁的持有者启动后执行一次"""
+    removed = session_index.drop_unpersisted(keep_ids=sessions.spilled_ids(), before=PROCESS_STARTED_AT)
+    logger.info(f"清理了{removed}条未持久化的会话索引记录")
+
+# 评分统计配置：按产品、日期、学员累计评分，统计接口不再读取会话文件
+ANALYTICS_CONFIG = {
+    "path": os.path.join(DATA_DIR, "score_aggregates.db"),
+    "dimensions": ("product", "day", "trainee"),
+    "metrics": ("total_score", "professionalism", "communication", "problem_solving", "service_attitude"),
+    # 总分直方图的分组宽度
+    "histogram_bin_width": 10,
+    "unknown_trainee": "未记录"
+}
+
+
+class ScoreAggregates:
+    """评分的增量汇总：每个(维度, 分组, 指标)保存次数、总和、平方和，总分另外保存直方图
+
+    每个会话评分完成时累加一次，并在recorded_sessions中记下该会话计入的行；同一会话重新评分时
+    先减去上次计入的行再累加新的评分，查询均值和标准差只需读取汇总行。
+    """
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS recorded_sessions (id TEXT PRIMARY KEY, contribution TEXT);
+            CREATE TABLE IF NOT EXISTS score_sums (
+                dimension TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                total REAL NOT NULL,
+                total_sq REAL NOT NULL,
+                PRIMARY KEY (dimension, bucket, metric)
+            );
+            CREATE TABLE IF NOT EXISTS score_histogram (
+                dimension TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                bin INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (dimension, bucket, bin)
+            );
+        """)
+        # 旧版本的recorded_sessions只有id列，无法在重新评分时扣除旧值，补列后需要全量重建
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(recorded_sessions)")}
+        self.needs_rebuild = 'contribution' not in columns
+        if self.needs_rebuild:
+            self._conn.execute("ALTER TABLE recorded_sessions ADD COLUMN contribution TEXT")
+        self._conn.commit()
+
+    def buckets_for(self, session):
+        """会话在各维度下所属的分组"""
+        return {
+            "product": session.get('target_product', '未知产品'),
+            "day": (session.get('timestamp') or '')[:10],
+            "trainee": session.get('trainee') or self.config["unknown_trainee"]
+        }
+
+    def _rows(self, session):
+        evaluation = session.get('evaluation') or {}
+        values = {}
+        for metric in self.config["metrics"]:
+            try:
+                values[metric] = float(evaluation[metric])
+            except (KeyError, TypeError, ValueError):
+                continue
+        buckets = self.buckets_for(session)
+        sums = [(dimension, buckets[dimension], metric, value, value * value)
+                for dimension in self.config["dimensions"] for metric, value in values.items()]
+        histogram = []
+        if "total_score" in values:
+            score_bin = int(values["total_score"] // self.config["histogram_bin_width"])
+            histogram = [(dimension, buckets[dimension], score_bin) for dimension in self.config["dimensions"]]
+        return sums, histogram
+
+    def _add(self, sums, histogram, sign):
+        """把一个会话的汇总行累加（sign=1）或扣除（sign=-1）"""
+        self._conn.executemany(
+            "INSERT INTO score_sums (dimension, bucket, metric, count, total, total_sq) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (dimension, bucket, metric) DO UPDATE SET count = count + excluded.count, "
+            "total = total + excluded.total, total_sq = total_sq + excluded.total_sq",
+            [(dimension, bucket, metric, sign, sign * value, sign * value_sq)
+             for dimension, bucket, metric, value, value_sq in sums]
+        )
+        self._conn.executemany(
+            "INSERT INTO score_histogram (dimension, bucket, bin, count) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (dimension, bucket, bin) DO UPDATE SET count = count + excluded.count",
+            [(dimension, bucket, score_bin, sign) for dimension, bucket, score_bin in histogram]
+        )
+        if sign < 0:
+            self._conn.execute("DELETE FROM score_sums WHERE count <= 0")
+            self._conn.execute("DELETE FROM score_histogram WHERE count <= 0")
+
+    def _apply(self, session):
+        """计入会话的当前评分，已计入过的会话先扣除上次计入的行；返回是否新计入"""
+        sums, histogram = self._rows(session)
+        contribution = json.dumps({"sums": sums, "histogram": histogram}, ensure_ascii=False)
+        row = self._conn.execute("SELECT contribution FROM recorded_sessions WHERE id = ?",
+                                 (session['id'],)).fetchone()
+        if row is not None:
+            if row[0] == contribution:
+                return False
+            if row[0]:
+                previous = json.loads(row[0])
+                self._add(previous["sums"], previous["histogram"], -1)
+        self._conn.execute("INSERT OR REPLACE INTO recorded_sessions (id, contribution) VALUES (?, ?)",
+                           (session['id'], contribution))
+        self._add(sums, histogram, 1)
+        return row is None
+
+    def record(self, session):
+        """计入一个已评分的会话，重新评分时替换该会话上次计入的评分；返回是否新计入"""
+        with self._lock:
+            added = self._apply(session)
+            self._conn.commit()
+        return added
+
+    def query(self, dimension, start=None, end=None):
+        """按维度返回各分组的次数、均值、标准差和总分直方图；start/end按分组名过滤（闭区间）"""
+        conditions, params = ["dimension = ?"], [dimension]
+        if start:
+            conditions.append("bucket >= ?")
+            params.append(start)
+        if end:
+            conditions.append("bucket <= ?")
+            params.append(end)
+        where = " AND ".join(conditions)
+        with self._lock:
+            sums = self._conn.execute(
+                f"SELECT bucket, metric, count, total, total_sq FROM score_sums WHERE {where} ORDER BY bucket",
+                params).fetchall()
+            bins = self._conn.execute(
+                f"SELECT bucket, bin, count FROM score_histogram WHERE {where} ORDER BY bucket, bin",
+                params).fetchall()
+        groups = {}
+        for bucket, metric, count, total, total_sq in sums:
+            mean = total / count
+            variance = max(total_sq / count - mean * mean, 0.0)
+            group = groups.setdefault(bucket, {'bucket': bucket, 'count': 0, 'metrics': {}, 'histogram': {}})
+            group['metrics'][metric] = {'count': count, 'mean': round(mean, 2), 'std': round(math.sqrt(variance), 2)}
+            if metric == "total_score":
+                group['count'] = count
+        width = self.config["histogram_bin_width"]
+        for bucket, score_bin, count in bins:
+            if bucket in groups:
+                groups[bucket]['histogram'][f"{score_bin * width}-{score_bin * width + width - 1}"] = count
+        return list(groups.values())
+
+    def rebuild(self, sessions_iter):
+        """清空后从会话全量重建，返回计入的会话数"""
+        count = 0
+        with self._lock:
+            self._conn.execute("DELETE FROM recorded_sessions")
+            self._conn.execute("DELETE FROM score_sums")
+            self._conn.execute("DELETE FROM score_histogram")
+            for session in sessions_iter:
+                if session.get('status') == 'completed' and session.get('evaluation'):
+                    count += self._apply(session)
+            self._conn.commit()
+            self.needs_rebuild = False
+        return count
+
+
+def iter_completed_sessions():
+    """按会话索引读取所有已完成的会话（会话文件或归档）"""
+    for session_id, path in session_index.find_by_status('completed'):
+        try:
+            yield read_session_location(path)
+        except Exception as e:
+            logger.error(f"读取会话[{session_id}]失败 {path}: {str(e)}")
+
+
+# token用量统计与评分统计一样保存在数据目录的共享SQLite中
+token_ledger = TokenLedger(os.path.join(DATA_DIR, "token_usage.db"), TOKEN_BUDGET_CONFIG)
+
+with startup_lock():
+    _aggregates_is_new = not os.path.exists(ANALYTICS_CONFIG["path"])
+    score_aggregates = ScoreAggregates(ANALYTICS_CONFIG["path"], ANALYTICS_CONFIG)
+    if _aggregates_is_new or score_aggregates.needs_rebuild:
+        logger.info("评分统计不存在或格式已过期，开始从已完成的会话重建")
+        logger.info(f"评分统计重建完成，共{score_aggregates.rebuild(iter_completed_sessions())}个会话")
+
+
+class SessionPayloadCache:
+    """最近查看的历史会话内容的LRU缓存，避免重复读取和解析JSON文件"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            payload = self._items.get(session_id)
+            if payload is not None:
+                self._items.move_to_end(session_id)
+            return payload
+
+    def put(self, session_id, payload):
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._items[session_id] = payload
+            self._items.move_to_end(session_id)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._items.pop(session_id, None)
+
+
+session_payload_cache = SessionPayloadCache(SESSION_INDEX_CONFIG["payload_cache_size"])
+
+# HTML模板（简单的单页面应用）
+HTML_TEMPLATE = '''
+<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>汇仁医药客服对话系统</title>
+    <style>
+        * {
+            margin: 0;
+            padding: 0;
+            box-sizing: border-box;
+        }
+        body {
+            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Arial, sans-serif;
+            background-color: #f5f5f5;
+            height: 100vh;
+            display: flex;
+            flex-direction: column;
+        }
+        .header {
+            background-color: #2c3e50;
+            color: white;
+            padding: 15px 20px;
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+        }
+        .container {
+            flex: 1;
+            display: flex;
+            max-width: 1200px;
+            margin: 0 auto;
+            width: 100%;
+            padding: 20px;
+            gap: 20px;
+        }
+        .sidebar {
+            width: 250px;
+            background: white;
+            border-radius: 8px;
+            padding: 20px;
+            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+        }
+        .main-content {
+            flex: 1;
+            display: flex;
+            flex-direction: column;
+        }
+        .chat-container {
+            flex: 1;
+            background: white;
+            border-radius: 8px;
+            padding: 20px;
+            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+            display: flex;
+            flex-direction: column;
+        }
+        .messages {
+            flex: 1;
             overflow-y: auto;
             padding: 20px;
             display: flex;
@@ -255,6 +2499,14 @@ HTML_TEMPLATE = '''
         .button.danger:hover {
             background-color: #c82333;
         }
+        .trainee-input {
+            width: 100%;
+            padding: 10px;
+            border: 1px solid #ddd;
+            border-radius: 5px;
+            font-size: 16px;
+            box-sizing: border-box;
+        }
         .session-list {
             margin-top: 20px;
         }
@@ -321,6 +2573,7 @@ HTML_TEMPLATE = '''
 
     <div class="container">
         <div class="sidebar">
+            <input type="text" class="trainee-input" id="trainee-input" placeholder="学员姓名（用于按学员统计评分）">
             <button class="button" onclick="startNewChat()">开始新对话</button>
             <div class="session-list" id="session-list">
                 <h3>历史会话</h3>
@@ -355,8 +2608,23 @@ HTML_TEMPLATE = '''
         let currentSessionId = null;
         let isActive = false;
 
+        // 学员姓名保存在浏览器中，下次打开页面自动填入
+        const traineeInput = document.getElementById('trainee-input');
+        traineeInput.value = localStorage.getItem('trainee') || '';
+
         function startNewChat() {
-            fetch('/api/start_chat', { method: 'POST' })
+            const trainee = traineeInput.value.trim();
+            if (!trainee) {
+                alert('请先填写学员姓名');
+                traineeInput.focus();
+                return;
+            }
+            localStorage.setItem('trainee', trainee);
+            fetch('/api/start_chat', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ trainee: trainee })
+            })
                 .then(response => response.json())
                 .then(data => {
                     currentSessionId = data.session_id;
@@ -379,29 +2647,134 @@ HTML_TEMPLATE = '''
 
             const messageDiv = document.createElement('div');
             messageDiv.className = 'message patient';
-            messageDiv.innerHTML = '正在输入...';
+            messageDiv.textContent = '正在输入...';
             document.getElementById('messages').appendChild(messageDiv);
 
-            const eventSource = new EventSource(`/api/send_message?session_id=${currentSessionId}&message=${encodeURIComponent(message)}`);
-            let fullResponse = '';
+            const idempotencyKey = window.crypto && crypto.randomUUID ? crypto.randomUUID() :
+                Date.now().toString(36) + Math.random().toString(36).slice(2);
+            streamReply(message, idempotencyKey, messageDiv);
+        }
+
+        // 流式回复渲染器：新内容先缓存，每帧只追加一次文本并滚动一次，已显示的内容不再重新解析
+        function createStreamRenderer(messageDiv) {
+            const container = document.getElementById('messages');
+            let textNode = null;
+            let pending = '';
+            let scheduled = false;
 
-            eventSource.onmessage = function(event) {
-                const data = JSON.parse(event.data);
-                if (data.content) {
-                    fullResponse += data.content;
-                    messageDiv.innerHTML = fullResponse;
-                    document.getElementById('messages').scrollTop = document.getElementById('messages').scrollHeight;
+            function flush() {
+                scheduled = false;
+                if (!pending) return;
+                // 学员向上翻看时不强制滚动到底部
+                const atBottom = container.scrollHeight - container.scrollTop - container.clientHeight < 40;
+                if (textNode === null) {
+                    messageDiv.textContent = '';
+                    textNode = document.createTextNode('');
+                    messageDiv.appendChild(textNode);
                 }
-                if (data.done) {
-                    eventSource.close();
+                textNode.appendData(pending);
+                pending = '';
+                if (atBottom) container.scrollTop = container.scrollHeight;
+            }
+
+            return {
+                append(text) {
+                    pending += text;
+                    if (!scheduled) {
+                        scheduled = true;
+                        requestAnimationFrame(flush);
+                    }
+                },
+                reset() {
+                    pending = '';
+                    textNode = null;
+                },
+                // 结束时立即输出剩余内容（后台标签页不触发动画帧）；没有任何内容时显示fallback，
+                // 已有部分内容时在其后追加notice
+                finish(fallback, notice) {
+                    flush();
+                    if (textNode === null && fallback) messageDiv.textContent = fallback;
+                    else if (textNode !== null && notice) messageDiv.appendChild(document.createTextNode(notice));
                 }
             };
+        }
+
+        // 以POST发送消息并读取流式回复；连接中断时用同一幂等键和Last-Event-ID重连续传，不会重复提交
+        function streamReply(message, idempotencyKey, messageDiv) {
+            const renderer = createStreamRenderer(messageDiv);
+            let lastEventId = null;
+            let attempts = 0;
+
+            function handleEvent(block) {
+                let data = null;
+                for (const line of block.split('\\n')) {
+                    if (line.startsWith('id: ')) lastEventId = line.slice(4);
+                    else if (line.startsWith('data: ')) data = JSON.parse(line.slice(6));
+                }
+                if (!data) return null;
+                if (data.reset) renderer.reset();
+                if (data.content) renderer.append(data.content);
+                if (data.error) {
+                    renderer.finish('发送失败，请重试', '（回复未完成，本轮未保存，请重新发送）');
+                    return 'error';
+                }
+                if (data.done) {
+                    renderer.finish('');
+                    return 'done';
+                }
+                return null;
+            }
 
-            eventSource.onerror = function(error) {
+            function retry(error) {
                 console.error('SSE Error:', error);
-                eventSource.close();
-                messageDiv.innerHTML = fullResponse || '发送失败，请重试';
-            };
+                if (attempts++ < 3) {
+                    setTimeout(connect, 1000 * attempts);
+                } else {
+                    renderer.finish('发送失败，请重试');
+                }
+            }
+
+            async function connect() {
+                const headers = { 'Content-Type': 'application/json' };
+                if (lastEventId) headers['Last-Event-ID'] = lastEventId;
+                let response;
+                try {
+                    response = await fetch('/api/send_message', {
+                        method: 'POST',
+                        headers: headers,
+                        body: JSON.stringify({ session_id: currentSessionId, message: message, idempotency_key: idempotencyKey })
+                    });
+                } catch (error) {
+                    return retry(error);
+                }
+                // 409表示同一消息仍在其他进程中处理，稍后重试；其余4xx不再重试
+                if (!response.ok) {
+                    if (response.status === 409 || response.status >= 500) return retry(response.status);
+                    renderer.finish('发送失败，请重试');
+                    return;
+                }
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                try {
+                    while (true) {
+                        const { value, done } = await reader.read();
+                        if (done) break;
+                        buffer += decoder.decode(value, { stream: true });
+                        let index;
+                        while ((index = buffer.indexOf('\\n\\n')) >= 0) {
+                            const block = buffer.slice(0, index);
+                            buffer = buffer.slice(index + 2);
+                            if (handleEvent(block)) return;
+                        }
+                    }
+                } catch (error) {
+                    return retry(error);
+                }
+                retry('连接中断');
+            }
+
+            connect();
         }
 
         function endChat() {
@@ -416,11 +2789,38 @@ HTML_TEMPLATE = '''
             .then(data => {
                 isActive = false;
                 document.getElementById('input-area').style.display = 'none';
-                showEvaluation(data.evaluation);
+                document.getElementById('evaluation-content').innerHTML = '<p>正在评分，请稍候...</p>';
+                document.getElementById('evaluation-modal').style.display = 'flex';
                 loadSessions();
+                waitForEvaluation(data.job_id, data.session_id);
             });
         }
 
+        // 轮询评分状态：每次请求立即返回，不会在评分期间占用服务端的请求线程
+        function waitForEvaluation(jobId, sessionId) {
+            setTimeout(() => pollEvaluation(jobId, sessionId), 500);
+        }
+
+        function pollEvaluation(jobId, sessionId) {
+            fetch(`/api/evaluation/${jobId}?session_id=${sessionId}`)
+                .then(response => response.json())
+                .then(job => {
+                    if (job.status === 'completed') {
+                        showEvaluation(job.evaluation);
+                        loadSessions();
+                    } else if (job.status === 'failed' || job.error) {
+                        document.getElementById('evaluation-content').innerHTML = '<p>评分失败，请稍后重新结束对话</p>';
+                        loadSessions();
+                    } else {
+                        setTimeout(() => pollEvaluation(jobId, sessionId), 1000);
+                    }
+                })
+                .catch(error => {
+                    console.error('查询评分状态失败:', error);
+                    setTimeout(() => pollEvaluation(jobId, sessionId), 2000);
+                });
+        }
+
         function showEvaluation(evaluation) {
             const content = `
                 <div class="score-section">
@@ -494,41 +2894,298 @@ HTML_TEMPLATE = '''
                 });
         }
 
-        function addMessage(content, role) {
-            const messageDiv = document.createElement('div');
-            messageDiv.className = `message ${role}`;
-            messageDiv.textContent = content;
-            document.getElementById('messages').appendChild(messageDiv);
-            document.getElementById('messages').scrollTop = document.getElementById('messages').scrollHeight;
-        }
+        function addMessage(content, role) {
+            const messageDiv = document.createElement('div');
+            messageDiv.className = `message ${role}`;
+            messageDiv.textContent = content;
+            document.getElementById('messages').appendChild(messageDiv);
+            document.getElementById('messages').scrollTop = document.getElementById('messages').scrollHeight;
+        }
+
+        function updateSessionInfo() {
+            document.getElementById('session-info').innerHTML = currentSessionId ? 
+                `会话ID: ${currentSessionId.substring(0, 8)}...` : '';
+        }
+
+        function handleKeyPress(event) {
+            if (event.key === 'Enter') {
+                sendMessage();
+            }
+        }
+
+        // 页面加载时加载历史会话
+        window.onload = function() {
+            loadSessions();
+        };
+    </script>
+</body>
+</html>
+'''
+logger.info("HTML模板配置完成")
+
+
+OPENER_SYSTEM_PROMPT = """你是一位帮助生成自然、口语化患者开场白的助手。
+请基于给定的症状模板，生成一个听起来像真实患者的开场白。使用口语化表达，添加适当的语气词，
+让内容听起来像是一个普通人在描述自己的不适，而不是机器人或医学专业人士。
+确保保留原始症状的核心信息，但表达方式更加自然、口语化。不要使用专业医学术语。"""
+
+# 开场白预生成池配置
+OPENER_POOL_CONFIG = {
+    "enabled": True,
+    # 每个产品保留的开场白数量
+    "depth": 8,
+    # 低于该数量时触发后台补充
+    "low_water_mark": 3,
+    # 开场白过期时间，过期后丢弃并重新生成
+    "ttl_seconds": 3600,
+    # 后台并发生成数
+    "refill_workers": 2,
+    # 后台定期检查过期、补充的间隔
+    "check_interval_seconds": 60,
+    # 连续生成失败达到该次数后暂停补充，暂停时长从error_backoff_seconds起每次翻倍，最长max_backoff_seconds
+    "max_consecutive_errors": 3,
+    "error_backoff_seconds": 30,
+    "max_backoff_seconds": 600
+}
+
+
+OPENER_COMPLETION_PARAMS = {
+    "temperature": 0.8,
+    "max_tokens": 300
+}
+
+
+def generate_opener(initial_symptom_template, product=None):
+    """调用AI基于症状模板生成更自然的开场白"""
+    open_messages = [
+        {"role": "system", "content": OPENER_SYSTEM_PROMPT},
+        {"role": "user", "content": f"请基于这个症状描述生成一个自然的患者开场白: {initial_symptom_template}"}
+    ]
+    open_messages, params, prompt_tokens, trimmed = budget_completion("opener", open_messages, OPENER_COMPLETION_PARAMS)
+    response = client.chat.completions.create(
+        model=AZURE_CONFIG["model"],
+        messages=open_messages,
+        **params
+    )
+    opener = response.choices[0].message.content.strip()
+    record_usage("opener", prompt_tokens, opener, response, product=product, trimmed=trimmed)
+    return opener
+
+
+class OpenerPool:
+    """按产品预生成开场白的池，start_chat直接取用，后台线程负责补充
+
+    池按(产品, 症状模板)区分，产品目录更新症状模板后旧的开场白不会再被取用。
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._executor = None
+        # 连续失败次数、连续暂停次数和暂停截止时间，任意一次生成成功后清零
+        self._consecutive_errors = 0
+        self._backoffs = 0
+        self._suspended_until = 0.0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "expired": 0,
+            "refills": 0,
+            "refill_errors": 0,
+            "refill_skipped": 0,
+            "refill_suspensions": 0,
+            "refill_seconds_total": 0.0,
+            "refill_seconds_max": 0.0
+        }
+
+    def start(self):
+        """启动后台补充线程（可重复调用）"""
+        if not self.config["enabled"]:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.config["refill_workers"],
+                                                thread_name_prefix="opener-refill")
+            self._thread = threading.Thread(target=self._run, name="opener-pool", daemon=True)
+            self._thread.start()
+        logger.info("开场白预生成池后台线程已启动")
+
+    def pop(self, product, symptom):
+        """取出一条未过期的开场白，池为空时返回None"""
+        if not self.config["enabled"]:
+            return None
+        self.start()
+        with self._lock:
+            pool = self._pools.setdefault((product, symptom), deque())
+            self._drop_expired(pool)
+            opener = pool.popleft()[1] if pool else None
+            self.stats["hits" if opener is not None else "misses"] += 1
+            low = len(pool) < self.config["low_water_mark"]
+        if low:
+            self._wakeup.set()
+        return opener
+
+    def refresh(self):
+        """立即触发一次后台检查和补充"""
+        self._wakeup.set()
+
+    def snapshot(self):
+        """返回池深度、命中率和补充耗时等指标"""
+        with self._lock:
+            stats = dict(self.stats)
+            depths = {product: len(pool) for (product, _), pool in self._pools.items()}
+        requests_total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / requests_total if requests_total else None
+        stats["refill_seconds_avg"] = (stats["refill_seconds_total"] / stats["refills"]
+                                       if stats["refills"] else None)
+        stats["depths"] = depths
+        stats["suspended_seconds_left"] = max(0.0, self._suspended_until - time.monotonic())
+        return stats
+
+    def _drop_expired(self, pool):
+        deadline = time.monotonic() - self.config["ttl_seconds"]
+        while pool and pool[0][0] < deadline:
+            pool.popleft()
+            self.stats["expired"] += 1
+
+    def _suspended(self):
+        return time.monotonic() < self._suspended_until
+
+    def _generate(self, product, symptom):
+        with self._lock:
+            # 本轮中途进入暂停时，剩余任务直接跳过，不再请求模型
+            if self._suspended():
+                self.stats["refill_skipped"] += 1
+                return False
+        start = time.perf_counter()
+        try:
+            opener = generate_opener(symptom, product)
+        except Exception as e:
+            logger.error(f"后台生成产品[{product}]的开场白失败: {str(e)}")
+            with self._lock:
+                self.stats["refill_errors"] += 1
+                self._consecutive_errors += 1
+                if self._consecutive_errors >= self.config["max_consecutive_errors"] and not self._suspended():
+                    backoff = min(self.config["error_backoff_seconds"] * 2 ** self._backoffs,
+                                  self.config["max_backoff_seconds"])
+                    self._suspended_until = time.monotonic() + backoff
+                    self._backoffs += 1
+                    self._consecutive_errors = 0
+                    self.stats["refill_suspensions"] += 1
+                    logger.warning(f"开场白连续生成失败，暂停补充{backoff}秒")
+            return False
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._consecutive_errors = 0
+            self._backoffs = 0
+            self._pools.setdefault((product, symptom), deque()).append((time.monotonic(), opener))
+            self.stats["refills"] += 1
+            self.stats["refill_seconds_total"] += elapsed
+            self.stats["refill_seconds_max"] = max(self.stats["refill_seconds_max"], elapsed)
+        return True
+
+    def _refill_once(self):
+        if self._suspended():
+            return
+        jobs = []
+        targets = {(item["product"], item["symptom"]) for item in catalog_manager.current.initial_symptoms}
+        with self._lock:
+            # 丢弃已从产品目录中移除或症状模板已变更的池
+            for key in [key for key in self._pools if key not in targets]:
+                del self._pools[key]
+            for item in catalog_manager.current.initial_symptoms:
+                pool = self._pools.setdefault((item["product"], item["symptom"]), deque())
+                self._drop_expired(pool)
+                if len(pool) < self.config["low_water_mark"]:
+                    jobs.extend([(item["product"], item["symptom"])] * (self.config["depth"] - len(pool)))
+        if jobs:
+            logger.info(f"开场白池开始补充，共需生成{len(jobs)}条")
+            list(self._executor.map(lambda job: self._generate(*job), jobs))
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                self._refill_once()
+            except Exception as e:
+                logger.error(f"开场白池补充出错: {str(e)}")
+            # 暂停期间的唤醒不会发起生成，暂停到期时再检查一次
+            timeout = self.config["check_interval_seconds"]
+            if self._suspended():
+                timeout = min(timeout, self._suspended_until - time.monotonic())
+            self._wakeup.wait(timeout=max(timeout, 0))
+
+
+opener_pool = OpenerPool(OPENER_POOL_CONFIG)
+catalog_manager.on_change(lambda catalog: opener_pool.refresh())
+
+
+# 前端页面配置：首次请求时渲染一次并预先压缩，之后直接返回，浏览器按ETag校验缓存
+PAGE_CONFIG = {
+    "gzip_level": 9,
+    "brotli_quality": 11,
+    # 页面随版本发布变化，每次打开都用ETag校验，未变化时返回304
+    "cache_control": "no-cache"
+}
+
+
+class CompiledPage:
+    """预先渲染并压缩好的页面，按Accept-Encoding选择编码，每种编码有各自的ETag"""
+
+    def __init__(self, html, config):
+        raw = html.encode('utf-8')
+        self.bodies = {"identity": raw, "gzip": gzip.compress(raw, config["gzip_level"], mtime=0)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(raw, quality=config["brotli_quality"])
+        digest = hashlib.sha256(raw).hexdigest()[:32]
+        self.etags = {encoding: f"{digest}-{encoding}" for encoding in self.bodies}
+        self.cache_control = config["cache_control"]
+
+    def choose_encoding(self, accept_encodings):
+        """按客户端的q值选择编码，同等优先时br优先于gzip"""
+        offered = [encoding for encoding in ("br", "gzip") if encoding in self.bodies]
+        return accept_encodings.best_match(offered) or "identity"
+
+    def sizes(self):
+        return {encoding: len(body) for encoding, body in self.bodies.items()}
 
-        function updateSessionInfo() {
-            document.getElementById('session-info').innerHTML = currentSessionId ? 
-                `会话ID: ${currentSessionId.substring(0, 8)}...` : '';
-        }
 
-        function handleKeyPress(event) {
-            if (event.key === 'Enter') {
-                sendMessage();
-            }
-        }
+_compiled_page = None
+_compiled_page_lock = threading.Lock()
 
-        // 页面加载时加载历史会话
-        window.onload = function() {
-            loadSessions();
-        };
-    </script>
-</body>
-</html>
-'''
-logger.info("HTML模板配置完成")
+
+def compiled_page():
+    """返回预先渲染的页面，首次调用时渲染并压缩"""
+    global _compiled_page
+    if _compiled_page is None:
+        with _compiled_page_lock:
+            if _compiled_page is None:
+                with app.app_context():
+                    html = render_template_string(HTML_TEMPLATE)
+                _compiled_page = CompiledPage(html, PAGE_CONFIG)
+                logger.info(f"前端页面已预先渲染和压缩，各编码大小: {_compiled_page.sizes()}")
+    return _compiled_page
 
 
 @app.route('/')
 def index():
-    """返回前端页面"""
+    """返回前端页面（预先渲染和压缩，支持ETag协商缓存）"""
     logger.info("访问首页")
-    return render_template_string(HTML_TEMPLATE)
+    # 用户打开页面时预热开场白池
+    opener_pool.start()
+    page = compiled_page()
+    encoding = page.choose_encoding(request.accept_encodings)
+    etag = page.etags[encoding]
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': page.cache_control, 'Vary': 'Accept-Encoding'}
+    if request.if_none_match.contains(etag):
+        return app.response_class(status=304, headers=headers)
+    if encoding != "identity":
+        headers['Content-Encoding'] = encoding
+    return app.response_class(page.bodies[encoding], mimetype='text/html', headers=headers)
 
 
 @app.route('/api/start_chat', methods=['POST'])
@@ -539,53 +3196,43 @@ def start_chat():
     # 生成会话ID
     session_id = str(uuid.uuid4())
     logger.info(f"生成会话ID: {session_id}")
+    # 学员标识，用于按学员统计评分；页面要求填写，接口调用方未提供时记为未记录
+    trainee = str((request.get_json(silent=True) or {}).get('trainee') or '').strip()
 
-    # 随机选择一个产品及其对应的初始症状
-    chosen_product_data = random.choice(INITIAL_SYMPTOMS)
+    # 随机选择一个产品及其对应的初始症状，会话固定使用当前目录版本
+    catalog = catalog_manager.current
+    chosen_product_data = random.choice(catalog.initial_symptoms)
     target_product = chosen_product_data["product"]
     initial_symptom_template = chosen_product_data["symptom"]
     logger.info(f"随机选择的目标产品: {target_product}")
 
-    # 让AI生成更自然的开场白
-    try:
-        # 构建开场白生成提示
-        open_messages = [
-            {"role": "system", "content": """你是一位帮助生成自然、口语化患者开场白的助手。
-请基于给定的症状模板，生成一个听起来像真实患者的开场白。使用口语化表达，添加适当的语气词，
-让内容听起来像是一个普通人在描述自己的不适，而不是机器人或医学专业人士。
-确保保留原始症状的核心信息，但表达方式更加自然、口语化。不要使用专业医学术语。"""},
-            {"role": "user", "content": f"请基于这个症状描述生成一个自然的患者开场白: {initial_symptom_template}"}
-        ]
-        logger.info(f"准备生成更自然的开场白")
-
-        # 调用AI生成开场白
-        response = client.chat.completions.create(
-            model=AZURE_CONFIG["model"],
-            messages=open_messages,
-            temperature=0.8,
-            max_tokens=300
-        )
-
-        # 获取生成的开场白
-        initial_symptom = response.choices[0].message.content.strip()
-        logger.info(f"成功生成自然的开场白: {initial_symptom}")
-    except Exception as e:
-        # 如果生成失败，使用原始模板
-        logger.error(f"生成开场白失败，使用原始模板: {str(e)}")
+    # 从预生成池中取开场白，池为空时直接使用原始模板
+    initial_symptom = opener_pool.pop(target_product, initial_symptom_template)
+    if initial_symptom is None:
+        logger.warning(f"产品[{target_product}]的开场白池为空，使用原始模板")
         initial_symptom = initial_symptom_template
 
-    logger.info(f"最终使用的开场白: {initial_symptom}")
+    content_logger.info(f"最终使用的开场白: {initial_symptom}")
 
     # 初始化会话数据
-    sessions[session_id] = {
+    session = {
         'id': session_id,
         'messages': [
             {'role': 'patient', 'content': initial_symptom}
         ],
         'timestamp': datetime.now().isoformat(),
         'status': 'active',
-        'target_product': target_product
+        'target_product': target_product,
+        # 开场白对应的症状模板，回复缓存按模板而不是生成的开场白匹配第一轮
+        'opener_template': initial_symptom_template,
+        'catalog_version': catalog.version,
+        # 目录版本被淘汰或进程重启后，评分和患者提示词仍按开始时的产品信息渲染
+        'product_snapshot': catalog.config["products"][target_product]
     }
+    if trainee:
+        session['trainee'] = trainee
+    sessions.save(session)
+    session_index.upsert(session)
     logger.info(f"会话[{session_id}]初始化成功")
 
     return jsonify({
@@ -595,145 +3242,1286 @@ def start_chat():
     })
 
 
-@app.route('/api/send_message')
-def send_message():
-    """处理用户消息并返回AI响应（流式）"""
-    session_id = request.args.get('session_id')
-    user_message = request.args.get('message')
-    logger.info(f"接收到会话[{session_id}]的新消息")
+@app.route('/api/opener_pool/stats')
+def get_opener_pool_stats():
+    """获取开场白预生成池的命中率、深度和补充耗时"""
+    return jsonify(opener_pool.snapshot())
 
-    if not session_id or not user_message:
-        logger.error("缺少必要参数: session_id或message")
-        return jsonify({'error': '缺少必要参数'}), 400
 
-    # 保存用户消息
-    sessions[session_id]['messages'].append({
-        'role': 'customer-service',
-        'content': user_message
+@app.route('/api/response_cache/stats')
+def get_response_cache_stats():
+    """获取患者回复缓存的命中率、条目数和节省的生成耗时"""
+    return jsonify(response_cache.snapshot())
+
+
+@app.route('/api/turn_streams/stats')
+def get_turn_stream_stats():
+    """返回流式回复事件缓冲的数量"""
+    return jsonify(turn_streams.snapshot())
+
+
+@app.route('/api/model_pool/stats')
+def get_model_pool_stats():
+    """获取各模型部署的在途请求数、延迟、错误和熔断状态"""
+    return jsonify(model_pool.snapshot())
+
+
+@app.route('/api/session_store/stats')
+def get_session_store_stats():
+    """获取会话存储的会话数及淘汰、写出、恢复和过期删除的次数"""
+    return jsonify(sessions.snapshot())
+
+
+@app.route('/api/token_usage')
+def get_token_usage():
+    """获取所有工作进程合计的按调用端点、产品统计的token用量及用量最高的会话，以及本进程的按端点用量"""
+    top = request.args.get('top', 20, type=int)
+    return jsonify(token_ledger.snapshot(top=max(1, min(top, 500))))
+
+
+@app.route('/api/token_usage/<session_id>')
+def get_session_token_usage(session_id):
+    """获取单个会话按调用端点累计的token用量（随会话记录持久化）"""
+    session = load_session(session_id)
+    if session is None:
+        return jsonify({'error': '会话不存在'}), 404
+    usage = session.get('token_usage', {})
+    return jsonify({
+        'session_id': session_id,
+        'target_product': session.get('target_product'),
+        'endpoints': usage,
+        'total_tokens': sum(item['prompt_tokens'] + item['completion_tokens'] for item in usage.values())
     })
-    logger.info(f"会话[{session_id}]保存了客服消息: {user_message}")
 
-    # 获取目标产品信息
-    target_product = sessions[session_id].get('target_product')
-    product_info = PRODUCT_CONFIG["products"].get(target_product, {})
-    logger.info(f"会话[{session_id}]的目标产品: {target_product}")
 
-    # 构建对话历史
-    messages = [
-        {"role": "system", "content": PATIENT_SYSTEM_PROMPT},
-    ]
+@app.route('/api/admin/catalog')
+def get_catalog_info():
+    """获取当前产品目录版本及最近一次加载信息"""
+    catalog = catalog_manager.current
+    return jsonify({
+        'version': catalog.version,
+        'products': len(catalog.config["products"]),
+        'last_reload': catalog_manager.last_reload
+    })
+
+
+@app.route('/api/admin/logging', methods=['GET', 'POST'])
+def admin_logging():
+    """查看日志队列状态，或按类别调整日志级别和采样率"""
+    if request.method == 'POST':
+        data = request.json or {}
+        category = data.get('category')
+        level = data.get('level')
+        sample_rate = data.get('sample_rate')
+        if not category:
+            return jsonify({'error': '缺少必要参数: category'}), 400
+        if level is not None and not isinstance(logging.getLevelName(str(level).upper()), int):
+            return jsonify({'error': f'无效的日志级别: {level}'}), 400
+        if sample_rate is not None and not (isinstance(sample_rate, (int, float)) and 0 <= sample_rate <= 1):
+            return jsonify({'error': 'sample_rate应在0到1之间'}), 400
+        logging_pipeline.set_category(category, str(level).upper() if level is not None else None, sample_rate)
+        logger.info(f"日志类别[{category}]已调整: 级别={level}, 采样率={sample_rate}")
+    return jsonify(logging_pipeline.snapshot())
 
-    # 如果有目标产品，添加到提示词中
-    if target_product:
-        additional_prompt = f"""
-你的目标产品是：{target_product}。
-请自然地引导客服推荐这个产品，但不要直接说出产品名称。可以描述与这个产品相关的症状，询问类似效果的药品。
-"""
-        messages[0]["content"] += additional_prompt
-        logger.info(f"为会话[{session_id}]添加了目标产品提示")
 
-    for msg in sessions[session_id]['messages']:
+@app.route('/api/admin/reload_catalog', methods=['POST'])
+def reload_catalog():
+    """重新加载产品配置文件，校验失败时继续使用当前版本"""
+    logger.info("请求重新加载产品目录")
+    try:
+        result = catalog_manager.reload()
+    except Exception as e:
+        logger.error(f"产品配置重新加载失败，继续使用版本[{catalog_manager.current.version}]: {str(e)}")
+        return jsonify({'error': f'产品配置无效: {str(e)}', 'version': catalog_manager.current.version}), 400
+    return jsonify(result)
+
+
+def sse_event(payload, event_id=None):
+    """按前端约定的格式编码一条SSE事件，event_id用于断线重连时的Last-Event-ID"""
+    if event_id is not None:
+        return f"id: {event_id}\ndata: {json_dumps(payload)}\n\n"
+    return f"data: {json_dumps(payload)}\n\n"
+
+
+SSE_DONE_EVENT = f"data: {json.dumps({'done': True})}\n\n"
+
+# 响应块合并配置：首块立即发送，之后的块累计到一定字数或时间窗口再作为一个SSE事件发送
+SSE_COALESCE_CONFIG = {
+    "enabled": True,
+    "max_chars": 24,
+    # 时间窗口在下一个响应块到达时检查，上游停顿时已缓冲的内容随下一块或结束时一起发送
+    "max_delay_ms": 30
+}
+
+
+class ChunkCoalescer:
+    """合并相邻的模型响应块，减少SSE事件数和每个事件的编码开销"""
+
+    def __init__(self, config):
+        self.enabled = config["enabled"]
+        self.max_chars = config["max_chars"]
+        self.max_delay = config["max_delay_ms"] / 1000
+        self._buffer = []
+        self._chars = 0
+        self._since = None
+        self._sent_first = False
+
+    def add(self, content):
+        """加入一个响应块，需要发送时返回合并后的文本，否则返回None"""
+        if not self.enabled or not self._sent_first:
+            self._sent_first = True
+            return content
+        self._buffer.append(content)
+        self._chars += len(content)
+        now = time.perf_counter()
+        if self._since is None:
+            self._since = now
+        if self._chars >= self.max_chars or now - self._since >= self.max_delay:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """取出缓冲区中剩余的文本，没有时返回None"""
+        if not self._buffer:
+            return None
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._chars = 0
+        self._since = None
+        return text
+
+    def replay(self, pieces):
+        """将已完整生成的回复（如缓存命中）按字数合并为要发送的文本列表"""
+        texts = [text for text in map(self.add, pieces) if text is not None]
+        tail = self.flush()
+        return texts + [tail] if tail is not None else texts
+
+
+# 对话历史窗口配置
+CONTEXT_WINDOW_CONFIG = {
+    "enabled": True,
+    # 后台摘要不覆盖的最近消息条数（客服和患者各算一条）
+    "recent_messages": 12,
+    # 最近消息之外累计未摘要的消息达到该条数时，后台更新摘要
+    "summarize_batch_messages": 6,
+    # 对话历史（摘要+原文消息）的token预算；未摘要的消息超出预算时先同步摘要较早的部分，不直接丢弃
+    "max_history_tokens": 4000,
+    # 摘要生成的输出上限
+    "summary_completion_params": {"temperature": 0.2, "max_tokens": 400},
+    "summary_workers": 2
+}
+
+SUMMARY_SYSTEM_PROMPT = """你是对话摘要助手。请把患者与药店在线客服之间的对话压缩成简洁的摘要，供扮演患者的一方继续对话时参考。
+必须保留：患者已经描述过的症状和顾虑、客服推荐过的产品及其介绍的价格、用法用量、功效和注意事项、患者已经表达的态度和购买意向。
+使用第三人称，只输出摘要正文，不超过300字。"""
+
+
+def format_transcript(messages):
+    """将消息列表格式化为"客服/患者: 内容"的对话文本"""
+    return "\n".join(
+        f"{'客服' if msg['role'] == 'customer-service' else '患者'}: {msg['content']}"
+        for msg in messages
+    )
+
+
+def _recent_within_budget(window, budget):
+    """从最新的消息往前，预算内能原文发送的消息条数，至少保留最后一条"""
+    keep, used = 0, 0
+    for msg in reversed(window):
+        used += count_tokens(msg['content'])
+        if used > budget:
+            break
+        keep += 1
+    return max(keep, min(len(window), 1))
+
+
+def build_context_messages(session, system_prompt):
+    """构建发送给模型的对话历史：系统提示词 + 早期对话摘要 + 摘要之后的原文消息
+
+    系统提示词始终位于最前且保持不变，摘要紧随其后，便于提示词前缀缓存命中。
+    """
+    messages = [{"role": "system", "content": system_prompt}]
+    history = session['messages']
+    if not CONTEXT_WINDOW_CONFIG["enabled"]:
+        window = history
+    else:
+        summary = session.get('context_summary')
+        summary_upto = session.get('summary_upto', 0) if summary else 0
+        window = history[summary_upto:]
+        budget = CONTEXT_WINDOW_CONFIG["max_history_tokens"]
+        if _recent_within_budget(window, budget - (count_tokens(summary) if summary else 0)) < len(window):
+            # 后台摘要没跟上，摘要之后的消息超出预算：同步摘要较早的部分再发送，摘要篇幅按其输出上限预留；
+            # 摘要失败时保留全部未摘要的消息，由budget_completion按上下文窗口裁剪
+            reserve = CONTEXT_WINDOW_CONFIG["summary_completion_params"]["max_tokens"]
+            fold_upto = len(history) - _recent_within_budget(window, budget - reserve)
+            folded = context_summarizer.summarize_now(session, fold_upto)
+            if folded is not None:
+                summary, summary_upto = folded, fold_upto
+                window = history[summary_upto:]
+        if summary:
+            messages.append({"role": "system", "content": f"之前的对话摘要：\n{summary}"})
+
+    for msg in window:
         role = "assistant" if msg['role'] == "patient" else "user"
         messages.append({"role": role, "content": msg['content']})
+    return messages
+
+
+class ContextSummarizer:
+    """在后台增量更新会话的早期对话摘要，每个会话同时只有一个摘要任务"""
+
+    def __init__(self, config):
+        self.config = config
+        self._executor = ThreadPoolExecutor(max_workers=config["summary_workers"], thread_name_prefix="summarizer")
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def maybe_schedule(self, session):
+        """窗口外累计的未摘要消息足够多时提交摘要任务"""
+        if not self.config["enabled"]:
+            return
+        summary_upto = session.get('summary_upto', 0)
+        fold_upto = len(session['messages']) - self.config["recent_messages"]
+        if fold_upto - summary_upto < self.config["summarize_batch_messages"]:
+            return
+        with self._lock:
+            if session['id'] in self._in_flight:
+                return
+            self._in_flight.add(session['id'])
+        self._executor.submit(contextvars.copy_context().run, self._summarize, session['id'], session.get('context_summary'), summary_upto,
+                              session['messages'][summary_upto:fold_upto], fold_upto)
+
+    def _generate(self, session_id, previous_summary, new_messages):
+        """在已有摘要上合并新增对话，返回(摘要, 模型响应, 提示词token数, 是否裁剪)"""
+        summary_messages = [
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": f"已有摘要：\n{previous_summary or '（无）'}\n\n"
+                                        f"新增对话：\n{format_transcript(new_messages)}\n\n请输出更新后的完整摘要。"}
+        ]
+        summary_messages, params, prompt_tokens, trimmed = budget_completion(
+            "summary", summary_messages, self.config["summary_completion_params"], session_id)
+        response = client.chat.completions.create(
+            model=AZURE_CONFIG["model"],
+            messages=summary_messages,
+            **params
+        )
+        return response.choices[0].message.content.strip(), response, prompt_tokens, trimmed
+
+    def _summarize(self, session_id, previous_summary, summary_upto, new_messages, fold_upto):
+        try:
+            summary, response, prompt_tokens, trimmed = self._generate(session_id, previous_summary, new_messages)
+
+            # 摘要期间其他请求可能已追加消息，写回时重新读取最新版本，只修改摘要字段和用量；
+            # 期间摘要已被其他任务更新时放弃本次结果
+            def merge(session):
+                record_usage("summary", prompt_tokens, summary, response, session=session, trimmed=trimmed)
+                if session.get('summary_upto', 0) == summary_upto:
+                    session['context_summary'] = summary
+                    session['summary_upto'] = fold_upto
+
+            session = sessions.update(session_id, merge)
+            if session is None:
+                record_usage("summary", prompt_tokens, summary, response, session_id=session_id, trimmed=trimmed)
+            if session is None or session.get('summary_upto') != fold_upto:
+                return
+            logger.info(f"会话[{session_id}]的对话摘要已更新，覆盖前{fold_upto}条消息")
+        except Exception as e:
+            logger.error(f"会话[{session_id}]的对话摘要生成失败: {str(e)}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(session_id)
+
+    def summarize_now(self, session, fold_upto):
+        """同步生成覆盖前fold_upto条消息的摘要并合并到会话的最新版本，返回摘要，失败时返回None
+
+        不修改传入的session（可能是存储中共享的对象），调用方使用返回的摘要构建本轮请求。
+        """
+        session_id = session['id']
+        previous_summary = session.get('context_summary')
+        summary_upto = session.get('summary_upto', 0) if previous_summary else 0
+        try:
+            summary, response, prompt_tokens, trimmed = self._generate(
+                session_id, previous_summary, session['messages'][summary_upto:fold_upto])
+        except Exception as e:
+            logger.error(f"会话[{session_id}]的对话摘要同步生成失败，本轮发送全部未摘要的消息: {str(e)}")
+            return None
+
+        # 存储中的摘要已覆盖到fold_upto（后台任务先完成）时保留已有的
+        def merge(latest):
+            record_usage("summary", prompt_tokens, summary, response, session=latest, trimmed=trimmed)
+            if latest.get('summary_upto', 0) < fold_upto:
+                latest['context_summary'] = summary
+                latest['summary_upto'] = fold_upto
+
+        if sessions.update(session_id, merge) is None:
+            record_usage("summary", prompt_tokens, summary, response, session_id=session_id, trimmed=trimmed)
+        logger.info(f"会话[{session_id}]未摘要的消息超出预算，已同步摘要前{fold_upto}条消息")
+        return summary
+
+
+context_summarizer = ContextSummarizer(CONTEXT_WINDOW_CONFIG)
+
+# 逐轮评分配置（默认关闭）：每条客服回复保存后在后台单独评分，结束对话时汇总逐轮结果，不再对整段对话做一次大的评分调用
+INCREMENTAL_EVALUATION_CONFIG = {
+    "enabled": os.environ.get("INCREMENTAL_EVALUATION") == "1",
+    "workers": 4,
+    # 每轮评分附带的前文消息条数
+    "context_messages": 4,
+    "completion_params": {"temperature": 0.2, "max_tokens": 150},
+    # 结束对话时等待在途逐轮评分的最长时间（秒），仍有轮次未评完时改用完整评分
+    "settle_seconds": 10,
+    # 与完整评分标准一致的分项权重
+    "weights": {"professionalism": 0.30, "communication": 0.25, "problem_solving": 0.25, "service_attitude": 0.20},
+    # 没有任何回复涉及产品信息时的专业性得分，以及从未推荐目标产品时解决问题能力的上限
+    "missed_target_cap": 50,
+    # 汇总评价中保留的优点、改进建议条数
+    "max_notes": 3,
+    # 汇总时是否再调用一次模型撰写优缺点和总体评语（输入只有逐轮结果，调用很小）
+    "synthesis_call": False,
+    "synthesis_completion_params": {"temperature": 0.3, "max_tokens": 300}
+}
+
+INCREMENTAL_SYNTHESIS_PROMPT = """你是一位专业的客服质量评估专家。以下是对一次客服对话逐条回复的评估结果和已经汇总好的分数，
+请据此归纳客服的优点、需要改进的地方和总体评语，不要改动分数。
+输出格式为JSON：
+{"strengths": ["回应及时"], "improvements": ["可以更主动询问顾客需求"], "overall_comment": "整体表现良好。"}"""
+
+
+def parse_turn_grade(text):
+    """解析逐轮评分的JSON，缺少empathy时抛出ValueError；product_accuracy允许为null"""
+    json_match = re.search(r'\{.*\}', text, re.DOTALL)
+    raw = json.loads(json_match.group(0) if json_match else text)
+
+    def score(value):
+        return None if value is None else max(0, min(100, round(float(value))))
+
+    grade = {
+        "product_accuracy": score(raw.get("product_accuracy")),
+        "empathy": score(raw.get("empathy")),
+        "mentions_target_product": bool(raw.get("mentions_target_product")),
+        "strength": str(raw.get("strength") or "").strip(),
+        "improvement": str(raw.get("improvement") or "").strip()
+    }
+    if grade["empathy"] is None:
+        raise ValueError("逐轮评分缺少empathy")
+    return grade
+
+
+class IncrementalGrader:
+    """逐轮评分：客服回复保存后在后台评分，结果写入会话的turn_evaluations并更新partial_evaluation
+
+    结束对话时补评缺失的轮次、等待在途的评分，再由逐轮结果汇总出与完整评分格式相同的评价。
+    """
 
-    logger.info(f"会话[{session_id}]构建了完整对话历史，共{len(messages)}条消息")
+    def __init__(self, config):
+        self.config = config
+        self._executor = ThreadPoolExecutor(max_workers=config["workers"], thread_name_prefix="turn-grader")
+        # 会话ID -> {消息序号: 评分任务}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def schedule(self, session, message_index):
+        """提交第message_index条（客服）消息的评分任务，该条已在评分中时跳过"""
+        if not self.config["enabled"]:
+            return
+        session_id = session['id']
+        context = session['messages'][max(0, message_index - self.config["context_messages"]):message_index + 1]
+        with self._lock:
+            pending = self._pending.setdefault(session_id, {})
+            if message_index in pending:
+                return
+            pending[message_index] = self._executor.submit(
+                contextvars.copy_context().run, self._grade, session_id, message_index, context,
+                session.get('target_product'), catalog_for_session(session))
+
+    @staticmethod
+    def _matches(session, grade):
+        """逐轮结果是否仍对应会话中该序号的消息（生成失败的一轮会被移除，后续消息占用相同序号）"""
+        index = grade['message_index']
+        return index < len(session['messages']) and \
+            session['messages'][index].get('turn_id') == grade.get('turn_id')
+
+    def _grade(self, session_id, message_index, context, target_product, catalog):
+        start = time.perf_counter()
+        outcome = 'completed'
+        try:
+            grade_messages = [
+                {"role": "system", "content": catalog.get_prompts(target_product)["turn_evaluation_system_prompt"]},
+                {"role": "user", "content": f"对话记录：\n{format_transcript(context)}\n\n"
+                                            f"客服应推荐的目标产品是：{target_product}\n请评价最后一条客服回复。"}
+            ]
+            grade_messages, params, prompt_tokens, trimmed = budget_completion(
+                "turn_evaluation", grade_messages, self.config["completion_params"], session_id)
+            response = client.chat.completions.create(
+                model=AZURE_CONFIG["model"],
+                messages=grade_messages,
+                **params
+            )
+            text = response.choices[0].message.content
+            grade = dict(parse_turn_grade(text), message_index=message_index, turn_id=context[-1].get('turn_id'))
+
+            # 评分期间其他请求可能已追加消息，写回时重新读取最新版本，只合并本轮的评分和用量
+            def merge(session):
+                record_usage("turn_evaluation", prompt_tokens, text, response, session=session, trimmed=trimmed)
+                if not self._matches(session, grade):
+                    return
+                grades = [item for item in session.get('turn_evaluations', [])
+                          if item['message_index'] != message_index]
+                grades.append(grade)
+                grades.sort(key=lambda item: item['message_index'])
+                session['turn_evaluations'] = grades
+                session['partial_evaluation'] = self.summarize(grades)
+
+            session = sessions.update(session_id, merge)
+            if session is None:
+                record_usage("turn_evaluation", prompt_tokens, text, response, session_id=session_id, trimmed=trimmed)
+            if session is None or not self._matches(session, grade):
+                return
+            logger.info(f"会话[{session_id}]第{message_index}条消息的逐轮评分完成: "
+                        f"准确度{grade['product_accuracy']}，同理心{grade['empathy']}")
+        except Exception as e:
+            outcome = 'error'
+            logger.error(f"会话[{session_id}]第{message_index}条消息的逐轮评分失败: {str(e)}")
+        finally:
+            TURN_GRADING_SECONDS.observe(time.perf_counter() - start, outcome=outcome)
+            with self._lock:
+                pending = self._pending.get(session_id, {})
+                pending.pop(message_index, None)
+                if not pending:
+                    self._pending.pop(session_id, None)
+
+    def summarize(self, grades):
+        """由逐轮结果计算分项分和总分，即会话的partial_evaluation"""
+        accuracy = [grade['product_accuracy'] for grade in grades if grade['product_accuracy'] is not None]
+        empathy = sum(grade['empathy'] for grade in grades) / len(grades)
+        mentioned = any(grade['mentions_target_product'] for grade in grades)
+        professionalism = sum(accuracy) / len(accuracy) if accuracy else self.config["missed_target_cap"]
+        scores = {
+            "professionalism": round(professionalism),
+            "communication": round((professionalism + empathy) / 2),
+            "problem_solving": round(professionalism if mentioned
+                                     else min(professionalism, self.config["missed_target_cap"])),
+            "service_attitude": round(empathy)
+        }
+        total = sum(scores[name] * weight for name, weight in self.config["weights"].items())
+        return dict(scores, total_score=round(total), turns=len(grades), mentioned_target_product=mentioned)
+
+    def finalize(self, session):
+        """结束对话时汇总评价；未开启，或等待时限内仍有客服回复没有逐轮评分时返回None"""
+        if not self.config["enabled"]:
+            return None
+        session_id = session['id']
+        start = time.perf_counter()
+        cs_indices = {index for index, message in enumerate(session['messages'])
+                      if message['role'] == 'customer-service'}
+        if not cs_indices:
+            return None
+        graded = {grade['message_index'] for grade in session.get('turn_evaluations', [])
+                  if self._matches(session, grade)}
+        for index in sorted(cs_indices - graded):
+            self.schedule(session, index)
+        with self._lock:
+            futures = list(self._pending.get(session_id, {}).values())
+        if futures:
+            wait_futures(futures, timeout=self.config["settle_seconds"])
+
+        # 逐轮评分写入的是会话存储中的最新版本
+        latest = sessions.get(session_id)
+        if latest is not None and latest is not session:
+            for key in ('turn_evaluations', 'partial_evaluation', 'token_usage'):
+                if key in latest:
+                    session[key] = latest[key]
+        grades = [grade for grade in session.get('turn_evaluations', []) if self._matches(session, grade)]
+        missing = cs_indices - {grade['message_index'] for grade in grades}
+        if missing:
+            logger.warning(f"会话[{session_id}]有{len(missing)}条客服回复没有逐轮评分，改用完整评分")
+            return None
+
+        evaluation = self.synthesize(session, grades)
+        elapsed = time.perf_counter() - start
+        GRADING_SECONDS.observe(elapsed, outcome='incremental')
+        logger.info(f"会话[{session_id}]由{len(grades)}轮逐轮评分汇总评价，总分{evaluation['total_score']}，"
+                    f"耗时{elapsed * 1000:.1f}毫秒")
+        return evaluation
+
+    def synthesize(self, session, grades):
+        """生成与完整评分格式相同的评价：分数按权重汇总，优缺点取自得分最高和最低的轮次"""
+        scores = self.summarize(grades)
+        ranked = sorted(grades, key=lambda grade: grade['empathy'] + (grade['product_accuracy'] or 0), reverse=True)
+        max_notes = self.config["max_notes"]
+        strengths = list(dict.fromkeys(grade['strength'] for grade in ranked if grade['strength']))[:max_notes]
+        improvements = list(dict.fromkeys(
+            grade['improvement'] for grade in reversed(ranked) if grade['improvement']))[:max_notes]
+        if not scores['mentioned_target_product']:
+            improvements = ["未向顾客推荐目标产品"] + improvements[:max_notes - 1]
+        evaluation = {
+            "total_score": scores['total_score'],
+            "professionalism": scores['professionalism'],
+            "communication": scores['communication'],
+            "problem_solving": scores['problem_solving'],
+            "service_attitude": scores['service_attitude'],
+            "strengths": strengths,
+            "improvements": improvements,
+            "overall_comment": f"共评估{scores['turns']}条客服回复：专业性{scores['professionalism']}分，"
+                               f"服务态度{scores['service_attitude']}分，"
+                               f"{'已' if scores['mentioned_target_product'] else '未'}向顾客推荐目标产品。",
+            "method": "incremental"
+        }
+        if self.config["synthesis_call"]:
+            evaluation.update(self._synthesis_notes(session, grades, scores))
+        evaluation["target_product"] = session.get('target_product', '未知产品')
+        return evaluation
+
+    def _synthesis_notes(self, session, grades, scores):
+        """调用模型根据逐轮结果撰写优缺点和总体评语，失败时返回空字典，沿用本地汇总的内容"""
+        session_id = session['id']
+        try:
+            notes = "\n".join(
+                f"第{grade['message_index']}条：准确度{grade['product_accuracy']}，同理心{grade['empathy']}，"
+                f"{'推荐了' if grade['mentions_target_product'] else '未推荐'}目标产品；"
+                f"优点：{grade['strength'] or '无'}；改进：{grade['improvement'] or '无'}"
+                for grade in grades)
+            synthesis_messages, params, prompt_tokens, trimmed = budget_completion("evaluation", [
+                {"role": "system", "content": INCREMENTAL_SYNTHESIS_PROMPT},
+                {"role": "user", "content": f"逐轮评估：\n{notes}\n\n汇总分数：{json.dumps(scores, ensure_ascii=False)}"}
+            ], self.config["synthesis_completion_params"], session_id)
+            response = client.chat.completions.create(
+                model=AZURE_CONFIG["model"],
+                messages=synthesis_messages,
+                **params
+            )
+            text = response.choices[0].message.content
+            record_usage("evaluation", prompt_tokens, text, response, session=session, trimmed=trimmed)
+            result = parse_evaluation_text(session_id, text)
+            return {key: result[key] for key in ("strengths", "improvements", "overall_comment") if key in result}
+        except Exception as e:
+            logger.error(f"会话[{session_id}]的评语汇总失败，使用逐轮结果: {str(e)}")
+            return {}
+
+
+incremental_grader = IncrementalGrader(INCREMENTAL_EVALUATION_CONFIG)
+
+
+def prepare_patient_turn(session_id, user_message, endpoint="send_message", turn_id=None):
+    """保存客服消息并构建本轮的模型请求，返回(消息列表, 调用参数, 提示词token数, 是否裁剪, 回复缓存键)，
+    会话不存在时返回None"""
+    # 保存用户消息，turn_id（幂等键）用于识别重复提交，started_at用于识别中断的生成
+    message = {
+        'role': 'customer-service',
+        'content': user_message
+    }
+    if turn_id:
+        message['turn_id'] = turn_id
+        message['started_at'] = time.time()
+
+    def append(session):
+        # 同一幂等键上次生成中断时留下的客服消息，重新生成前移除
+        if turn_id and drop_unanswered_turn(session, turn_id):
+            stream_logger.info(f"会话[{session_id}]第[{turn_id}]轮上次生成已中断，重新生成")
+        session['messages'].append(message)
+
+    # 在最新版本上追加，避免覆盖后台摘要、逐轮评分期间写入的内容
+    session = sessions.update(session_id, append)
+    if session is None:
+        logger.error(f"会话[{session_id}]不存在")
+        return None
+    stream_logger.info(f"会话[{session_id}]保存了客服消息，长度: {len(user_message)}")
+    incremental_grader.schedule(session, len(session['messages']) - 1)
+    content_logger.info(f"会话[{session_id}]的客服消息: {user_message}")
+
+    # 获取目标产品信息
+    target_product = session.get('target_product')
+    catalog = catalog_for_session(session)
+    stream_logger.info(f"会话[{session_id}]的目标产品: {target_product}")
+
+    # 构建对话历史，系统提示词（含目标产品提示）取自预渲染缓存
+    start = time.perf_counter()
+    messages = build_context_messages(session, catalog.get_prompts(target_product)["patient_system_prompt"])
+    prepared = budget_completion("patient", messages, PATIENT_COMPLETION_PARAMS, session_id) + \
+        (response_cache.key_for(session),)
+    elapsed = time.perf_counter() - start
+    PROMPT_BUILD_SECONDS.observe(elapsed, endpoint=endpoint)
+    stream_logger.info(f"会话[{session_id}]构建了对话历史，共{len(messages)}条消息"
+                       f"（会话累计{len(session['messages'])}条），耗时{elapsed * 1000:.1f}毫秒")
+    return prepared
+
+
+def finish_patient_turn(session_id, full_response, chunk_count, prompt_tokens=0, trimmed=False, cached=False,
+                        turn_id=None):
+    """保存流式生成完成的患者回复并记录本轮token用量，命中回复缓存时不计用量"""
+    stream_logger.info(f"会话[{session_id}]的{'缓存回放' if cached else '流式响应'}完成，共{chunk_count}个响应块")
+    content_logger.info(f"会话[{session_id}]的完整患者回复: {full_response}")
+
+    message = {
+        'role': 'patient',
+        'content': full_response
+    }
+    if turn_id:
+        message['turn_id'] = turn_id
+
+    def append(session):
+        session['messages'].append(message)
+        if not cached:
+            record_usage("patient", prompt_tokens, full_response, session=session, trimmed=trimmed)
+
+    # 在最新版本上追加，生成期间其他工作进程或后台任务可能已经写入
+    session = sessions.update(session_id, append)
+    if session is None:
+        logger.error(f"会话[{session_id}]已不存在，丢弃患者回复")
+        if not cached:
+            record_usage("patient", prompt_tokens, full_response, session_id=session_id, trimmed=trimmed)
+        return
+    stream_logger.info(f"会话[{session_id}]保存了患者回复")
+    context_summarizer.maybe_schedule(session)
+
+
+# 患者回复缓存配置（默认关闭）
+RESPONSE_CACHE_CONFIG = {
+    "enabled": False,
+    # 只缓存对话前几轮：开场问候、询问症状等说法高度重复，后续回复更依赖上下文
+    "max_turn": 2,
+    # 缓存键包含最近几轮对话（每轮为客服消息及其之前的患者消息）
+    "window_turns": 1,
+    # 字符二元组Jaccard相似度达到该阈值视为相似命中，设为1.0时只做精确匹配
+    "similarity_threshold": 0.8,
+    "max_entries": 2000,
+    "ttl_seconds": 3600,
+    # 每个缓存键保留的不同回复数；不足时按概率放行到模型以积累变体，命中时随机选取一个
+    "variants_per_key": 3,
+    "explore_probability": 0.5
+}
+
+
+def normalize_cache_text(text):
+    """缓存匹配用的文本归一化：全角转半角、转小写、去掉空白和标点"""
+    return re.sub(r'[\W_]+', '', unicodedata.normalize('NFKC', text).lower())
+
+
+def char_bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+
+class ResponseCache:
+    """按(目标产品, 目录版本, 轮次, 最近几轮的患者消息, 最近几轮的客服消息)缓存患者回复，按容量和TTL淘汰
+
+    患者消息必须完全一致，避免回放的回复与本会话患者之前说过的话矛盾；客服消息支持精确和相似匹配。
+    开场白由模型为每个会话单独生成、各不相同，缓存键中以其症状模板代替，同一症状的会话可以共享第一轮回复。
+    目录版本切换后旧版本的缓存不再命中。缓存的是原始流式响应块，命中时按相同的SSE分块回放。
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._miss_seconds = None
+        self.stats = {"lookups": 0, "exact_hits": 0, "similar_hits": 0, "misses": 0, "explored": 0,
+                      "stores": 0, "evictions": 0, "latency_saved_seconds": 0.0}
+
+    def key_for(self, session):
+        """返回本轮的缓存键，未启用或超出缓存轮次时返回None"""
+        if not self.config["enabled"]:
+            return None
+        messages = session['messages']
+        cs_indices = [i for i, msg in enumerate(messages) if msg['role'] == 'customer-service']
+        if len(cs_indices) > self.config["max_turn"]:
+            return None
+        # 窗口从第window_turns条最近的客服消息之前的患者消息开始
+        start = cs_indices[-self.config["window_turns"]] if cs_indices else len(messages)
+        if start > 0 and messages[start - 1]['role'] == 'patient':
+            start -= 1
+        patient_texts = [(session.get('opener_template') or msg['content']) if i == 0 else msg['content']
+                         for i, msg in enumerate(messages[start:], start) if msg['role'] == 'patient']
+        patient_window = "|".join(normalize_cache_text(text) for text in patient_texts)
+        cs_window = "|".join(normalize_cache_text(msg['content']) for msg in messages[start:]
+                             if msg['role'] == 'customer-service')
+        return (session.get('target_product'), session.get('catalog_version'), len(cs_indices), patient_window,
+                cs_window)
+
+    def _expired(self, entry, now):
+        return now - entry["created"] > self.config["ttl_seconds"]
+
+    def _find_similar(self, key, now):
+        threshold = self.config["similarity_threshold"]
+        if threshold >= 1.0:
+            return None, None
+        grams = char_bigrams(key[4])
+        best_key, best_score = None, threshold
+        for other_key, entry in self._entries.items():
+            if other_key[:4] != key[:4] or self._expired(entry, now):
+                continue
+            score = len(grams & entry["grams"]) / len(grams | entry["grams"])
+            if score >= best_score:
+                best_key, best_score = other_key, score
+        return best_key, best_score
+
+    def lookup(self, key):
+        """查找缓存的回复，命中时返回响应块列表，未命中返回None"""
+        if key is None:
+            return None
+        with self._lock:
+            self.stats["lookups"] += 1
+            now = time.monotonic()
+            hit_key, kind = key, "exact_hits"
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, now):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                hit_key, _ = self._find_similar(key, now)
+                entry, kind = self._entries.get(hit_key), "similar_hits"
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            # 变体不足时按概率放行到模型，避免同一问题总是得到一模一样的回复
+            if entry["generations"] < self.config["variants_per_key"] and \
+                    random.random() < self.config["explore_probability"]:
+                self.stats["explored"] += 1
+                return None
+            self._entries.move_to_end(hit_key)
+            self.stats[kind] += 1
+            self.stats["latency_saved_seconds"] += self._miss_seconds or 0.0
+            return random.choice(entry["variants"])
+
+    def store(self, key, chunks, elapsed):
+        """保存一次模型生成的回复（响应块列表）及其耗时"""
+        if key is None or not chunks:
+            return
+        with self._lock:
+            self._miss_seconds = elapsed if self._miss_seconds is None else 0.2 * elapsed + 0.8 * self._miss_seconds
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry, now):
+                entry = {"created": now, "grams": char_bigrams(key[4]), "variants": [], "generations": 0}
+                self._entries[key] = entry
+            entry["generations"] += 1
+            if len(entry["variants"]) < self.config["variants_per_key"] and chunks not in entry["variants"]:
+                entry["variants"].append(list(chunks))
+                self.stats["stores"] += 1
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.config["max_entries"]:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            hits = self.stats["exact_hits"] + self.stats["similar_hits"]
+            return dict(self.stats, enabled=self.config["enabled"], entries=len(self._entries),
+                        hit_rate=round(hits / self.stats["lookups"], 4) if self.stats["lookups"] else 0.0,
+                        latency_saved_seconds=round(self.stats["latency_saved_seconds"], 3),
+                        avg_generation_seconds=round(self._miss_seconds, 3) if self._miss_seconds else None)
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_CONFIG)
+
+
+PATIENT_COMPLETION_PARAMS = {
+    "temperature": 0.85,
+    "max_tokens": 1200
+}
+
+
+# 流式回复缓冲配置：模型生成与HTTP连接解耦，写入每轮的事件缓冲，断线重连和重复提交从缓冲读取
+TURN_STREAM_CONFIG = {
+    "generation_workers": 128,
+    # 生成结束后缓冲保留的时间，期间同一幂等键的请求直接回放
+    "buffer_ttl_seconds": 300,
+    "max_buffers": 10000,
+    # 所有连接断开后等待重连的时间，超时后关闭上游响应；设为0时发现连接断开即取消，不等待巡检
+    "abandon_grace_seconds": 0.5,
+    # 单轮生成的最长时长，以及上游两次输出之间的最长停顿
+    "max_stream_seconds": 120,
+    "idle_timeout_seconds": 30,
+    # 没有新事件时发送SSE注释行的间隔，用于及时发现已断开的连接（同步模式只有写入时才能发现断开）
+    "heartbeat_seconds": 1,
+    "watchdog_interval_seconds": 0.5,
+    # 会话中的一轮开始超过max_stream_seconds加上该宽限仍没有回复时，视为生成进程已退出，同一幂等键可重新提交
+    "stale_turn_grace_seconds": 30
+}
+
+# 取消原因及返回给前端的提示
+STREAM_CANCEL_REASONS = {
+    "abandoned": "连接已断开，生成已取消",
+    "max_duration": "生成超时，请重试",
+    "idle": "模型响应停顿超时，请重试"
+}
+SSE_HEARTBEAT = ": ping\n\n"
+
+# 幂等键同时用作SSE事件ID的前缀（"<幂等键>:<序号>"），不能包含冒号
+IDEMPOTENCY_KEY_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def _wake_waiter(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class TurnStream:
+    """一轮患者回复的事件缓冲：生成任务依次追加编码好的SSE事件，任意数量的连接从指定序号开始读取"""
+
+    def __init__(self, session_id, key, replayed=False):
+        self.session_id = session_id
+        self.key = key
+        # 由会话中已保存的回复重建的缓冲，事件序号与原始生成不对应
+        self.replayed = replayed
+        self.events = []
+        self.done = False
+        self.finished_at = None
+        self.started_at = self.last_event_at = self.detached_at = time.monotonic()
+        self.subscribers = 0
+        self.cancel_reason = None
+        # 生成失败且没有保存任何回复，同一幂等键的请求应重新生成而不是回放
+        self.failed = False
+        self._canceller = None
+        self._cond = threading.Condition()
+        self._async_waiters = []
+
+    def publish(self, payload=None, final=False):
+        """追加一个事件，payload为None时追加结束事件；final表示本轮不再有后续事件"""
+        with self._cond:
+            event_id = f"{self.key}:{len(self.events)}"
+            if payload is None:
+                self.events.append(f"id: {event_id}\n{SSE_DONE_EVENT}")
+                final = True
+            else:
+                self.events.append(sse_event(payload, event_id))
+            self.last_event_at = time.monotonic()
+            if final:
+                self.done = True
+                self.finished_at = time.monotonic()
+            self._cond.notify_all()
+            waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake_waiter, future)
+            except RuntimeError:
+                pass
+
+    def set_canceller(self, canceller):
+        """登记关闭上游响应的回调；已被取消时立即调用"""
+        with self._cond:
+            self._canceller = canceller
+            cancelled = self.cancel_reason is not None
+        if cancelled:
+            self._run_canceller(canceller)
+
+    def cancel(self, reason):
+        """取消生成中的一轮，生成任务随后保存已生成的部分并推送结束事件"""
+        with self._cond:
+            if self.done or self.cancel_reason is not None:
+                return
+            self.cancel_reason = reason
+            canceller = self._canceller
+        if canceller is not None:
+            self._run_canceller(canceller)
+
+    def _run_canceller(self, canceller):
+        try:
+            canceller()
+        except Exception as e:
+            # 关闭失败时生成任务仍会在下一块到达时检查取消标记
+            logger.warning(f"关闭会话[{self.session_id}]的上游响应失败: {str(e)}")
+
+    def _attach(self):
+        with self._cond:
+            self.subscribers += 1
+
+    def _detach(self):
+        with self._cond:
+            self.subscribers -= 1
+            abandoned = self.subscribers == 0 and not self.done
+            if self.subscribers == 0:
+                self.detached_at = time.monotonic()
+        if abandoned and TURN_STREAM_CONFIG["abandon_grace_seconds"] <= 0:
+            self.cancel("abandoned")
+
+    def start_index(self, last_event_id):
+        """根据Last-Event-ID计算续传的起始序号"""
+        if not last_event_id or self.replayed:
+            return 0
+        key, _, seq = last_event_id.rpartition(":")
+        if key != self.key or not seq.isdigit():
+            return 0
+        return int(seq) + 1
+
+    def iter_events(self, start=0, heartbeat=None):
+        """从第start个事件开始产出，直到本轮结束；连接关闭（生成器被关闭）时登记为断开"""
+        self._attach()
+        try:
+            while True:
+                with self._cond:
+                    if len(self.events) <= start and not self.done:
+                        self._cond.wait(heartbeat)
+                    batch = self.events[start:]
+                    done = self.done
+                if not batch and not done:
+                    # 写入心跳时若连接已断开，服务器会关闭本生成器
+                    yield SSE_HEARTBEAT
+                    continue
+                yield from batch
+                start += len(batch)
+                if done:
+                    return
+        finally:
+            self._detach()
+
+    async def aiter_events(self, start=0, heartbeat=None):
+        """iter_events的异步版本，等待期间不占用线程"""
+        loop = asyncio.get_running_loop()
+        self._attach()
+        try:
+            while True:
+                waiter = None
+                with self._cond:
+                    batch = self.events[start:]
+                    done = self.done
+                    if not batch and not done:
+                        waiter = loop.create_future()
+                        self._async_waiters.append((loop, waiter))
+                if waiter is not None:
+                    try:
+                        await asyncio.wait_for(waiter, heartbeat)
+                    except asyncio.TimeoutError:
+                        yield SSE_HEARTBEAT
+                    continue
+                for event in batch:
+                    yield event
+                start += len(batch)
+                if done:
+                    return
+        finally:
+            self._detach()
+
+
+class TurnStreamRegistry:
+    """按(会话ID, 幂等键)管理进程内的事件缓冲，并在生成线程池中运行同步模式的生成任务
+
+    后台巡检线程取消无人接收（所有连接断开且超过等待重连时间）、超过最长时长或上游停顿过久的生成。
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=config["generation_workers"],
+                                            thread_name_prefix="generation")
+        # 异步模式的生成任务，保留引用避免被回收
+        self._tasks = set()
+        threading.Thread(target=self._watchdog, daemon=True, name="turn-watchdog").start()
+
+    def get(self, session_id, key):
+        with self._lock:
+            return self._streams.get((session_id, key))
+
+    def open(self, session_id, key):
+        """返回(缓冲, 是否新建)，同一键并发到达时只有一个请求新建；已失败的缓冲被新的一轮替换"""
+        with self._lock:
+            stream = self._streams.get((session_id, key))
+            if stream is not None and not stream.failed:
+                return stream, False
+            self._prune()
+            replaced = stream is not None
+            # 替换已失败的缓冲时事件序号重新开始，忽略旧的Last-Event-ID，并让前端清除已显示的部分回复
+            stream = self._streams[(session_id, key)] = TurnStream(session_id, key, replayed=replaced)
+            if replaced:
+                stream.publish({'reset': True})
+            return stream, True
+
+    def discard(self, stream):
+        with self._lock:
+            if self._streams.get((stream.session_id, stream.key)) is stream:
+                del self._streams[(stream.session_id, stream.key)]
+
+    def start(self, fn, *args):
+        """在生成线程池中运行同步生成任务"""
+        self._executor.submit(contextvars.copy_context().run, fn, *args)
+
+    def start_async(self, stream, coro):
+        """在当前事件循环中运行异步生成任务，取消时直接取消该任务"""
+        loop = asyncio.get_running_loop()
+        task = loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        stream.set_canceller(lambda: loop.call_soon_threadsafe(task.cancel))
+
+    def cancel_reason_for(self, stream, now):
+        """返回生成中的缓冲应被取消的原因，不需要取消时返回None"""
+        if now - stream.started_at > self.config["max_stream_seconds"]:
+            return "max_duration"
+        if now - stream.last_event_at > self.config["idle_timeout_seconds"]:
+            return "idle"
+        if stream.subscribers == 0 and now - stream.detached_at >= self.config["abandon_grace_seconds"]:
+            return "abandoned"
+        return None
+
+    def _watchdog(self):
+        while True:
+            time.sleep(self.config["watchdog_interval_seconds"])
+            with self._lock:
+                generating = [stream for stream in self._streams.values()
+                              if not stream.done and stream.cancel_reason is None]
+            now = time.monotonic()
+            for stream in generating:
+                reason = self.cancel_reason_for(stream, now)
+                if reason is not None:
+                    stream_logger.info(f"取消会话[{stream.session_id}]第[{stream.key}]轮的生成: {reason}")
+                    stream.cancel(reason)
+
+    def _prune(self):
+        now = time.monotonic()
+        expired = [key for key, stream in self._streams.items()
+                   if stream.done and now - stream.finished_at > self.config["buffer_ttl_seconds"]]
+        for key in expired:
+            del self._streams[key]
+        # 超出上限时淘汰最早结束的缓冲，生成中的缓冲保留
+        overflow = len(self._streams) - self.config["max_buffers"] + 1
+        if overflow > 0:
+            finished = sorted((stream.finished_at, key) for key, stream in self._streams.items() if stream.done)
+            for _, key in finished[:overflow]:
+                del self._streams[key]
+
+    def snapshot(self):
+        with self._lock:
+            active = sum(1 for stream in self._streams.values() if not stream.done)
+            return {"buffers": len(self._streams), "generating": active, "config": self.config}
+
+
+turn_streams = TurnStreamRegistry(TURN_STREAM_CONFIG)
+
+
+# find_turn_reply在一轮仍在生成时的返回值，与内容为空字符串的患者回复区分
+TURN_IN_PROGRESS = object()
+
+
+def find_turn_reply(session, key):
+    """在会话中查找幂等键对应的一轮：未提交过或生成已中断返回None，仍在生成返回TURN_IN_PROGRESS，
+    否则返回患者回复（可能为空字符串）
+
+    是否已回复按有没有该幂等键的患者消息判断，而不是回复内容是否为空。生成中的一轮不会超过
+    max_stream_seconds，开始时间早于该时限（加上宽限）仍没有回复时，视为所在进程已退出，按未提交处理。
+    """
+    reply = None
+    for message in reversed(session['messages']):
+        if message.get('turn_id') != key:
+            continue
+        if message['role'] == 'patient':
+            reply = message
+        elif reply is not None:
+            return reply['content']
+        else:
+            deadline = TURN_STREAM_CONFIG["max_stream_seconds"] + TURN_STREAM_CONFIG["stale_turn_grace_seconds"]
+            return TURN_IN_PROGRESS if time.time() - message.get('started_at', 0) < deadline else None
+    return None
+
+
+def drop_unanswered_turn(session, turn_id):
+    """移除幂等键对应、还没有患者回复的客服消息，返回是否有消息被移除"""
+    if any(msg.get('turn_id') == turn_id and msg['role'] == 'patient' for msg in session['messages']):
+        return False
+    remaining = [msg for msg in session['messages'] if msg.get('turn_id') != turn_id]
+    dropped = len(remaining) != len(session['messages'])
+    session['messages'] = remaining
+    return dropped
+
+
+def fail_patient_turn(stream, error):
+    """生成失败且没有任何回复时移除本轮的客服消息并标记缓冲失败，同一幂等键重试时重新生成"""
+    dropped = []
+    sessions.update(stream.session_id, lambda session: dropped.append(drop_unanswered_turn(session, stream.key)))
+    if any(dropped):
+        stream_logger.info(f"会话[{stream.session_id}]第[{stream.key}]轮生成失败，已移除本轮的客服消息")
+    stream.failed = True
+    stream.publish({'error': error}, final=True)
+
+
+def open_turn(session_id, user_message, key, endpoint):
+    """按幂等键打开本轮回复，返回(缓冲, 模型请求, 错误)：
+
+    同一键的重复提交或断线重连返回已有的缓冲，模型请求为None，不再追加消息、调用模型；
+    新的一轮保存客服消息并返回模型请求，由调用方启动生成任务。
+    """
+    stream = turn_streams.get(session_id, key)
+    if stream is not None and not stream.failed:
+        TURN_REQUESTS.inc(outcome='resumed')
+        stream_logger.info(f"会话[{session_id}]的第[{key}]轮从事件缓冲续传")
+        return stream, None, None
+
+    session = sessions.get(session_id)
+    if session is None:
+        logger.error(f"会话[{session_id}]不存在")
+        return None, None, ('会话不存在', 404)
+    # 缓冲不在本进程（已过期或由其他工作进程生成）时，以会话中保存的记录为准
+    reply = find_turn_reply(session, key)
+    if reply is TURN_IN_PROGRESS:
+        logger.warning(f"会话[{session_id}]的第[{key}]轮仍在生成，拒绝重复提交")
+        return None, None, ('该消息正在处理中，请稍后重试', 409)
+    if reply is not None:
+        TURN_REQUESTS.inc(outcome='replayed')
+        stream_logger.info(f"会话[{session_id}]的第[{key}]轮已完成，按会话记录回放")
+        stream = TurnStream(session_id, key, replayed=True)
+        # reset表示替换前端已显示的部分内容
+        stream.publish({'content': reply, 'reset': True})
+        stream.publish()
+        return stream, None, None
+    if not user_message:
+        logger.error("缺少必要参数: message")
+        return None, None, ('缺少必要参数', 400)
+
+    stream, created = turn_streams.open(session_id, key)
+    if not created:
+        TURN_REQUESTS.inc(outcome='resumed')
+        return stream, None, None
+    prepared = prepare_patient_turn(session_id, user_message, endpoint=endpoint, turn_id=key)
+    if prepared is None:
+        turn_streams.discard(stream)
+        return None, None, ('会话不存在', 404)
+    TURN_REQUESTS.inc(outcome='new')
+    return stream, prepared, None
+
+
+def abort_patient_turn(stream, pieces, prompt_tokens, trimmed, max_tokens, timer):
+    """生成被取消时统计已生成和节省的token数，并推送取消提示
+
+    不完整的部分回复不保存到会话：否则会被当作完整的患者回复参与评分、进入后续对话的上下文，
+    并在同一幂等键重试时被回放。本轮的客服消息随之移除，重试时重新生成。
+    """
+    reason = stream.cancel_reason
+    partial = "".join(pieces)
+    received = count_tokens(partial) if partial else 0
+    CANCELLED_STREAMS.inc(endpoint=timer.endpoint, reason=reason)
+    CANCELLED_TOKENS.inc(received, reason=reason)
+    ABORTED_TOKENS.inc(max(max_tokens - received, 0), reason=reason)
+    elapsed = timer.finish(reason)
+    logger.warning(f"会话[{stream.session_id}]的流式响应已取消（{reason}），"
+                   f"已生成{received}个token，耗时{elapsed:.2f}秒")
+    record_usage("patient", prompt_tokens, partial, session_id=stream.session_id, trimmed=trimmed)
+    fail_patient_turn(stream, STREAM_CANCEL_REASONS[reason])
+
+
+def replay_cached_turn(stream, cached, timer):
+    """命中回复缓存时按相同的SSE分块回放到事件缓冲"""
+    stream_logger.info(f"会话[{stream.session_id}]命中患者回复缓存")
+    for text in ChunkCoalescer(SSE_COALESCE_CONFIG).replay(cached):
+        timer.chunk()
+        stream.publish({'content': text})
+    finish_patient_turn(stream.session_id, "".join(cached), len(cached), cached=True, turn_id=stream.key)
+    timer.finish('cached')
+    stream.publish()
+
+
+def generate_patient_turn(stream, prepared, timer):
+    """在生成线程中调用模型，把患者回复写入本轮的事件缓冲"""
+    session_id = stream.session_id
+    messages, params, prompt_tokens, trimmed, cache_key = prepared
+    try:
+        # 命中回复缓存时按相同的SSE分块回放
+        cached = response_cache.lookup(cache_key)
+        if cached is not None:
+            replay_cached_turn(stream, cached, timer)
+            return
+
+        # 获取AI响应
+        stream_logger.info(f"开始调用Azure OpenAI生成会话[{session_id}]的患者回复")
+        start = time.perf_counter()
+        response = client.chat.completions.create(
+            model=AZURE_CONFIG["model"],
+            messages=messages,
+            stream=True,
+            **params
+        )
+        timer.connected()
+        # 取消时从巡检线程关闭上游连接，正在阻塞的读取随之结束
+        stream.set_canceller(getattr(response, 'close', lambda: None))
+        stream_logger.info(f"成功创建会话[{session_id}]的流式响应请求")
 
-    def generate():
-        """生成流式响应"""
-        try:
-            # 获取AI响应
-            logger.info(f"开始调用Azure OpenAI生成会话[{session_id}]的患者回复")
-            response = client.chat.completions.create(
-                model=AZURE_CONFIG["model"],
-                messages=messages,
-                temperature=0.85,
-                max_tokens=1200,
-                stream=True
-            )
-            logger.info(f"成功创建会话[{session_id}]的流式响应请求")
-
-            full_response = ""
-            chunk_count = 0
-            for chunk in response:
-                chunk_count += 1
-                if chunk.choices and chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    full_response += content
-                    yield f"data: {json.dumps({'content': content})}\n\n"
-
-            logger.info(f"会话[{session_id}]的流式响应完成，共收到{chunk_count}个响应块")
-            logger.debug(f"会话[{session_id}]的完整患者回复: {full_response}")
-
-            # 保存AI响应
-            sessions[session_id]['messages'].append({
-                'role': 'patient',
-                'content': full_response
-            })
-            logger.info(f"会话[{session_id}]保存了患者回复")
+        chunk_count = 0
+        pieces = []
+        coalescer = ChunkCoalescer(SSE_COALESCE_CONFIG)
+        for chunk in response:
+            if stream.cancel_reason is not None:
+                break
+            chunk_count += 1
+            if chunk.choices and chunk.choices[0].delta.content:
+                pieces.append(chunk.choices[0].delta.content)
+                text = coalescer.add(pieces[-1])
+                if text is not None:
+                    timer.chunk()
+                    stream.publish({'content': text})
+        if stream.cancel_reason is not None:
+            abort_patient_turn(stream, pieces, prompt_tokens, trimmed, params.get('max_tokens', 0), timer)
+            return
+        text = coalescer.flush()
+        if text is not None:
+            timer.chunk()
+            stream.publish({'content': text})
 
-            yield f"data: {json.dumps({'done': True})}\n\n"
+        response_cache.store(cache_key, pieces, time.perf_counter() - start)
+        finish_patient_turn(session_id, "".join(pieces), chunk_count, prompt_tokens, trimmed, turn_id=stream.key)
+        elapsed = timer.finish('completed')
+        stream_logger.info(f"会话[{session_id}]的首token耗时{(timer.first_token or 0) * 1000:.0f}毫秒，"
+                           f"流式总耗时{elapsed:.2f}秒")
+        stream.publish()
 
-        except Exception as e:
-            logger.error(f"会话[{session_id}]生成响应出错: {str(e)}")
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+    except Exception as e:
+        timer.finish('error')
+        logger.error(f"会话[{session_id}]生成响应出错: {str(e)}")
+        fail_patient_turn(stream, str(e))
 
-    return app.response_class(generate(), mimetype='text/event-stream')
 
+def read_turn_request():
+    """读取发送消息请求的参数，返回(会话ID, 消息, 幂等键, Last-Event-ID)
 
-@app.route('/api/end_chat', methods=['POST'])
-def end_chat():
-    """结束聊天并获取评分"""
-    data = request.json
-    session_id = data.get('session_id')
-    logger.info(f"请求结束会话[{session_id}]并评分")
+    POST请求体为JSON，幂等键由客户端生成（idempotency_key字段或Idempotency-Key请求头）；
+    GET请求兼容旧的查询参数，未带幂等键时从Last-Event-ID中取出（EventSource自动重连），都没有时视为新的一轮。
+    """
+    last_event_id = request.headers.get('Last-Event-ID')
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        key = data.get('idempotency_key') or request.headers.get('Idempotency-Key')
+        return data.get('session_id'), data.get('message'), key, last_event_id
+    key = request.args.get('key')
+    if not key and last_event_id and ":" in last_event_id:
+        key = last_event_id.rpartition(":")[0]
+    return request.args.get('session_id'), request.args.get('message'), key or uuid.uuid4().hex, last_event_id
 
-    if not session_id:
-        logger.error("缺少会话ID")
-        return jsonify({'error': '缺少会话ID'}), 400
 
-    # 获取对话记录
-    messages = sessions[session_id]['messages']
-    target_product = sessions[session_id].get('target_product', '未知产品')
-    logger.info(f"会话[{session_id}]的目标产品是: {target_product}")
-    logger.info(f"会话[{session_id}]共有{len(messages)}条消息记录")
+@app.route('/api/send_message', methods=['GET', 'POST'])
+def send_message():
+    """处理用户消息并返回AI响应（流式），同一幂等键的重复请求从事件缓冲续传"""
+    session_id, user_message, key, last_event_id = read_turn_request()
+    stream_logger.info(f"接收到会话[{session_id}]的新消息")
 
-    # 获取目标产品的详细信息
-    product_info = ""
-    if target_product in PRODUCT_CONFIG["products"]:
-        product_data = PRODUCT_CONFIG["products"][target_product]
+    if not session_id or not key:
+        logger.error("缺少必要参数: session_id或idempotency_key")
+        return jsonify({'error': '缺少必要参数'}), 400
+    if not IDEMPOTENCY_KEY_PATTERN.match(key):
+        logger.error(f"幂等键格式错误: {key}")
+        return jsonify({'error': '幂等键只能包含字母、数字、下划线和连字符，最长64个字符'}), 400
 
-        # 格式化产品详细信息
-        product_info = f"产品名称: {target_product}\n"
+    stream, prepared, error = open_turn(session_id, user_message, key, 'send_message')
+    if error is not None:
+        return jsonify({'error': error[0]}), error[1]
+    if prepared is not None:
+        turn_streams.start(generate_patient_turn, stream, prepared, StreamTimer('send_message', g.request_start))
 
-        # 添加产品说明
-        if "产品说明" in product_data:
-            product_info += "产品说明:\n"
-            for key, value in product_data["产品说明"].items():
-                if isinstance(value, list):
-                    product_info += f"- {key}: \n"
-                    for item in value:
-                        product_info += f"  * {item}\n"
-                else:
-                    product_info += f"- {key}: {value}\n"
+    events = stream.iter_events(stream.start_index(last_event_id), TURN_STREAM_CONFIG["heartbeat_seconds"])
+    return app.response_class(events, mimetype='text/event-stream')
 
-        # 添加价目表
-        if "价目表" in product_data:
-            product_info += "价目表:\n"
-            for item in product_data["价目表"]:
-                product_info += f"- 规格: {item.get('商品规格', '未知')}，价格: {item.get('零售价', '未知')}元\n"
 
-    logger.info(f"获取到产品[{target_product}]的详细信息")
-    logger.debug(f"产品详细信息: {product_info}")
+def build_evaluation_messages(session, catalog=None):
+    """根据会话记录构建评分请求，默认使用会话开始时的产品目录版本"""
+    session_id = session['id']
+    messages = session['messages']
+    target_product = session.get('target_product', '未知产品')
+    logger.info(f"会话[{session_id}]的目标产品是: {target_product}")
+    logger.info(f"会话[{session_id}]共有{len(messages)}条消息记录")
 
-    # 生成包含产品信息的评分系统提示词
-    evaluation_prompt = EVALUATION_SYSTEM_PROMPT_TEMPLATE.format(product_info=product_info)
-    logger.info(f"生成了包含产品信息的评分系统提示词")
+    # 包含产品详细信息的评分系统提示词取自预渲染缓存
+    catalog = catalog or catalog_for_session(session)
+    evaluation_prompt = catalog.get_prompts(target_product)["evaluation_system_prompt"]
+    logger.info(f"获取到产品[{target_product}]的评分系统提示词")
 
     # 构建评价请求
-    conversation_text = "\n".join([
-        f"{'客服' if msg['role'] == 'customer-service' else '患者'}: {msg['content']}"
-        for msg in messages
-    ])
+    conversation_text = format_transcript(messages)
     logger.info(f"生成会话[{session_id}]的对话文本, 长度: {len(conversation_text)}")
 
     eval_messages = [
@@ -742,36 +4530,59 @@ def end_chat():
          "content": f"请评价以下客服对话记录：\n\n{conversation_text}\n\n客服应推荐的目标产品是：{target_product}"}
     ]
     logger.info(f"构建会话[{session_id}]的评价请求")
+    return eval_messages
+
+
+EVALUATION_COMPLETION_PARAMS = {
+    "temperature": 0.3,
+    "max_tokens": 1000
+}
+
+
+def parse_evaluation_text(session_id, eval_text):
+    """从模型返回的文本中解析评价JSON，解析失败时抛出异常"""
+    content_logger.info(f"会话[{session_id}]的原始评价文本: {eval_text}")
+
+    # 尝试提取JSON
+    json_match = re.search(r'```json\s*(.*?)\s*```', eval_text, re.DOTALL)
+    if json_match:
+        logger.info(f"从代码块中提取会话[{session_id}]的评价JSON")
+        evaluation = json.loads(json_match.group(1))
+    else:
+        # 如果没有找到JSON格式，尝试直接解析
+        logger.info(f"直接解析会话[{session_id}]的评价JSON")
+        evaluation = json.loads(eval_text)
+    logger.info(f"会话[{session_id}]的评价解析成功，总分: {evaluation.get('total_score')}")
+    content_logger.info(f"会话[{session_id}]的评价结果: {evaluation}")
+    return evaluation
+
 
+def evaluate_session(session):
+    """调用模型为会话评分，解析失败或出错时返回默认评价"""
+    session_id = session['id']
+    eval_messages, params, prompt_tokens, trimmed = budget_completion(
+        "evaluation", build_evaluation_messages(session), EVALUATION_COMPLETION_PARAMS, session_id)
+
+    start = time.perf_counter()
+    outcome = 'completed'
     try:
         # 获取评价
         logger.info(f"开始调用Azure OpenAI评价会话[{session_id}]")
         response = client.chat.completions.create(
             model=AZURE_CONFIG["model"],
             messages=eval_messages,
-            temperature=0.3,
-            max_tokens=1000
+            **params
         )
         logger.info(f"成功获取会话[{session_id}]的评价响应")
+        record_usage("evaluation", prompt_tokens, response.choices[0].message.content, response,
+                     session=session, trimmed=trimmed)
 
         # 解析评价结果
-        eval_text = response.choices[0].message.content
-        logger.debug(f"会话[{session_id}]的原始评价文本: {eval_text}")
-
         try:
-            # 尝试提取JSON
-            import re
-            json_match = re.search(r'```json\s*(.*?)\s*```', eval_text, re.DOTALL)
-            if json_match:
-                logger.info(f"从代码块中提取会话[{session_id}]的评价JSON")
-                evaluation = json.loads(json_match.group(1))
-            else:
-                # 如果没有找到JSON格式，尝试直接解析
-                logger.info(f"直接解析会话[{session_id}]的评价JSON")
-                evaluation = json.loads(eval_text)
-            logger.info(f"会话[{session_id}]的评价解析成功: {evaluation}")
+            evaluation = parse_evaluation_text(session_id, response.choices[0].message.content)
         except Exception as e:
             logger.error(f"会话[{session_id}]的评价结果解析失败: {str(e)}")
+            outcome = 'parse_error'
             # 如果解析失败，返回默认评价
             evaluation = {
                 "total_score": 75,
@@ -783,9 +4594,10 @@ def end_chat():
                 "improvements": ["可以更深入了解客户需求", "产品知识可以更全面"],
                 "overall_comment": "客服表现中规中矩，有进步空间。"
             }
-            logger.info(f"使用默认评价结果: {evaluation}")
+            logger.info("使用默认评价结果")
     except Exception as e:
         logger.error(f"会话[{session_id}]评价出错: {str(e)}")
+        outcome = 'error'
         evaluation = {
             "total_score": 75,
             "professionalism": 75,
@@ -796,83 +4608,443 @@ def end_chat():
             "improvements": ["系统出错，无法准确评价"],
             "overall_comment": "评价系统出现错误，请稍后重试。"
         }
-        logger.info(f"由于错误使用备用评价结果: {evaluation}")
+        logger.info("由于错误使用备用评价结果")
+
+    elapsed = time.perf_counter() - start
+    GRADING_SECONDS.observe(elapsed, outcome=outcome)
+    logger.info(f"会话[{session_id}]评分耗时{elapsed:.2f}秒")
 
     # 添加目标产品信息到评价中
-    evaluation["target_product"] = target_product
+    evaluation["target_product"] = session.get('target_product', '未知产品')
     logger.info(f"向会话[{session_id}]的评价结果添加目标产品信息")
+    return evaluation
 
-    # 更新会话状态并保存
-    sessions[session_id]['status'] = 'completed'
-    sessions[session_id]['evaluation'] = evaluation
-    sessions[session_id]['score'] = evaluation['total_score']
-    logger.info(f"更新会话[{session_id}]状态为已完成，评分: {evaluation['total_score']}")
 
-    # 保存到文件
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"session_{session_id}_{timestamp}.json"
-    logger.info(f"准备将会话[{session_id}]保存到文件: {filename}")
+def save_session_file(session):
+    """将会话保存到文件并更新索引，已保存过的会话覆盖原文件；开启归档时已完成的会话写入归档"""
+    session_id = session['id']
+    file_path = session_index.get_path(session_id)
+    if ARCHIVE_CONFIG["enabled"] and session.get('status') == 'completed':
+        start = time.perf_counter()
+        location = session_archive.append(session)
+        elapsed = time.perf_counter() - start
+        PERSIST_SECONDS.observe(elapsed, target='archive')
+        logger.info(f"会话[{session_id}]已写入归档: {location}，耗时{elapsed * 1000:.1f}毫秒")
+        session_index.upsert(session, path=location)
+        session_payload_cache.invalidate(session_id)
+        # 评分期间写出的会话文件已被归档取代
+        if file_path and not SessionArchive.is_location(file_path) and os.path.exists(file_path):
+            os.remove(file_path)
+        return location
+
+    if not file_path or SessionArchive.is_location(file_path):
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        file_path = os.path.join(DATA_DIR, f"session_{session_id}_{timestamp}.json")
+    logger.info(f"准备将会话[{session_id}]保存到文件: {file_path}")
 
     # 确保data目录存在
-    os.makedirs('data', exist_ok=True)
-    logger.info("确认data目录存在")
+    os.makedirs(DATA_DIR, exist_ok=True)
+
+    start = time.perf_counter()
+    dump_json_file(session, file_path, JSON_CONFIG["session_file_indent"])
+    elapsed = time.perf_counter() - start
+    PERSIST_SECONDS.observe(elapsed, target='session_file')
+    logger.info(f"会话[{session_id}]已保存到文件: {file_path}，耗时{elapsed * 1000:.1f}毫秒")
+
+    # 增量更新会话索引
+    session_index.upsert(session, path=file_path)
+    session_payload_cache.invalidate(session_id)
+    logger.info(f"会话[{session_id}]的索引记录已更新")
+    return file_path
+
+
+# 评分任务配置
+EVALUATION_CONFIG = {
+    # 同时进行的评分调用数上限
+    "workers": 4,
+    # 内存中保留的评分任务数上限，超出后丢弃最早完成的任务
+    "max_jobs": 1000,
+    # SSE推送接口每个连接等待结果的最长时间，超时后推送当前状态并结束，由客户端重新订阅或轮询
+    "events_wait_seconds": 25,
+    # 评分中的会话超过该时间仍未完成时，即使提交任务的进程仍在运行也重新提交
+    "stale_seconds": 900,
+    # 评分失败的会话由维护任务自动重新提交的次数上限（end_chat手动提交不受限制）
+    "max_attempts": 3
+}
 
-    with open(f'data/{filename}', 'w', encoding='utf-8') as f:
-        json.dump(sessions[session_id], f, ensure_ascii=False, indent=2)
-    logger.info(f"会话[{session_id}]已保存到文件: data/{filename}")
+
+class EvaluationQueue:
+    """评分任务队列：end_chat提交任务后立即返回，由线程池限并发地完成评分"""
+
+    def __init__(self, config):
+        self.config = config
+        self._executor = ThreadPoolExecutor(max_workers=config["workers"], thread_name_prefix="evaluation")
+        self._jobs = OrderedDict()
+        self._done_events = {}
+        self._lock = threading.Lock()
+
+    def submit(self, session):
+        """保存会话并提交评分任务，返回任务ID"""
+        job_id = str(uuid.uuid4())
+        session['status'] = 'evaluating'
+        session['evaluation_job_id'] = job_id
+        session['evaluation_attempts'] = session.get('evaluation_attempts', 0) + 1
+        session.pop('evaluation_error', None)
+        # 记录执行任务的进程，进程退出后由维护任务重新提交
+        session['evaluation_owner'] = {"host": socket.gethostname(), "pid": os.getpid(), "submitted_at": time.time()}
+        save_session_file(session)
+        sessions.save(session)
+        with self._lock:
+            self._jobs[job_id] = {
+                'job_id': job_id,
+                'session_id': session['id'],
+                'status': 'pending',
+                'created_at': datetime.now().isoformat()
+            }
+            self._done_events[job_id] = threading.Event()
+            self._prune()
+        self._executor.submit(contextvars.copy_context().run, self._run, job_id, session)
+        logger.info(f"会话[{session['id']}]的评分任务[{job_id}]已提交")
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def wait(self, job_id, timeout):
+        """等待评分任务完成，最多等待timeout秒，返回任务状态"""
+        event = self._done_events.get(job_id)
+        if event is not None:
+            event.wait(timeout)
+        return self.get(job_id)
+
+    def _run(self, job_id, session):
+        session_id = session['id']
+        self._update(job_id, status='running')
+        try:
+            # 开启逐轮评分时由逐轮结果汇总，不可用时做完整评分
+            evaluation = incremental_grader.finalize(session) or evaluate_session(session)
+
+            # 更新会话状态并保存
+            session['status'] = 'completed'
+            session['evaluation'] = evaluation
+            session['score'] = evaluation['total_score']
+            logger.info(f"更新会话[{session_id}]状态为已完成，评分: {evaluation['total_score']}")
+            save_session_file(session)
+            sessions.save(session)
+            score_aggregates.record(session)
+            self._update(job_id, status='completed', evaluation=evaluation)
+        except Exception as e:
+            logger.error(f"会话[{session_id}]的评分任务[{job_id}]失败: {str(e)}")
+            self._mark_failed(session, str(e))
+            self._update(job_id, status='failed', error=str(e))
+        finally:
+            self._done_events[job_id].set()
+
+    @staticmethod
+    def _mark_failed(session, error):
+        """评分失败的会话退出评分中状态，由end_chat或维护任务重新提交"""
+        session['status'] = 'evaluation_failed'
+        session['evaluation_error'] = error
+        session.pop('evaluation', None)
+        session.pop('score', None)
+        try:
+            save_session_file(session)
+            sessions.save(session)
+        except Exception as e:
+            logger.error(f"保存会话[{session['id']}]的评分失败状态出错: {str(e)}")
+
+    def _update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+                if fields.get('status') in ('completed', 'failed'):
+                    self._jobs[job_id]['finished_at'] = datetime.now().isoformat()
+
+    def _prune(self):
+        while len(self._jobs) > self.config["max_jobs"]:
+            oldest_id, oldest = next(iter(self._jobs.items()))
+            if oldest['status'] not in ('completed', 'failed'):
+                break
+            self._jobs.pop(oldest_id)
+            self._done_events.pop(oldest_id, None)
+
+
+evaluation_queue = EvaluationQueue(EVALUATION_CONFIG)
+
+
+@app.route('/api/end_chat', methods=['POST'])
+def end_chat():
+    """结束聊天：立即保存对话记录并提交评分任务"""
+    data = request.json
+    session_id = data.get('session_id')
+    logger.info(f"请求结束会话[{session_id}]并评分")
+
+    if not session_id:
+        logger.error("缺少会话ID")
+        return jsonify({'error': '缺少会话ID'}), 400
+
+    session = sessions.get(session_id)
+    if session is None:
+        logger.error(f"会话[{session_id}]不存在")
+        return jsonify({'error': '会话不存在'}), 404
+
+    # 重复提交时返回已有的评分任务
+    if session.get('status') == 'evaluating' and session.get('evaluation_job_id'):
+        logger.info(f"会话[{session_id}]已在评分中")
+        return jsonify({
+            'session_id': session_id,
+            'job_id': session['evaluation_job_id'],
+            'status': 'pending'
+        }), 202
+
+    # 先保存对话记录，评分在后台完成
+    job_id = evaluation_queue.submit(session)
 
     return jsonify({
-        'evaluation': evaluation
-    })
+        'session_id': session_id,
+        'job_id': job_id,
+        'status': 'pending'
+    }), 202
 
 
-@app.route('/api/sessions')
-def get_sessions():
-    """获取所有会话列表"""
-    logger.info("请求获取所有会话列表")
-
-    # 从内存中获取会话
-    session_list = []
-    for session_id, session in sessions.items():
-        session_list.append({
-            'id': session_id,
-            'timestamp': session['timestamp'],
-            'score': session.get('score'),
-            'status': session.get('status', 'active'),
-            'target_product': session.get('target_product', '未知产品')
-        })
-    logger.info(f"内存中共有{len(session_list)}个会话")
-
-    # 从文件中加载历史会话
-    loaded_count = 0
-    if os.path.exists('data'):
-        logger.info("开始从data目录加载历史会话")
-        for filename in os.listdir('data'):
-            if filename.endswith('.json') and filename.startswith('session_'):
+def find_evaluation_job(job_id, session_id=None):
+    """查找评分任务；任务由其他工作进程执行时，根据共享的会话状态还原任务状态"""
+    job = evaluation_queue.get(job_id)
+    if job is not None or not session_id:
+        return job
+    session = load_session(session_id)
+    if session is None or session.get('evaluation_job_id') != job_id:
+        return None
+    job = {'job_id': job_id, 'session_id': session_id, 'status': 'pending'}
+    if session.get('status') == 'completed':
+        job.update(status='completed', evaluation=session.get('evaluation'))
+    elif session.get('status') == 'evaluation_failed':
+        job.update(status='failed', error=session.get('evaluation_error'))
+    return job
+
+
+@app.route('/api/evaluation/<job_id>')
+def get_evaluation(job_id):
+    """查询评分任务状态，完成后包含评价结果"""
+    job = find_evaluation_job(job_id, request.args.get('session_id'))
+    if job is None:
+        logger.error(f"评分任务[{job_id}]不存在")
+        return jsonify({'error': '评分任务不存在'}), 404
+    return jsonify(job)
+
+
+@app.route('/api/evaluation/<job_id>/events')
+def evaluation_events(job_id):
+    """以SSE推送评分结果，任务完成或等待超过events_wait_seconds时发送一条事件后结束
+
+    每个连接会占用一个请求线程直到结束，页面默认轮询 /api/evaluation/<job_id>，本接口供外部集成使用。
+    """
+    session_id = request.args.get('session_id')
+    if find_evaluation_job(job_id, session_id) is None:
+        logger.error(f"评分任务[{job_id}]不存在")
+        return jsonify({'error': '评分任务不存在'}), 404
+
+    def generate():
+        wait_seconds = EVALUATION_CONFIG["events_wait_seconds"]
+        if evaluation_queue.get(job_id) is not None:
+            yield sse_event(evaluation_queue.wait(job_id, wait_seconds))
+            return
+        # 任务在其他工作进程中执行，轮询共享的会话状态
+        deadline = time.monotonic() + wait_seconds
+        job = find_evaluation_job(job_id, session_id)
+        while job['status'] == 'pending' and time.monotonic() < deadline:
+            time.sleep(0.5)
+            job = find_evaluation_job(job_id, session_id)
+        yield sse_event(job)
+
+    return app.response_class(generate(), mimetype='text/event-stream')
+
+
+def evaluation_is_orphaned(session):
+    """评分中的会话是否已无进程负责：提交任务的进程已退出、在其他机器上提交或已超过stale_seconds"""
+    if evaluation_queue.get(session.get('evaluation_job_id')) is not None:
+        return False
+    owner = session.get('evaluation_owner')
+    if not owner or time.time() - owner["submitted_at"] > EVALUATION_CONFIG["stale_seconds"]:
+        return True
+    if owner["host"] != socket.gethostname() or os.name != 'posix':
+        return False
+    try:
+        os.kill(owner["pid"], 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    # 同一进程中找不到任务（进程号被复用）时同样视为无人负责
+    return owner["pid"] == os.getpid()
+
+
+def resume_pending_evaluations():
+    """重新提交所在进程已退出、尚未完成的评分任务，以及未超过重试次数的失败任务"""
+    resumed = 0
+    candidates = session_index.find_by_status('evaluating') + session_index.find_by_status('evaluation_failed')
+    for session_id, file_path in candidates:
+        try:
+            session = read_session_location(file_path)
+            if session.get('status') == 'evaluation_failed':
+                if session.get('evaluation_attempts', 0) >= EVALUATION_CONFIG["max_attempts"]:
+                    continue
+            elif not evaluation_is_orphaned(session):
+                continue
+            evaluation_queue.submit(session)
+            resumed += 1
+        except Exception as e:
+            logger.error(f"恢复会话[{session_id}]的评分任务失败: {str(e)}")
+    if resumed:
+        logger.info(f"重新提交了{resumed}个未完成的评分任务")
+
+
+# 后台维护配置：多个工作进程通过文件锁选出一个进程执行维护任务
+MAINTENANCE_CONFIG = {
+    "lock_path": os.path.join(DATA_DIR, ".maintenance.lock"),
+    # 维护任务的执行间隔，未获得锁的进程按同样的间隔尝试接替
+    "interval_seconds": 60
+}
+
+
+class MaintenanceRunner:
+    """在处理请求的进程中运行后台维护任务（恢复评分任务等）
+
+    gunicorn/uvicorn直接加载模块、不经过main()，因此在收到第一个请求时启动；多个工作进程中只有
+    取得文件锁的进程执行，并在进程存活期间一直持有该锁，进程退出后由其他工作进程接替。
+    命令行子命令不处理请求，不会执行维护任务。
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._tasks = []
+        self._started = False
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self.owner = False
+
+    def register(self, name, fn, once=False):
+        """登记维护任务，once表示只在取得锁后执行一次"""
+        self._tasks.append((name, fn, once))
+
+    def ensure_started(self):
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name="maintenance", daemon=True).start()
+
+    def _acquire(self):
+        if fcntl is None:
+            # 不支持文件锁的平台只能单进程运行
+            return True
+        os.makedirs(os.path.dirname(self.config["lock_path"]) or '.', exist_ok=True)
+        lock_file = open(self.config["lock_path"], 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _run(self):
+        while not self._acquire():
+            time.sleep(self.config["interval_seconds"])
+        self.owner = True
+        logger.info(f"进程[{os.getpid()}]取得维护锁，开始执行后台维护任务")
+        first = True
+        while True:
+            for name, fn, once in self._tasks:
+                if once and not first:
+                    continue
                 try:
-                    with open(f'data/{filename}', 'r', encoding='utf-8') as f:
-                        session_data = json.load(f)
-                        # 避免重复添加
-                        if session_data['id'] not in sessions:
-                            session_list.append({
-                                'id': session_data['id'],
-                                'timestamp': session_data['timestamp'],
-                                'score': session_data.get('score'),
-                                'status': session_data.get('status', 'completed'),
-                                'target_product': session_data.get('target_product', '未知产品')
-                            })
-                            loaded_count += 1
+                    fn()
                 except Exception as e:
-                    logger.error(f"加载会话文件出错 {filename}: {str(e)}")
-        logger.info(f"从文件中成功加载了{loaded_count}个历史会话")
-    else:
-        logger.warning("data目录不存在，未加载历史会话")
+                    logger.error(f"维护任务[{name}]执行失败: {str(e)}")
+            first = False
+            time.sleep(self.config["interval_seconds"])
+
+
+maintenance = MaintenanceRunner(MAINTENANCE_CONFIG)
+maintenance.register("drop_unpersisted_sessions", drop_unpersisted_sessions, once=True)
+maintenance.register("resume_pending_evaluations", resume_pending_evaluations)
+
+
+@app.before_request
+def start_maintenance():
+    maintenance.ensure_started()
+
+
+@app.route('/api/sessions')
+def get_sessions():
+    """获取会话列表（从会话索引分页、排序查询）"""
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+        page_size = int(request.args.get('page_size', SESSION_INDEX_CONFIG["default_page_size"]))
+    except ValueError:
+        logger.error("分页参数格式错误")
+        return jsonify({'error': '分页参数格式错误'}), 400
+    page_size = min(max(page_size, 1), SESSION_INDEX_CONFIG["max_page_size"])
+    sort = request.args.get('sort', 'timestamp')
+    order = request.args.get('order', 'desc')
+    logger.info(f"请求获取会话列表: 第{page}页, 每页{page_size}条, 排序={sort} {order}")
+
+    session_list, total = session_index.query(page=page, page_size=page_size, sort=sort, order=order)
+    logger.info(f"返回{len(session_list)}个会话记录, 索引中共{total}个")
+
+    return jsonify({
+        'sessions': session_list,
+        'total': total,
+        'page': page,
+        'page_size': page_size
+    })
+
 
-    # 按时间排序
-    session_list.sort(key=lambda x: x['timestamp'], reverse=True)
-    logger.info(f"总共返回{len(session_list)}个会话记录")
+@app.route('/api/analytics/scores')
+def get_score_analytics():
+    """按产品、日期或学员查询评分统计（均值、标准差、总分直方图）"""
+    by = request.args.get('by', 'product')
+    if by not in ANALYTICS_CONFIG["dimensions"]:
+        logger.error(f"不支持的统计维度: {by}")
+        return jsonify({'error': f"by参数只支持: {', '.join(ANALYTICS_CONFIG['dimensions'])}"}), 400
+    start = request.args.get('from')
+    end = request.args.get('to')
+    groups = score_aggregates.query(by, start=start, end=end)
+    logger.info(f"返回按{by}分组的评分统计，共{len(groups)}组")
+    return jsonify({'by': by, 'from': start, 'to': end, 'groups': groups})
 
-    return jsonify({'sessions': session_list})
+
+def load_session(session_id):
+    """依次从会话存储、LRU缓存和已归档的文件中查找会话，不存在时返回None"""
+    # 先从会话存储中查找
+    session = sessions.get(session_id)
+    if session is not None:
+        logger.info(f"从会话存储中找到会话[{session_id}]")
+        return session
+
+    # 其次查LRU缓存，再按索引中的路径精确读取文件
+    payload = session_payload_cache.get(session_id)
+    if payload is not None:
+        logger.info(f"从缓存中找到会话[{session_id}]")
+        return payload
+
+    file_path = session_index.get_path(session_id)
+    if file_path:
+        try:
+            logger.info(f"在{file_path}中找到会话[{session_id}]")
+            payload = read_session_location(file_path)
+            # 评分中的会话稍后还会更新，只缓存已完成的
+            if payload.get('status') == 'completed':
+                session_payload_cache.put(session_id, payload)
+            return payload
+        except Exception as e:
+            logger.error(f"加载会话文件出错 {file_path}: {str(e)}")
+    return None
 
 
 @app.route('/api/session/<session_id>')
@@ -880,38 +5052,699 @@ def get_session(session_id):
     """获取特定会话的详情"""
     logger.info(f"请求获取会话[{session_id}]的详情")
 
-    # 先从内存中查找
-    if session_id in sessions:
-        logger.info(f"从内存中找到会话[{session_id}]")
-        return jsonify(sessions[session_id])
-
-    # 从文件中查找
-    if os.path.exists('data'):
-        logger.info(f"在内存中未找到会话[{session_id}]，开始从文件查找")
-        for filename in os.listdir('data'):
-            if filename.endswith('.json') and session_id in filename:
-                try:
-                    logger.info(f"在文件{filename}中找到会话[{session_id}]")
-                    with open(f'data/{filename}', 'r', encoding='utf-8') as f:
-                        return jsonify(json.load(f))
-                except Exception as e:
-                    logger.error(f"加载会话文件出错 {filename}: {str(e)}")
+    session = load_session(session_id)
+    if session is not None:
+        return jsonify(session)
 
     logger.error(f"会话[{session_id}]不存在")
     return jsonify({'error': '会话不存在'}), 404
 
 
-if __name__ == '__main__':
+# 批量重新评分配置
+RESCORE_CONFIG = {
+    "workers": 8,
+    # 令牌桶限速：每秒请求数及突发容量
+    "requests_per_second": 2.0,
+    "burst": 4,
+    # 限流、超时、服务端错误的重试次数及指数退避参数
+    "max_retries": 5,
+    "backoff_base_seconds": 1.0,
+    "backoff_max_seconds": 60.0
+}
+
+
+class TokenBucket:
+    """线程安全的令牌桶限速器"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取走一个令牌，令牌不足时阻塞等待"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def backoff_seconds(attempt, error, config):
+    """批处理任务的重试等待：优先遵循服务端返回的Retry-After，否则使用带随机抖动的指数退避"""
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None:
+        return retry_after
+    ceiling = min(config["backoff_max_seconds"], config["backoff_base_seconds"] * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+
+def iter_session_files(data_dir):
+    """逐个产出data目录下的会话文件路径，不一次性列出整个目录"""
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith('session_') and entry.name.endswith('.json'):
+                yield entry.path
+
+
+def session_id_from_filename(filename):
+    """从会话文件名 session_<会话ID>_<日期>_<时间>.json 中取出会话ID"""
+    return filename[len('session_'):-len('.json')].rsplit('_', 2)[0]
+
+
+def write_json_atomic(path, data):
+    """先写临时文件再替换，避免中途退出留下损坏的JSON"""
+    tmp_path = f"{path}.tmp"
+    dump_json_file(data, tmp_path, indent=2)
+    os.replace(tmp_path, path)
+
+
+class BatchRescorer:
+    """按当前评分标准和产品配置批量重新评分历史会话（会话文件和归档）
+
+    新评价写入会话的 rescores[tag] 字段，原有 evaluation 保持不变：会话文件原地改写，
+    归档中的会话记录在归档的重新评分结果库中（不追加新版本）。已完成的文件名或"archive:<会话ID>"记录在检查点文件中，
+    使用相同的tag重新运行即可断点续跑。
+    """
+
+    def __init__(self, api_client, tag, data_dir, config):
+        self.api_client = api_client
+        self.tag = tag
+        self.data_dir = data_dir
+        self.config = config
+        self.bucket = TokenBucket(config["requests_per_second"], config["burst"])
+        self.checkpoint_path = os.path.join(data_dir, f"rescore_{tag}.checkpoint")
+        self.archive = archive_for_data_dir(data_dir)
+        self._checkpoint_lock = threading.Lock()
+        self.stats = {"rescored": 0, "failed": 0, "skipped": 0, "retries": 0}
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return set()
+        with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def _backoff_seconds(self, attempt, error):
+        return backoff_seconds(attempt, error, self.config)
+
+    def _request_evaluation(self, session):
+        # 重新评分使用最新的产品目录
+        eval_messages, params, prompt_tokens, trimmed = budget_completion(
+            "rescore", build_evaluation_messages(session, catalog_manager.current), EVALUATION_COMPLETION_PARAMS,
+            session['id'])
+        for attempt in range(self.config["max_retries"] + 1):
+            self.bucket.acquire()
+            try:
+                response = self.api_client.chat.completions.create(
+                    model=AZURE_CONFIG["model"],
+                    messages=eval_messages,
+                    **params
+                )
+                record_usage("rescore", prompt_tokens, response.choices[0].message.content, response,
+                             session_id=session['id'], product=session.get('target_product'), trimmed=trimmed)
+                return parse_evaluation_text(session['id'], response.choices[0].message.content)
+            except RETRYABLE_API_ERRORS as e:
+                if attempt == self.config["max_retries"]:
+                    raise
+                delay = self._backoff_seconds(attempt, e)
+                logger.warning(f"会话[{session['id']}]重新评分请求失败，{delay:.1f}秒后第{attempt + 1}次重试: {str(e)}")
+                with self._checkpoint_lock:
+                    self.stats["retries"] += 1
+                time.sleep(delay)
+
+    def _write_file(self, path, evaluation):
+        # 写入前重新读取，避免覆盖评分期间其他进程对文件的修改
+        session = load_json_file(path)
+        session.setdefault('rescores', {})[self.tag] = evaluation
+        write_json_atomic(path, session)
+
+    def _write_archived(self, session_id, evaluation):
+        # 归档只追加，每次重新评分都追加整份会话会无限增长，评分结果单独按(会话ID, tag)保存
+        self.archive.set_rescore(session_id, self.tag, evaluation)
+        if self.archive is session_archive:
+            session_payload_cache.invalidate(session_id)
+
+    def _rescore(self, name, read, write):
+        """重新评分一个会话：name为检查点中的名称，read读取会话，write(评价)写回"""
+        try:
+            session = read()
+            evaluation = self._request_evaluation(session)
+            evaluation["target_product"] = session.get('target_product', '未知产品')
+            evaluation["rescored_at"] = datetime.now().isoformat()
+            write(evaluation)
+        except Exception as e:
+            logger.error(f"重新评分会话失败 {name}: {str(e)}")
+            with self._checkpoint_lock:
+                self.stats["failed"] += 1
+            return
+
+        with self._checkpoint_lock:
+            with open(self.checkpoint_path, 'a', encoding='utf-8') as f:
+                f.write(name + "\n")
+            self.stats["rescored"] += 1
+            done = self.stats["rescored"]
+        if done % 100 == 0:
+            logger.info(f"已重新评分{done}个会话")
+
+    def _archived_locations(self):
+        """归档中每个会话最新版本的位置；先全部读出，评分期间追加的新版本不会被再次评分"""
+        locations = {}
+        for entry, location in self.archive.iter_index():
+            locations[entry["id"]] = location
+        return locations
+
+    def run(self):
+        """执行批量重新评分，返回统计信息"""
+        completed = self._load_checkpoint()
+        archived = self._archived_locations()
+        logger.info(f"开始批量重新评分[{self.tag}]，检查点中已完成{len(completed)}个会话，"
+                    f"归档中有{len(archived)}个会话")
+        start = time.perf_counter()
+        # 限制排队中的任务数，目录再大也只占用少量内存
+        in_flight = threading.BoundedSemaphore(self.config["workers"] * 2)
+
+        def submit(name, read, write):
+            if name in completed:
+                self.stats["skipped"] += 1
+                return
+            in_flight.acquire()
+            future = executor.submit(self._rescore, name, read, write)
+            future.add_done_callback(lambda _: in_flight.release())
+
+        with ThreadPoolExecutor(max_workers=self.config["workers"], thread_name_prefix="rescore") as executor:
+            for path in iter_session_files(self.data_dir):
+                # 迁移时保留了原文件（--keep-files）的会话以归档中的版本为准
+                if session_id_from_filename(os.path.basename(path)) in archived:
+                    continue
+                submit(os.path.basename(path), functools.partial(load_json_file, path),
+                       functools.partial(self._write_file, path))
+            for session_id, location in archived.items():
+                submit(f"{ARCHIVE_LOCATION_PREFIX}{session_id}", functools.partial(self.archive.read, location),
+                       functools.partial(self._write_archived, session_id))
+        elapsed = time.perf_counter() - start
+        self.stats["elapsed_seconds"] = round(elapsed, 2)
+        self.stats["sessions_per_minute"] = round(self.stats["rescored"] / elapsed * 60, 1) if elapsed else None
+        logger.info(f"批量重新评分[{self.tag}]完成: {self.stats}")
+        return self.stats
+
+
+# 自我对练配置：患者模型与自动客服批量对话，生成示例对话语料
+SELFPLAY_CONFIG = {
+    "output_dir": os.path.join(DATA_DIR, "selfplay"),
+    # 同时进行的对话数；所有对话共享一个令牌桶限速
+    "concurrency": 32,
+    "requests_per_second": 5.0,
+    "burst": 10,
+    # 每场对话客服发言的轮数
+    "turns": 6,
+    "max_retries": 5,
+    "backoff_base_seconds": 1.0,
+    "backoff_max_seconds": 60.0,
+    # 每完成多少场对话输出一次进度
+    "progress_every": 50
+}
+
+SELFPLAY_AGENT_COMPLETION_PARAMS = {
+    "temperature": 0.7,
+    "max_tokens": 400
+}
+
+SELFPLAY_AGENT_PROMPT_TEMPLATE = """你是一家药店的在线客服，正在通过文字与前来咨询的顾客交流。请用简洁、口语化的中文回复，每次回复不超过150字，不要使用markdown格式。
+{profile_instructions}
+
+本店在售的产品有：{product_names}
+
+以下是与顾客症状最相关的产品资料：
+{product_info}"""
+
+# 自动客服的水平档位，用于生成不同质量的示例对话（校准评分、给新员工做正反例）
+SELFPLAY_AGENT_PROFILES = {
+    "expert": "你经验丰富、耐心专业：先询问症状、持续时间和用药史，再推荐合适的产品，准确说明功效、用法用量、禁忌和价格，并提醒注意事项、关心顾客。",
+    "average": "你态度友好，能回答顾客的基本问题并推荐产品，但介绍不够全面，有时会忘记询问用药史或说明注意事项。",
+    "poor": "你比较敷衍、急于成交：很少追问症状，介绍简单甚至不够准确，顾客犹豫时反复催促下单。"
+}
+
+
+class SelfPlayRunner:
+    """让患者模型（PATIENT_SYSTEM_PROMPT加目标产品提示）与自动客服批量对话
+
+    对话计划由产品、每个产品的场数和客服档位确定，对话ID为"<tag>-<序号>"；
+    每场对话完成后立即追加写入 <tag>.jsonl，重新运行相同的tag时跳过文件中已有的对话。
+    """
+
+    def __init__(self, api_client, tag, config, per_product, products=None, profiles=None, grade=False):
+        self.api_client = api_client
+        self.tag = tag
+        self.config = config
+        self.catalog = catalog_manager.current
+        self.products = products or [item["product"] for item in self.catalog.initial_symptoms]
+        self.profiles = profiles or list(SELFPLAY_AGENT_PROFILES)
+        self.per_product = per_product
+        self.grade = grade
+        self.bucket = TokenBucket(config["requests_per_second"], config["burst"])
+        self.output_path = os.path.join(config["output_dir"], f"{tag}.jsonl")
+        self._write_lock = threading.Lock()
+        self._start = None
+        self.stats = {"completed": 0, "failed": 0, "skipped": 0, "retries": 0}
+
+    def plan(self):
+        """返回(对话ID, 目标产品, 客服档位)列表，产品和档位交替排列"""
+        symptoms = {item["product"]: item["symptom"] for item in self.catalog.initial_symptoms}
+        unknown = [product for product in self.products if product not in symptoms]
+        if unknown:
+            raise ValueError(f"产品目录中没有这些产品或缺少initial_symptom: {', '.join(unknown)}")
+        plan = []
+        for _ in range(self.per_product):
+            for product in self.products:
+                profile = self.profiles[len(plan) % len(self.profiles)]
+                plan.append((f"{self.tag}-{len(plan):06d}", product, profile))
+        return plan
+
+    def _load_completed(self):
+        """读取已写入的对话ID；中途退出时可能留下不完整的最后一行，截掉后再继续追加"""
+        if not os.path.exists(self.output_path):
+            return set()
+        completed = set()
+        valid_bytes = 0
+        with open(self.output_path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                valid_bytes += len(line)
+                try:
+                    completed.add(json_loads(line)['id'])
+                except (ValueError, KeyError):
+                    continue
+        if valid_bytes < os.path.getsize(self.output_path):
+            logger.warning(f"截掉{self.output_path}末尾不完整的记录")
+            os.truncate(self.output_path, valid_bytes)
+        return completed
+
+    def _complete(self, endpoint, session, messages, params):
+        """限速调用模型（非流式），可重试的错误按退避重试，返回回复文本"""
+        messages, params, prompt_tokens, trimmed = budget_completion(endpoint, messages, params, session['id'])
+        for attempt in range(self.config["max_retries"] + 1):
+            self.bucket.acquire()
+            try:
+                response = self.api_client.chat.completions.create(
+                    model=AZURE_CONFIG["model"],
+                    messages=messages,
+                    **params
+                )
+                text = response.choices[0].message.content or ""
+                record_usage(endpoint, prompt_tokens, text, response, session=session, trimmed=trimmed)
+                return text
+            except RETRYABLE_API_ERRORS as e:
+                if attempt == self.config["max_retries"]:
+                    raise
+                delay = backoff_seconds(attempt, e, self.config)
+                logger.warning(f"自我对练[{session['id']}]的{endpoint}请求失败，{delay:.1f}秒后第{attempt + 1}次重试: {str(e)}")
+                with self._write_lock:
+                    self.stats["retries"] += 1
+                time.sleep(delay)
+
+    def _agent_prompt(self, product, profile):
+        return SELFPLAY_AGENT_PROMPT_TEMPLATE.format(
+            profile_instructions=SELFPLAY_AGENT_PROFILES[profile],
+            product_names="、".join(self.catalog.config["products"]),
+            product_info=self.catalog.get_prompts(product)["product_info"])
+
+    def _converse(self, conversation_id, product, profile):
+        symptom = next(item["symptom"] for item in self.catalog.initial_symptoms if item["product"] == product)
+        session = {
+            'id': conversation_id,
+            'messages': [{'role': 'patient', 'content': symptom}],
+            'timestamp': datetime.now().isoformat(),
+            'status': 'completed',
+            'target_product': product,
+            'catalog_version': self.catalog.version,
+            'selfplay': {'tag': self.tag, 'agent_profile': profile}
+        }
+        agent_prompt = self._agent_prompt(product, profile)
+        patient_prompt = self.catalog.get_prompts(product)["patient_system_prompt"]
+        for _ in range(self.config["turns"]):
+            # 客服看到的对话中患者是user、自己是assistant，与患者模型的视角相反
+            agent_messages = [{"role": "system", "content": agent_prompt}] + [
+                {"role": "user" if msg['role'] == 'patient' else "assistant", "content": msg['content']}
+                for msg in session['messages']]
+            reply = self._complete("selfplay_agent", session, agent_messages, SELFPLAY_AGENT_COMPLETION_PARAMS)
+            session['messages'].append({'role': 'customer-service', 'content': reply})
+            patient_messages = build_context_messages(session, patient_prompt)
+            reply = self._complete("selfplay_patient", session, patient_messages, PATIENT_COMPLETION_PARAMS)
+            session['messages'].append({'role': 'patient', 'content': reply})
+        if self.grade:
+            text = self._complete("selfplay_evaluation", session, build_evaluation_messages(session, self.catalog),
+                                  EVALUATION_COMPLETION_PARAMS)
+            session['evaluation'] = parse_evaluation_text(conversation_id, text)
+            session['evaluation']['target_product'] = product
+            session['score'] = session['evaluation'].get('total_score')
+        return session
+
+    def _run_one(self, conversation_id, product, profile):
+        try:
+            session = self._converse(conversation_id, product, profile)
+        except Exception as e:
+            logger.error(f"自我对练[{conversation_id}]失败: {str(e)}")
+            with self._write_lock:
+                self.stats["failed"] += 1
+            return
+        line = json_dumps(session) + "\n"
+        with self._write_lock:
+            with open(self.output_path, 'a', encoding='utf-8') as f:
+                f.write(line)
+            self.stats["completed"] += 1
+            done = self.stats["completed"]
+        if done % self.config["progress_every"] == 0:
+            elapsed = time.perf_counter() - self._start
+            logger.info(f"自我对练[{self.tag}]已完成{done}场对话，{done / elapsed * 60:.1f}场/分钟")
+
+    def run(self):
+        """执行全部对话计划，返回统计信息（含每分钟完成的对话数）"""
+        os.makedirs(self.config["output_dir"], exist_ok=True)
+        plan = self.plan()
+        completed = self._load_completed()
+        logger.info(f"开始自我对练[{self.tag}]: 计划{len(plan)}场对话（{len(self.products)}个产品 × {self.per_product}场，"
+                    f"客服档位{self.profiles}），已完成{len(completed)}场，并发{self.config['concurrency']}，"
+                    f"限速{self.config['requests_per_second']}次/秒")
+        self._start = time.perf_counter()
+        in_flight = threading.BoundedSemaphore(self.config["concurrency"] * 2)
+        with ThreadPoolExecutor(max_workers=self.config["concurrency"], thread_name_prefix="selfplay") as executor:
+            for conversation_id, product, profile in plan:
+                if conversation_id in completed:
+                    self.stats["skipped"] += 1
+                    continue
+                in_flight.acquire()
+                future = executor.submit(self._run_one, conversation_id, product, profile)
+                future.add_done_callback(lambda _: in_flight.release())
+        elapsed = time.perf_counter() - self._start
+        self.stats["elapsed_seconds"] = round(elapsed, 2)
+        self.stats["conversations_per_minute"] = round(self.stats["completed"] / elapsed * 60, 1) if elapsed else None
+        self.stats["token_usage"] = token_ledger.snapshot(top=0)["process"]["endpoints"]
+        self.stats["output"] = self.output_path
+        dump_json_file(self.stats, os.path.join(self.config["output_dir"], f"{self.tag}.summary.json"), indent=2)
+        logger.info(f"自我对练[{self.tag}]完成: {self.stats}")
+        return self.stats
+
+
+# 异步服务模式配置
+ASYNC_SERVER_CONFIG = {
+    # 非流式接口仍由Flask处理，在该线程池中执行
+    "wsgi_workers": 32,
+    # 异步接口中读写会话存储等同步操作的线程池大小
+    "blocking_workers": 32
+}
+_blocking_executor = ThreadPoolExecutor(max_workers=ASYNC_SERVER_CONFIG["blocking_workers"],
+                                        thread_name_prefix="async-blocking")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """在线程池中执行同步函数（保留请求追踪ID等上下文变量），避免阻塞事件循环"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        _blocking_executor, functools.partial(context.run, fn, *args, **kwargs))
+
+
+async def generate_patient_turn_async(stream, prepared, timer):
+    """generate_patient_turn的异步版本：使用异步客户端，流式等待期间不占用线程
+
+    保存会话、计数token等同步操作放到线程池执行，避免读写会话存储时阻塞事件循环中的其他流。
+    """
+    session_id = stream.session_id
+    messages, params, prompt_tokens, trimmed, cache_key = prepared
+    response = None
+    pieces = []
+    try:
+        cached = response_cache.lookup(cache_key)
+        if cached is not None:
+            await run_blocking(replay_cached_turn, stream, cached, timer)
+            return
+
+        stream_logger.info(f"开始调用Azure OpenAI生成会话[{session_id}]的患者回复")
+        start = time.perf_counter()
+        response = await async_client.chat.completions.create(
+            model=AZURE_CONFIG["model"],
+            messages=messages,
+            stream=True,
+            **params
+        )
+        timer.connected()
+        stream_logger.info(f"成功创建会话[{session_id}]的流式响应请求")
+
+        chunk_count = 0
+        coalescer = ChunkCoalescer(SSE_COALESCE_CONFIG)
+        async for chunk in response:
+            chunk_count += 1
+            if chunk.choices and chunk.choices[0].delta.content:
+                pieces.append(chunk.choices[0].delta.content)
+                text = coalescer.add(pieces[-1])
+                if text is not None:
+                    timer.chunk()
+                    stream.publish({'content': text})
+        text = coalescer.flush()
+        if text is not None:
+            timer.chunk()
+            stream.publish({'content': text})
+
+        response_cache.store(cache_key, pieces, time.perf_counter() - start)
+        await run_blocking(finish_patient_turn, session_id, "".join(pieces), chunk_count, prompt_tokens,
+                           trimmed, turn_id=stream.key)
+        elapsed = timer.finish('completed')
+        stream_logger.info(f"会话[{session_id}]的首token耗时{(timer.first_token or 0) * 1000:.0f}毫秒，"
+                           f"流式总耗时{elapsed:.2f}秒")
+        stream.publish()
+
+    except asyncio.CancelledError:
+        if stream.cancel_reason is None:
+            raise
+        # 由巡检线程取消：关闭上游响应，释放连接
+        if response is not None:
+            await response.aclose()
+        await run_blocking(abort_patient_turn, stream, pieces, prompt_tokens, trimmed,
+                           params.get('max_tokens', 0), timer)
+    except Exception as e:
+        timer.finish('error')
+        logger.error(f"会话[{session_id}]生成响应出错: {str(e)}")
+        await run_blocking(fail_patient_turn, stream, str(e))
+
+
+async def send_message_async(request):
+    """send_message的异步版本：生成任务和事件读取都在事件循环中运行"""
+    request_start = time.perf_counter()
+    maintenance.ensure_started()
+    trace_id = start_trace(request.headers.get('X-Request-ID'))
+    last_event_id = request.headers.get('Last-Event-ID')
+    if request.method == 'POST':
+        try:
+            data = await request.json()
+        except ValueError:
+            data = {}
+        session_id, user_message = data.get('session_id'), data.get('message')
+        key = data.get('idempotency_key') or request.headers.get('Idempotency-Key')
+    else:
+        session_id = request.query_params.get('session_id')
+        user_message = request.query_params.get('message')
+        key = request.query_params.get('key')
+        if not key and last_event_id and ":" in last_event_id:
+            key = last_event_id.rpartition(":")[0]
+        key = key or uuid.uuid4().hex
+    stream_logger.info(f"接收到会话[{session_id}]的新消息（异步模式）")
+
+    if not session_id or not key:
+        logger.error("缺少必要参数: session_id或idempotency_key")
+        return JSONResponse({'error': '缺少必要参数'}, status_code=400)
+    if not IDEMPOTENCY_KEY_PATTERN.match(key):
+        logger.error(f"幂等键格式错误: {key}")
+        return JSONResponse({'error': '幂等键只能包含字母、数字、下划线和连字符，最长64个字符'}, status_code=400)
+
+    # 读写会话存储、构建上下文和计数token都是同步操作，在线程池中执行
+    stream, prepared, error = await run_blocking(open_turn, session_id, user_message, key, 'send_message_async')
+    if error is not None:
+        return JSONResponse({'error': error[0]}, status_code=error[1])
+    if prepared is not None:
+        turn_streams.start_async(stream, generate_patient_turn_async(
+            stream, prepared, StreamTimer('send_message_async', request_start)))
+
+    headers = {'Access-Control-Allow-Origin': '*'}
+    if METRICS_CONFIG["trace_ids"]:
+        headers['X-Request-ID'] = trace_id
+    events = stream.aiter_events(stream.start_index(last_event_id), TURN_STREAM_CONFIG["heartbeat_seconds"])
+    return StreamingResponse(events, media_type='text/event-stream', headers=headers)
+
+
+def create_asgi_app():
+    """创建ASGI应用：/api/send_message走原生异步实现，其余接口转交Flask"""
+    if Starlette is None:
+        raise RuntimeError("异步服务模式需要安装可选依赖: pip install starlette uvicorn a2wsgi")
+    return Starlette(routes=[
+        Route('/api/send_message', send_message_async, methods=['GET', 'POST']),
+        Mount('/', app=WSGIMiddleware(app, workers=ASYNC_SERVER_CONFIG["wsgi_workers"]))
+    ])
+
+
+# 供 uvicorn app:asgi_app 等ASGI服务器直接加载
+asgi_app = create_asgi_app() if Starlette is not None else None
+
+
+def allocated_bytes(paths):
+    """文件实际占用的磁盘空间（按块计），小文件多时远大于文件内容的字节数"""
+    return sum(os.stat(path).st_blocks * 512 for path in paths)
+
+
+def archive_session_files(data_dir, keep_files=False):
+    """把data目录中已完成的会话文件迁移到归档，返回迁移的会话数"""
+    archive = archive_for_data_dir(data_dir)
+    files = sorted(os.path.join(data_dir, name) for name in os.listdir(data_dir)
+                   if name.startswith('session_') and name.endswith('.json'))
+    before_files, before_bytes = len(files), sum(os.path.getsize(path) for path in files)
+    before_allocated = allocated_bytes(files)
+    start = time.perf_counter()
+    migrated, skipped = 0, 0
+    for file_path in files:
+        try:
+            session = load_json_file(file_path)
+        except Exception as e:
+            logger.error(f"读取会话文件失败，跳过 {file_path}: {str(e)}")
+            skipped += 1
+            continue
+        # 未完成或正在评分的会话仍由会话文件承载，评分完成后再写入归档
+        if session.get('status', 'completed') != 'completed':
+            skipped += 1
+            continue
+        location = archive.append(session)
+        if archive is session_archive:
+            session_index.upsert(session, path=location)
+        if not keep_files:
+            os.remove(file_path)
+        migrated += 1
+    elapsed = time.perf_counter() - start
+
+    remaining = [os.path.join(data_dir, name) for name in os.listdir(data_dir)
+                 if name.startswith('session_') and name.endswith('.json')]
+    archive_files = [os.path.join(archive.dir, name) for name in os.listdir(archive.dir)
+                     if name.endswith((".jsonl", ".idx"))] if os.path.isdir(archive.dir) else []
+    after_files = remaining + archive_files
+    after_bytes = sum(os.path.getsize(path) for path in after_files)
+    logger.info(f"归档迁移完成: 迁移{migrated}个会话，跳过{skipped}个，耗时{elapsed:.2f}秒")
+    logger.info(f"迁移前: {before_files}个文件，{before_bytes / 1024:.0f}KB，占用磁盘{before_allocated / 1024:.0f}KB")
+    logger.info(f"迁移后: {len(after_files)}个文件，{after_bytes / 1024:.0f}KB，"
+                f"占用磁盘{allocated_bytes(after_files) / 1024:.0f}KB")
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="汇仁医药客服对话系统")
+    subparsers = parser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser("serve", help="启动Web服务（默认）")
+    serve_parser.add_argument("--async", dest="use_async", action="store_true",
+                              help="使用异步ASGI服务模式（需要starlette、uvicorn、a2wsgi）")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=5000)
+    subparsers.add_parser("rebuild-index", help="从data目录全量重建会话索引")
+    archive_parser = subparsers.add_parser("archive", help="把已完成的会话文件迁移到紧凑的分段归档")
+    archive_parser.add_argument("--data-dir", default=DATA_DIR)
+    archive_parser.add_argument("--keep-files", action="store_true", help="迁移后保留原会话文件")
+    subparsers.add_parser("rebuild-analytics", help="从会话文件和归档全量重建评分统计")
+    rescore_parser = subparsers.add_parser("rescore", help="按当前评分标准批量重新评分历史会话")
+    rescore_parser.add_argument("--tag", default=datetime.now().strftime("%Y%m%d_%H%M%S"),
+                                help="本次重新评分的标识，使用相同的tag可断点续跑")
+    rescore_parser.add_argument("--data-dir", default=DATA_DIR)
+    rescore_parser.add_argument("--workers", type=int, default=RESCORE_CONFIG["workers"])
+    rescore_parser.add_argument("--rps", type=float, default=RESCORE_CONFIG["requests_per_second"],
+                                help="每秒请求数上限")
+    rescore_parser.add_argument("--burst", type=int, default=RESCORE_CONFIG["burst"])
+    rescore_parser.add_argument("--max-retries", type=int, default=RESCORE_CONFIG["max_retries"])
+    rescore_parser.add_argument("--base-url", help="使用OpenAI兼容接口（如本地桩服务）代替Azure")
+    selfplay_parser = subparsers.add_parser("selfplay", help="患者模型与自动客服批量对话，生成示例对话语料")
+    selfplay_parser.add_argument("--tag", default=datetime.now().strftime("%Y%m%d_%H%M%S"),
+                                 help="本次运行的标识，使用相同的tag可断点续跑")
+    selfplay_parser.add_argument("--per-product", type=int, default=10, help="每个产品的对话场数")
+    selfplay_parser.add_argument("--products", nargs="+", help="只为这些产品生成对话，默认为全部产品")
+    selfplay_parser.add_argument("--profiles", nargs="+", choices=list(SELFPLAY_AGENT_PROFILES),
+                                 help="自动客服的水平档位，默认轮流使用全部档位")
+    selfplay_parser.add_argument("--turns", type=int, default=SELFPLAY_CONFIG["turns"])
+    selfplay_parser.add_argument("--concurrency", type=int, default=SELFPLAY_CONFIG["concurrency"])
+    selfplay_parser.add_argument("--rps", type=float, default=SELFPLAY_CONFIG["requests_per_second"],
+                                 help="所有对话合计的每秒请求数上限")
+    selfplay_parser.add_argument("--burst", type=int, default=SELFPLAY_CONFIG["burst"])
+    selfplay_parser.add_argument("--grade", action="store_true", help="对话结束后用当前评分标准评分")
+    selfplay_parser.add_argument("--output-dir", default=SELFPLAY_CONFIG["output_dir"])
+    selfplay_parser.add_argument("--base-url", help="使用OpenAI兼容接口（如本地桩服务）代替Azure")
+    args = parser.parse_args()
+
+    if args.command == "rescore":
+        config = dict(RESCORE_CONFIG, workers=args.workers, requests_per_second=args.rps,
+                      burst=args.burst, max_retries=args.max_retries)
+        # 重试由BatchRescorer统一处理，关闭客户端自带的重试；使用Azure时仍在多个部署间分发
+        if args.base_url:
+            api_client = OpenAI(base_url=args.base_url, api_key="stub", max_retries=0)
+        else:
+            api_client = ModelPool(AZURE_DEPLOYMENTS, dict(MODEL_POOL_CONFIG, max_retries=0)).client
+        BatchRescorer(api_client, args.tag, args.data_dir, config).run()
+        return
+
+    if args.command == "selfplay":
+        config = dict(SELFPLAY_CONFIG, turns=args.turns, concurrency=args.concurrency,
+                      requests_per_second=args.rps, burst=args.burst, output_dir=args.output_dir)
+        if args.base_url:
+            api_client = OpenAI(base_url=args.base_url, api_key="stub", max_retries=0)
+        else:
+            api_client = ModelPool(AZURE_DEPLOYMENTS, dict(MODEL_POOL_CONFIG, max_retries=0)).client
+        SelfPlayRunner(api_client, args.tag, config, args.per_product, args.products, args.profiles,
+                       args.grade).run()
+        return
+
+    if args.command == "rebuild-index":
+        os.makedirs(DATA_DIR, exist_ok=True)
+        logger.info(f"开始从{DATA_DIR}目录重建会话索引")
+        count = session_index.rebuild(DATA_DIR)
+        logger.info(f"会话索引重建完成，共{count}条记录")
+        return
+
+    if args.command == "rebuild-analytics":
+        logger.info("开始从已完成的会话重建评分统计")
+        start = time.perf_counter()
+        count = score_aggregates.rebuild(iter_completed_sessions())
+        logger.info(f"评分统计重建完成，共{count}个会话，耗时{time.perf_counter() - start:.2f}秒")
+        return
+
+    if args.command == "archive":
+        archive_session_files(args.data_dir, args.keep_files)
+        return
+
     logger.info("汇仁医药客服对话系统")
     logger.info("====================")
     logger.info("启动中...")
-    logger.info("访问地址: http://localhost:5000")
+    host = getattr(args, "host", "127.0.0.1")
+    port = getattr(args, "port", 5000)
+    logger.info(f"访问地址: http://localhost:{port}")
     logger.info("按 Ctrl+C 停止服务")
 
     # 确保data目录存在
-    os.makedirs('data', exist_ok=True)
+    os.makedirs(DATA_DIR, exist_ok=True)
     logger.info("确保data目录存在")
 
+    # debug模式下重载器的监控进程不处理请求，只在实际服务进程中启动维护任务（首个请求到达时也会启动）
+    use_async = getattr(args, "use_async", False)
+    if use_async or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        maintenance.ensure_started()
+
+    if use_async:
+        logger.info("开始以异步ASGI模式启动应用")
+        asgi = create_asgi_app()
+        uvicorn.run(asgi, host=host, port=port)
+        return
+
     # 启动Flask应用
     logger.info("开始启动Flask应用")
-    app.run(debug=True, port=5000, threaded=True)
\ No newline at end of file
+    app.run(debug=True, host=host, port=port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""会话文件与分段归档的存储规模、全量扫描和随机读取对比
+
+在临时目录中生成N个模拟的已完成会话，分别以 每个会话一个带缩进的JSON文件（改造前）
+和 分段归档 两种方式保存，比较文件数、字节数、实际占用磁盘、全量扫描（统计平均分）耗时
+和按位置随机读取单个会话的延迟。
+
+用法（在项目根目录运行）:
+    python bench/bench_archive.py --sessions 5000 --turns 10
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as chatbot  # noqa: E402
+
+CS_MESSAGE = "您好，这款产品每天两次，每次四片，饭后温水送服，一个疗程一般是一个月左右。"
+PATIENT_MESSAGE = "嗯，我最近确实老是腰酸，晚上还得起来好几次，吃这个会不会有什么副作用啊？"
+
+
+def make_session(i, turns):
+    return {
+        "id": f"bench-{i:06d}", "timestamp": f"2026-01-01T00:00:{i % 60:02d}", "status": "completed",
+        "target_product": "汇仁肾宝片", "score": 60 + i % 40,
+        "messages": [{"role": "customer-service" if j % 2 == 0 else "patient",
+                      "content": CS_MESSAGE if j % 2 == 0 else PATIENT_MESSAGE} for j in range(turns * 2)],
+        "evaluation": {"total_score": 60 + i % 40, "strengths": ["回应及时"], "overall_comment": CS_MESSAGE}
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def report(label, paths, scan, read, locations, samples):
+    size = sum(os.path.getsize(path) for path in paths)
+    start = time.perf_counter()
+    scores = [session["score"] for session in scan()]
+    scan_seconds = time.perf_counter() - start
+    latencies = []
+    for location in random.sample(locations, min(samples, len(locations))):
+        start = time.perf_counter()
+        read(location)
+        latencies.append(time.perf_counter() - start)
+    print(f"{label:<14}{len(paths):>8}{size / 1024 / 1024:>10.1f}{chatbot.allocated_bytes(paths) / 1024 / 1024:>12.1f}"
+          f"{scan_seconds * 1000:>12.0f}{percentile(latencies, 0.5) * 1e6:>12.0f}{percentile(latencies, 0.99) * 1e6:>12.0f}"
+          f"  平均分{sum(scores) / len(scores):.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="会话文件与分段归档的对比")
+    parser.add_argument("--sessions", type=int, default=5000)
+    parser.add_argument("--turns", type=int, default=10, help="每个会话的对话轮数")
+    parser.add_argument("--samples", type=int, default=1000, help="随机读取的次数")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    workdir = tempfile.mkdtemp(prefix="hr_chatbot_archive_")
+    try:
+        sessions = [make_session(i, args.turns) for i in range(args.sessions)]
+        files = []
+        for session in sessions:
+            path = os.path.join(workdir, f"session_{session['id']}.json")
+            chatbot.dump_json_file(session, path, indent=2)
+            files.append(path)
+
+        archive = chatbot.SessionArchive(dict(chatbot.ARCHIVE_CONFIG, dir=os.path.join(workdir, "archive")))
+        locations = [archive.append(session) for session in sessions]
+        archive_files = [os.path.join(archive.dir, name) for name in os.listdir(archive.dir)
+                         if name.endswith((".jsonl", ".idx"))]
+
+        print(f"{args.sessions}个会话，每个{args.turns}轮对话")
+        print(f"{'存储方式':<14}{'文件数':>8}{'大小(MB)':>10}{'占用磁盘(MB)':>12}{'全量扫描(ms)':>12}"
+              f"{'随机读p50(us)':>12}{'随机读p99(us)':>12}")
+        report("会话文件", files, lambda: (chatbot.load_json_file(path) for path in files),
+               chatbot.load_json_file, files, args.samples)
+        report("分段归档", archive_files, archive.iter_sessions, archive.read, locations, args.samples)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
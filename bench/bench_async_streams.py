@@ -0,0 +1,162 @@
+"""异步服务模式并发流式压测
+
+用本地桩替换异步Azure客户端（按固定间隔吐出响应块），在独立子进程中启动ASGI服务，
+再由压测进程同时发起大量 /api/send_message 流式请求，统计首包时间、总耗时和服务进程线程数。
+默认依次测量页面使用的POST请求（JSON请求体+幂等键）和兼容旧客户端的GET请求；
+--save-delay 给每次保存会话注入延迟，模拟较慢的会话存储，检查其是否拖慢其他流。
+
+用法（在项目根目录运行）:
+    python bench/bench_async_streams.py --streams 300 --chunks 40 --chunk-delay 0.05
+    python bench/bench_async_streams.py --methods POST --save-delay 0.05
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import multiprocessing
+import logging
+from datetime import datetime
+from types import SimpleNamespace
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uvicorn
+
+import app as chatbot
+
+
+class StubStream:
+    """模拟流式响应：每隔chunk_delay秒产出一个响应块"""
+
+    def __init__(self, chunks, chunk_delay):
+        self.chunks = chunks
+        self.chunk_delay = chunk_delay
+
+    async def __aiter__(self):
+        for i in range(self.chunks):
+            await asyncio.sleep(self.chunk_delay)
+            delta = SimpleNamespace(content=f"字{i}")
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+class StubAsyncClient:
+    def __init__(self, chunks, chunk_delay):
+        async def create(**kwargs):
+            return StubStream(chunks, chunk_delay)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=create))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def run_stream(port, session_id, method):
+    """用原始socket发起一次流式请求（httpx在数百并发流下会先成为压测端瓶颈）"""
+    start = time.perf_counter()
+    first = None
+    done = False
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    if method == 'POST':
+        body = json.dumps({'session_id': session_id, 'message': '您好，请问有什么症状',
+                           'idempotency_key': uuid.uuid4().hex}).encode()
+        writer.write(f"POST /api/send_message HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n"
+                     f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    else:
+        query = urlencode({'session_id': session_id, 'message': '您好，请问有什么症状'})
+        writer.write(f"GET /api/send_message?{query} HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+                     f"Connection: close\r\n\r\n".encode())
+    await writer.drain()
+    async for raw in reader:
+        line = raw.decode().strip()
+        if not line.startswith('data: '):
+            continue
+        if first is None:
+            first = time.perf_counter() - start
+        if json.loads(line[6:]).get('done'):
+            done = True
+            break
+    writer.close()
+    return first, time.perf_counter() - start, done
+
+
+def serve(args, session_ids):
+    """服务子进程：安装桩客户端并预置会话后启动ASGI服务"""
+    logging.disable(logging.CRITICAL)
+    chatbot.async_client = StubAsyncClient(args.chunks, args.chunk_delay)
+    if args.save_delay:
+        def delayed(method):
+            def wrapper(*method_args, **kwargs):
+                time.sleep(args.save_delay)
+                return method(*method_args, **kwargs)
+            return wrapper
+        chatbot.sessions.save = delayed(chatbot.sessions.save)
+        chatbot.sessions.update = delayed(chatbot.sessions.update)
+    for session_id in session_ids:
+        chatbot.sessions.save({
+            'id': session_id,
+            'messages': [{'role': 'patient', 'content': '最近腰酸，晚上老起夜'}],
+            'timestamp': datetime.now().isoformat(),
+            'status': 'active',
+            'target_product': chatbot.catalog_manager.current.initial_symptoms[0]["product"]
+        })
+    uvicorn.run(chatbot.create_asgi_app(), port=args.port, log_level="error")
+
+
+def server_threads(pid):
+    """读取服务进程当前的线程数（Linux）"""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("Threads:"):
+                return int(line.split()[1])
+    return None
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="异步服务模式并发流式压测")
+    parser.add_argument("--streams", type=int, default=300, help="并发流数量")
+    parser.add_argument("--chunks", type=int, default=40, help="每个回复的响应块数")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="响应块间隔（秒）")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--methods", nargs="+", choices=["POST", "GET"], default=["POST", "GET"])
+    parser.add_argument("--save-delay", type=float, default=0.0, help="每次保存会话注入的延迟（秒）")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    session_ids = {method: [str(uuid.uuid4()) for _ in range(args.streams)] for method in args.methods}
+    all_ids = [sid for ids in session_ids.values() for sid in ids]
+    server = multiprocessing.get_context("fork").Process(target=serve, args=(args, all_ids), daemon=True)
+    server.start()
+
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', args.port)
+            writer.close()
+            break
+        except OSError:
+            await asyncio.sleep(0.1)
+
+    ideal = args.chunks * args.chunk_delay
+    print(f"并发流: {args.streams}, 单流理论耗时: {ideal:.2f}s, 保存会话注入延迟: {args.save_delay * 1000:.0f}ms")
+    for method in args.methods:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(run_stream(args.port, sid, method) for sid in session_ids[method]))
+        elapsed = time.perf_counter() - start
+        threads = server_threads(server.pid)
+
+        ttfb = [r[0] for r in results if r[0] is not None]
+        totals = [r[1] for r in results]
+        print(f"[{method}] 完成: {sum(1 for r in results if r[2])}, 全部完成耗时: {elapsed:.2f}s")
+        print(f"[{method}] 首包时间 p50={percentile(ttfb, 0.5) * 1000:.1f}ms p95={percentile(ttfb, 0.95) * 1000:.1f}ms")
+        print(f"[{method}] 单流耗时 p50={percentile(totals, 0.5):.2f}s p99={percentile(totals, 0.99):.2f}s")
+        print(f"[{method}] 服务进程线程数: {threads}")
+    server.terminate()
+    server.join()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+"""产品目录重新加载的耗时和内存占用测试
+
+以 product_config.json 中的产品为模板复制出指定数量的SKU，写入临时配置文件，
+测量 load_product_catalog（读取、校验、预渲染提示词）的耗时和目录的内存占用。
+
+用法（在项目根目录运行）:
+    python bench/bench_catalog_reload.py --skus 5000 --rounds 5
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as chatbot
+
+
+def build_config(template, skus):
+    """复制模板产品生成指定数量的SKU"""
+    products = list(template["products"].items())
+    config = {"products": {}}
+    for i in range(skus):
+        name, data = products[i % len(products)]
+        product = json.loads(json.dumps(data, ensure_ascii=False))
+        product["initial_symptom"] = f"{data.get('initial_symptom', '')}（{i}）"
+        config["products"][f"{name}-{i:05d}"] = product
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description="产品目录重新加载耗时和内存占用测试")
+    parser.add_argument("--skus", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    config = build_config(chatbot.catalog_manager.current.config, args.skus)
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False, encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False)
+        path = f.name
+    try:
+        timings = []
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            chatbot.load_product_catalog(path)
+            timings.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        catalog = chatbot.load_product_catalog(path)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        os.unlink(path)
+
+    print(f"SKU数量: {len(catalog.config['products'])}, 配置文件大小: {len(json.dumps(config, ensure_ascii=False).encode()) / 1024 / 1024:.1f}MB")
+    print(f"加载耗时: 最快 {min(timings) * 1000:.1f}ms, 平均 {sum(timings) / len(timings) * 1000:.1f}ms")
+    print(f"目录内存占用: {current / 1024 / 1024:.1f}MB (加载峰值 {peak / 1024 / 1024:.1f}MB)")
+
+
+if __name__ == '__main__':
+    main()
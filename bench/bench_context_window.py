@@ -0,0 +1,115 @@
+"""对话历史窗口的提示词规模与实测首token延迟对比
+
+在临时目录中启动应用，模型调用指向本地桩服务（或 --base-url 指定的OpenAI兼容服务），
+通过 /api/send_message 逐轮进行一场长对话，在第10/50/100/150轮记录发送给患者模型的提示词token数
+和实测的首token延迟（请求发出到收到第一个回复事件），对比开启与关闭窗口两种情况。
+桩服务按 --prefill-ms-per-1k 模拟提示词越长首token越慢；摘要由后台摘要器经同一服务生成。
+
+用法（在项目根目录运行）:
+    python bench/bench_context_window.py
+    python bench/bench_context_window.py --turns 10 50 100 150 --latency 0.25 --prefill-ms-per-1k 60
+    python bench/bench_context_window.py --base-url http://127.0.0.1:8001/v1
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import logging
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_openai_server import make_server  # noqa: E402
+
+CS_MESSAGE = "您好，这款产品每天两次，每次四片，饭后温水送服，一个疗程一般是一个月左右，价格是一百二十八元一盒。"
+
+
+def send_turn(client, session_id, key):
+    """发送一轮消息，返回(首个回复事件的延迟, 整轮耗时)"""
+    start = time.perf_counter()
+    response = client.post('/api/send_message', buffered=False, json={
+        'session_id': session_id, 'message': CS_MESSAGE, 'idempotency_key': key})
+    first = None
+    for chunk in response.response:
+        if first is None and b'"content"' in chunk:
+            first = time.perf_counter() - start
+        if b'"error"' in chunk:
+            raise RuntimeError(chunk.decode('utf-8'))
+    response.close()
+    return first, time.perf_counter() - start
+
+
+def run_conversation(chatbot, turns, enabled, settle_seconds):
+    """进行一场对话，返回 轮次 -> (提示词token数, 首token延迟, 整轮耗时)"""
+    chatbot.CONTEXT_WINDOW_CONFIG["enabled"] = enabled
+    client = chatbot.app.test_client()
+    session_id = client.post('/api/start_chat').get_json()['session_id']
+    results = {}
+    for turn in range(1, max(turns) + 1):
+        if turn in turns:
+            # 等待后台摘要跟上，与真实对话中学员输入的间隔相当
+            time.sleep(settle_seconds)
+            session = chatbot.sessions.get(session_id)
+            system_prompt = chatbot.catalog_for_session(session).get_prompts(
+                session['target_product'])["patient_system_prompt"]
+            pending = dict(session, messages=session['messages'] + [{"role": "customer-service",
+                                                                      "content": CS_MESSAGE}])
+            tokens = chatbot.count_message_tokens(chatbot.build_context_messages(pending, system_prompt))
+            results[turn] = (tokens,) + send_turn(client, session_id, f"{int(enabled)}-{turn}")
+        else:
+            send_turn(client, session_id, f"{int(enabled)}-{turn}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对话历史窗口的提示词规模与实测首token延迟对比")
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 50, 100, 150])
+    parser.add_argument("--base-url", help="OpenAI兼容服务地址，未指定时启动本地桩服务")
+    parser.add_argument("--stub-port", type=int, default=0, help="桩服务端口，默认随机空闲端口")
+    parser.add_argument("--latency", type=float, default=0.25, help="桩服务的固定延迟（秒）")
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=60.0, help="桩服务每千字提示词增加的首token延迟（毫秒）")
+    parser.add_argument("--settle", type=float, default=0.5, help="检查点前等待后台摘要的时间（秒）")
+    args = parser.parse_args()
+
+    base_url = args.base_url
+    if base_url is None:
+        stub = make_server(args.stub_port, latency=args.latency, chunk_delay=0.001,
+                           prefill_ms_per_1k=args.prefill_ms_per_1k)
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{stub.server_address[1]}/v1"
+
+    workdir = tempfile.mkdtemp(prefix="hr_chatbot_context_")
+    shutil.copy(os.path.join(ROOT, "product_config.json"), workdir)
+    os.chdir(workdir)
+    logging.disable(logging.CRITICAL)
+    from openai import OpenAI
+    import app as chatbot
+    chatbot.client = OpenAI(base_url=base_url, api_key="stub", max_retries=0)
+    chatbot.OPENER_POOL_CONFIG["enabled"] = False
+    chatbot.RESPONSE_CACHE_CONFIG["enabled"] = False
+
+    try:
+        turns = set(args.turns)
+        full = run_conversation(chatbot, turns, False, args.settle)
+        windowed = run_conversation(chatbot, turns, True, args.settle)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"模型服务: {base_url}")
+    print(f"{'轮次':>6} {'全量token':>10} {'窗口token':>10} {'全量TTFT(ms)':>13} {'窗口TTFT(ms)':>13}"
+          f" {'全量整轮(ms)':>13} {'窗口整轮(ms)':>13}")
+    for turn in sorted(turns):
+        (full_tokens, full_ttft, full_total), (win_tokens, win_ttft, win_total) = full[turn], windowed[turn]
+        print(f"{turn:>6} {full_tokens:>10} {win_tokens:>10} {full_ttft * 1000:>13.0f} {win_ttft * 1000:>13.0f}"
+              f" {full_total * 1000:>13.0f} {win_total * 1000:>13.0f}")
+    print(json.dumps({"full": full, "windowed": windowed}))
+
+
+if __name__ == '__main__':
+    main()
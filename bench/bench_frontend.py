@@ -0,0 +1,79 @@
+"""前端页面传输大小、首页处理耗时和流式回复渲染开销对比
+
+- 页面：各编码（原始/gzip/br）的传输字节数，ETag校验命中时的304响应
+- 首页处理耗时：每次请求render_template_string（改造前）与返回预先压缩的页面
+- 渲染开销：按"每块重新设置innerHTML并滚动"（改造前）与"按帧追加文本"两种方式，
+  估算一条回复需要重新解析的字符数和DOM更新次数；浏览器中的实测见 bench/render_bench.html
+
+用法（在项目根目录运行）:
+    python bench/bench_frontend.py --requests 2000
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import logging
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def measure(client, requests, headers=None):
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = client.get('/', headers=headers or {})
+    return (time.perf_counter() - start) / requests, response
+
+
+def main():
+    parser = argparse.ArgumentParser(description="前端页面与渲染开销对比")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--chunk-chars", type=int, default=2, help="每个SSE事件的平均字数")
+    parser.add_argument("--chars-per-second", type=float, default=40, help="模型输出速率（字/秒）")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="hr_chatbot_frontend_")
+    shutil.copy(os.path.join(ROOT, "product_config.json"), workdir)
+    os.chdir(workdir)
+    os.environ["MODEL_BACKEND"] = "mock"
+    import app as chatbot
+    logging.disable(logging.CRITICAL)
+    chatbot.OPENER_POOL_CONFIG["enabled"] = False
+    client = chatbot.app.test_client()
+
+    try:
+        print("页面传输大小")
+        for encoding, size in chatbot.compiled_page().sizes().items():
+            print(f"  {encoding:<10}{size:>8}字节")
+        etag = client.get('/', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+        not_modified = client.get('/', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        print(f"  ETag命中    {len(not_modified.data):>8}字节（状态码{not_modified.status_code}）")
+
+        print(f"\n首页处理耗时（{args.requests}次平均）")
+        with chatbot.app.test_request_context('/'):
+            start = time.perf_counter()
+            for _ in range(args.requests):
+                chatbot.render_template_string(chatbot.HTML_TEMPLATE)
+            baseline = (time.perf_counter() - start) / args.requests
+        print(f"  {'每次渲染模板（改造前）':<20}{baseline * 1e6:>8.0f}微秒")
+        for label, headers in (("预压缩页面gzip", {'Accept-Encoding': 'gzip'}),
+                               ("ETag命中304", {'Accept-Encoding': 'gzip', 'If-None-Match': etag})):
+            elapsed, _ = measure(client, args.requests, headers)
+            print(f"  {label:<20}{elapsed * 1e6:>8.0f}微秒（含Flask请求处理）")
+
+        print(f"\n渲染开销估算（每块{args.chunk_chars}字，输出{args.chars_per_second:.0f}字/秒，60帧/秒）")
+        print(f"{'回复字数':>8}{'改造前解析字数':>16}{'按帧追加字数':>14}{'改造前DOM更新':>14}{'按帧DOM更新':>12}")
+        for reply_chars in (100, 500, 1200, 2400):
+            chunks = reply_chars // args.chunk_chars
+            reparsed = sum(args.chunk_chars * i for i in range(1, chunks + 1))
+            frames = min(chunks, int(reply_chars / args.chars_per_second * 60) + 1)
+            print(f"{reply_chars:>8}{reparsed:>16}{reply_chars:>14}{chunks:>14}{frames:>12}")
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""日志开销对比：同步DEBUG日志、异步结构化日志、关闭日志三种情况下的请求延迟
+
+在临时目录中以进程内方式运行应用（模型调用使用离线模拟后端，几乎无延迟），
+多线程并发完成 开始对话 → K轮发送消息 的流程，统计send_message延迟分位数和写出的日志量。
+
+用法（在项目根目录运行）:
+    python bench/bench_logging.py --threads 8 --conversations 50 --turns 5
+    python bench/bench_logging.py --slow-disk-ms 2   # 模拟磁盘抖动：每次写日志额外耗时2毫秒
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def run_load(chatbot, threads, conversations, turns):
+    latencies = []
+    lock = threading.Lock()
+
+    def conversation(_):
+        client = chatbot.app.test_client()
+        session_id = client.post('/api/start_chat').get_json()['session_id']
+        for turn in range(turns):
+            start = time.perf_counter()
+            body = client.get(f'/api/send_message?session_id={session_id}&message=第{turn}轮咨询').data
+            elapsed = time.perf_counter() - start
+            assert b'"done": true' in body, body
+            with lock:
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(conversation, range(conversations)))
+    return latencies, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="日志开销对比")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--slow-disk-ms", type=float, default=0.0, help="每条日志写文件时额外的延迟（毫秒）")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="hr_chatbot_logbench_")
+    shutil.copy(os.path.join(ROOT, "product_config.json"), workdir)
+    os.chdir(workdir)
+    os.environ.update({"MODEL_BACKEND": "mock", "MOCK_FIRST_TOKEN_SECONDS": "0", "MOCK_TOKENS_PER_SECOND": "1000000"})
+    import app as chatbot
+    chatbot.OPENER_POOL_CONFIG["enabled"] = False
+    if args.slow_disk_ms:
+        emit = chatbot.SizeAndTimeRotatingFileHandler.emit
+
+        def slow_emit(self, record):
+            time.sleep(args.slow_disk_ms / 1000)
+            emit(self, record)
+        chatbot.SizeAndTimeRotatingFileHandler.emit = slow_emit
+
+    base = dict(chatbot.LOG_CONFIG, console=False)
+    modes = [
+        # 改造前的配置：DEBUG级别、同步写文本文件、不采样
+        ("同步DEBUG文本", dict(base, level="DEBUG", file="sync.log", file_format="text", **{"async": False},
+                           categories={name: {"level": "DEBUG"} for name in base["categories"]})),
+        ("异步JSON（默认）", dict(base, file="async.log")),
+        ("关闭日志", None),
+    ]
+
+    try:
+        print(f"{'配置':<16}{'请求数':>8}{'平均(ms)':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}"
+              f"{'吞吐(req/s)':>13}{'日志(KB)':>10}{'丢弃':>8}")
+        for name, config in modes:
+            if config is None:
+                logging.disable(logging.CRITICAL)
+            else:
+                logging.disable(logging.NOTSET)
+                chatbot.logging_pipeline.configure(config)
+            run_load(chatbot, args.threads, 2, args.turns)  # 预热
+            latencies, wall = run_load(chatbot, args.threads, args.conversations, args.turns)
+            dropped = chatbot.logging_pipeline.snapshot()["dropped"] if config else 0
+            chatbot.logging_pipeline.stop()
+            log_kb = os.path.getsize(config["file"]) / 1024 if config else 0
+            print(f"{name:<16}{len(latencies):>8}{sum(latencies) / len(latencies) * 1000:>10.2f}"
+                  f"{percentile(latencies, 0.5) * 1000:>10.2f}{percentile(latencies, 0.95) * 1000:>10.2f}"
+                  f"{percentile(latencies, 0.99) * 1000:>10.2f}{len(latencies) / wall:>13.1f}"
+                  f"{log_kb:>10.0f}{dropped:>8}")
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""SSE响应块编码与会话文件写入的单核微基准
+
+按send_message中generate()的处理方式，对一批模拟的模型响应块做编码和拼接，
+比较 标准库json逐块编码+字符串拼接（改造前）、快速序列化、响应块合并 等组合的每秒处理块数；
+另外比较一个长会话写入会话文件的耗时。单线程运行，结果即单核吞吐。
+
+用法（在项目根目录运行）:
+    python bench/bench_sse_encoding.py --replies 2000 --chunks 300
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as chatbot  # noqa: E402
+
+SAMPLE_TEXT = "嗯，我最近确实老是腰酸，晚上还得起来好几次，这个药大概多少钱啊？吃多久能见效？"
+
+
+def make_reply(chunks):
+    """模拟模型的流式响应块：每块1~2个字符"""
+    pieces = []
+    for i in range(chunks):
+        start = i % len(SAMPLE_TEXT)
+        pieces.append(SAMPLE_TEXT[start:start + 1 + i % 2])
+    return pieces
+
+
+def encode_baseline(reply):
+    """改造前的处理方式：标准库json逐块编码，字符串拼接累计回复"""
+    full_response = ""
+    out = 0
+    for content in reply:
+        full_response += content
+        out += len(f"data: {json.dumps({'content': content})}\n\n")
+    return out, full_response
+
+
+def encode_current(reply):
+    """当前generate()的处理方式：响应块合并（按配置）+ sse_event + 列表累计"""
+    pieces = []
+    coalescer = chatbot.ChunkCoalescer(chatbot.SSE_COALESCE_CONFIG)
+    out = 0
+    for content in reply:
+        pieces.append(content)
+        text = coalescer.add(content)
+        if text is not None:
+            out += len(chatbot.sse_event({'content': text}))
+    text = coalescer.flush()
+    if text is not None:
+        out += len(chatbot.sse_event({'content': text}))
+    return out, "".join(pieces)
+
+
+def measure(encode, replies):
+    start = time.perf_counter()
+    for reply in replies:
+        encode(reply)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE响应块编码与会话文件写入的单核微基准")
+    parser.add_argument("--replies", type=int, default=2000)
+    parser.add_argument("--chunks", type=int, default=300, help="每个回复的响应块数")
+    parser.add_argument("--turns", type=int, default=100, help="会话文件基准中的对话轮数")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    replies = [make_reply(args.chunks) for _ in range(args.replies)]
+    total_chunks = args.replies * args.chunks
+    fast_available = chatbot.orjson is not None
+    print(f"orjson: {'已安装' if fast_available else '未安装'}，共{total_chunks}个响应块")
+
+    cases = [("标准库json逐块+字符串拼接（改造前）", encode_baseline, None)]
+    for fast in ([False, True] if fast_available else [False]):
+        for coalesce in (False, True):
+            label = f"{'orjson' if fast else '标准库json'}{'+合并' if coalesce else '逐块'}+列表累计"
+            cases.append((label, encode_current, (fast, coalesce)))
+
+    print(f"{'配置':<34}{'块/秒':>14}{'SSE事件数/回复':>16}")
+    for label, encode, options in cases:
+        if options is not None:
+            chatbot.JSON_CONFIG["fast_json"], chatbot.SSE_COALESCE_CONFIG["enabled"] = options
+        # 合并的时间窗口在微基准中不会触发，事件数由字数上限决定
+        events = args.chunks
+        if options is not None and options[1]:
+            events = len(chatbot.ChunkCoalescer(chatbot.SSE_COALESCE_CONFIG).replay(replies[0]))
+        elapsed = measure(encode, replies)
+        print(f"{label:<34}{total_chunks / elapsed:>14,.0f}{events:>16}")
+
+    session = {
+        "id": "bench", "status": "completed", "target_product": "汇仁肾宝片", "score": 85,
+        "messages": [{"role": "customer-service" if i % 2 == 0 else "patient", "content": SAMPLE_TEXT * 3}
+                     for i in range(args.turns * 2)],
+        "evaluation": {"total_score": 85, "strengths": ["回应及时"], "overall_comment": SAMPLE_TEXT}
+    }
+    workdir = tempfile.mkdtemp(prefix="hr_chatbot_json_")
+    try:
+        path = os.path.join(workdir, "session.json")
+        print(f"\n会话文件写入（{args.turns}轮对话）")
+        for fast in ([False, True] if fast_available else [False]):
+            chatbot.JSON_CONFIG["fast_json"] = fast
+            start = time.perf_counter()
+            for _ in range(200):
+                chatbot.dump_json_file(session, path, indent=2)
+            elapsed = (time.perf_counter() - start) / 200
+            print(f"{'orjson' if fast else '标准库json':<12}{elapsed * 1000:>8.3f} 毫秒/次  {os.path.getsize(path) / 1024:.0f}KB")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""模型客户端池的负载均衡与熔断检查
+
+启动三个本地桩服务作为三个"部署"：正常、慢速（注入延迟）、故障（按请求顺序失败、成功交替，
+即约一半请求返回429/500，但从不连续失败，结果可复现），
+用ModelPool并发发送非流式和流式请求，输出各部署的请求分布、延迟和熔断情况，并校验：
+- 所有请求最终成功（失败请求换部署重试）
+- 故障部署按失败比例触发熔断，承担的请求明显少于正常部署
+- latency路由下慢速部署承担的请求少于正常部署
+
+用法（在项目根目录运行）:
+    python bench/check_model_pool.py --requests 300 --concurrency 16 --routing latency
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_openai_server import make_server  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模型客户端池的负载均衡与熔断检查")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--routing", choices=["least_outstanding", "latency"], default="latency")
+    parser.add_argument("--base-port", type=int, default=18301)
+    args = parser.parse_args()
+
+    stubs = {
+        "healthy": make_server(args.base_port, latency=0.02, chunk_delay=0.001),
+        "slow": make_server(args.base_port + 1, latency=0.3, chunk_delay=0.001),
+        "faulty": make_server(args.base_port + 2, latency=0.02, error_rate=0.5, chunk_delay=0.001, error_mode="even"),
+    }
+    for server in stubs.values():
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    import app as chatbot
+    logging.disable(logging.CRITICAL)
+    deployments = [{"name": name, "base_url": f"http://127.0.0.1:{server.server_address[1]}/v1", "model": "stub"}
+                   for name, server in stubs.items()]
+    config = dict(chatbot.MODEL_POOL_CONFIG, routing=args.routing, cooldown_seconds=2, backoff_base_seconds=0.05)
+    pool = chatbot.ModelPool(deployments, config)
+    messages = [{"role": "system", "content": "你是患者"}, {"role": "user", "content": "您好"}]
+
+    def one_request(i):
+        if i % 4 == 0:
+            stream = pool.client.chat.completions.create(model="ignored", messages=messages, stream=True)
+            return "".join(chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices)
+        response = pool.client.chat.completions.create(model="ignored", messages=messages)
+        return response.choices[0].message.content
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(one_request, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    for server in stubs.values():
+        server.shutdown()
+
+    snapshot = pool.snapshot()
+    print(json.dumps(snapshot, ensure_ascii=False, indent=2))
+    print(f"{args.requests}个请求，并发{args.concurrency}，耗时{elapsed:.2f}秒")
+
+    backends = {backend["name"]: backend for backend in snapshot["backends"]}
+    assert all(results), "存在空响应"
+    assert snapshot["failures"] == 0, snapshot
+    assert all(backend["outstanding"] == 0 for backend in backends.values()), backends
+    assert backends["faulty"]["circuit_opens"] >= 1, backends["faulty"]
+    assert backends["faulty"]["requests"] < backends["healthy"]["requests"], backends
+    if args.routing == "latency":
+        assert backends["slow"]["requests"] < backends["healthy"]["requests"], backends
+    print("检查通过: " + "，".join(f"{name}承担{backend['requests']}次请求" for name, backend in backends.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""多工作进程会话共享检查
+
+在临时目录中启动N个使用SQLite会话存储的工作进程（各自监听一个端口），
+模型调用指向本地桩服务；一次对话的开始、每轮消息、结束和评分查询
+依次轮流发往不同的工作进程，最后校验对话记录完整、评分已写回。
+
+用法（在项目根目录运行）:
+    python bench/check_multiworker_sessions.py --workers 4 --turns 6
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_openai_server import make_server
+
+
+def run_worker(workdir, port, stub_port):
+    """工作进程：切换到临时目录后再导入应用，使用SQLite会话存储"""
+    os.chdir(workdir)
+    os.environ["SESSION_STORE_BACKEND"] = "sqlite"
+    import logging
+    logging.disable(logging.CRITICAL)
+    from openai import OpenAI
+    from werkzeug.serving import make_server as make_wsgi_server
+    import app as chatbot
+    chatbot.client = OpenAI(base_url=f"http://127.0.0.1:{stub_port}/v1", api_key="stub", max_retries=0)
+    chatbot.OPENER_POOL_CONFIG["enabled"] = False
+    make_wsgi_server("127.0.0.1", port, chatbot.app, threaded=True).serve_forever()
+
+
+def request(port, path, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=data,
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=30) as response:
+        return response.read().decode()
+
+
+def wait_ready(port):
+    for _ in range(100):
+        try:
+            request(port, "/api/sessions?page_size=1")
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"工作进程 {port} 启动超时")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多工作进程会话共享检查")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--base-port", type=int, default=5100)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="hr_chatbot_workers_")
+    shutil.copy(os.path.join(ROOT, "product_config.json"), workdir)
+    stub = make_server(args.base_port - 1, chunk_delay=0.0)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    ports = [args.base_port + i for i in range(args.workers)]
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=run_worker, args=(workdir, port, args.base_port - 1), daemon=True)
+               for port in ports]
+    for worker in workers:
+        worker.start()
+    try:
+        for port in ports:
+            wait_ready(port)
+
+        started = json.loads(request(ports[0], "/api/start_chat", {}))
+        session_id = started["session_id"]
+        print(f"worker:{ports[0]} start_chat -> {session_id}")
+        for turn in range(args.turns):
+            port = ports[(turn + 1) % len(ports)]
+            stream = request(port, f"/api/send_message?session_id={session_id}&message=turn{turn}")
+            assert '"done": true' in stream, stream
+            print(f"worker:{port} send_message 第{turn + 1}轮完成")
+
+        port = ports[-1]
+        ended = json.loads(request(port, "/api/end_chat", {"session_id": session_id}))
+        print(f"worker:{port} end_chat -> job {ended['job_id']}")
+        port = ports[0]
+        job = json.loads(request(port, f"/api/evaluation/{ended['job_id']}/events?session_id={session_id}")[6:])
+        print(f"worker:{port} 评分任务状态: {job['status']}")
+
+        session = json.loads(request(ports[1 % len(ports)], f"/api/session/{session_id}"))
+        roles = [message["role"] for message in session["messages"]]
+        assert len(roles) == 1 + 2 * args.turns, roles
+        assert roles == ["patient"] + ["customer-service", "patient"] * args.turns, roles
+        assert session["status"] == "completed" and session["score"] is not None, session
+        print(f"检查通过: {args.workers}个工作进程共享一次对话，共{len(roles)}条消息，评分{session['score']}")
+    finally:
+        for worker in workers:
+            worker.terminate()
+        stub.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""患者回复缓存的跨会话命中检查
+
+在临时目录中以离线模拟后端（MODEL_BACKEND=mock）启动应用，开启开场白预生成池和回复缓存，
+模拟模型每次生成不同的开场白，经 /api/start_chat 和 /api/send_message 进行多场对话，
+每场的第一轮客服消息相同，输出缓存统计并校验：
+- 各会话的开场白互不相同（来自预生成池）
+- 同一产品的后续会话命中缓存，命中率达到 --min-hit-rate
+
+用法（在项目根目录运行）:
+    python bench/check_response_cache.py --sessions 30
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import logging
+import tempfile
+import itertools
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CS_MESSAGE = "您好，请问您有什么不舒服的地方？"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="患者回复缓存的跨会话命中检查")
+    parser.add_argument("--sessions", type=int, default=30)
+    parser.add_argument("--min-hit-rate", type=float, default=0.5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="hr_chatbot_cache_")
+    shutil.copy(os.path.join(ROOT, "product_config.json"), workdir)
+    os.chdir(workdir)
+    os.environ.update(MODEL_BACKEND="mock", MOCK_FIRST_TOKEN_SECONDS="0.01", MOCK_TOKENS_PER_SECOND="2000")
+    logging.disable(logging.CRITICAL)
+    import app as chatbot
+
+    try:
+        # 模拟模型生成的开场白各不相同
+        counter = itertools.count()
+        generate_opener = chatbot.generate_opener
+        chatbot.generate_opener = lambda symptom, product=None: f"{generate_opener(symptom, product)}（{next(counter)}）"
+        chatbot.RESPONSE_CACHE_CONFIG.update(enabled=True, similarity_threshold=1.0)
+        chatbot.OPENER_POOL_CONFIG["depth"] = args.sessions
+        chatbot.opener_pool.start()
+        # 等待每个产品的池都补充到足够整轮检查取用
+        products = {item["product"] for item in chatbot.catalog_manager.current.initial_symptoms}
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            depths = chatbot.opener_pool.snapshot()["depths"]
+            if all(depths.get(product, 0) >= args.sessions for product in products):
+                break
+            time.sleep(0.1)
+
+        client = chatbot.app.test_client()
+        openers = []
+        for i in range(args.sessions):
+            started = client.post('/api/start_chat', json={}).get_json()
+            openers.append(started['initial_message'])
+            stream = client.post('/api/send_message', json={
+                'session_id': started['session_id'], 'message': CS_MESSAGE, 'idempotency_key': f"turn-{i}"})
+            assert b'"done": true' in stream.data, stream.data
+
+        stats = chatbot.response_cache.snapshot()
+        pool_stats = chatbot.opener_pool.snapshot()
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps({"response_cache": stats, "opener_pool_hits": pool_stats["hits"]}, ensure_ascii=False, indent=2))
+    assert pool_stats["hits"] == args.sessions, pool_stats
+    assert len(set(openers)) == args.sessions, "开场白应各不相同"
+    assert stats["hit_rate"] >= args.min_hit_rate, stats
+    print(f"检查通过: {args.sessions}场对话的开场白各不相同，第一轮回复缓存命中率{stats['hit_rate']:.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""端到端压测：模拟N个学员并发完成 开始对话 → K轮发送消息 → 结束对话 → 等待评分
+
+默认在临时目录中启动一个使用内置离线模拟后端（MODEL_BACKEND=mock）的服务子进程，
+模型延迟完全可控，测得的就是服务自身的开销；也可以用 --url 指向已经在运行的服务。
+统计每个接口的p50/p95/p99延迟和请求数/秒，send_message另外统计首token时间，结果保存为JSON以便不同版本对比。
+
+用法（在项目根目录运行）:
+    python bench/load_test.py --trainees 50 --turns 5
+    python bench/load_test.py --trainees 200 --turns 5 --async --tokens-per-second 100 --output results/async.json
+    python bench/load_test.py --url http://127.0.0.1:5000 --trainees 20
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime
+from urllib.parse import urlencode, urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TRAINEE_MESSAGES = [
+    "您好，请问您有什么不舒服的地方？",
+    "这种情况持续多久了？平时有没有在吃其他药？",
+    "根据您的症状，推荐您试试我们的产品，每天两次，每次四片，饭后服用。",
+    "一个疗程一个月左右，价格是一百二十八元一盒，一般需要两到三盒。",
+    "服用期间注意清淡饮食、规律作息，有任何不适随时联系我们。",
+]
+# 等待评分时查询状态的间隔，与页面的轮询间隔一致
+EVALUATION_POLL_SECONDS = 1.0
+
+
+def serve(workdir, port, use_async, mock_env):
+    """服务子进程：切换到临时目录并启用模拟后端后再导入应用"""
+    os.chdir(workdir)
+    os.environ.update(mock_env)
+    sys.path.insert(0, ROOT)
+    import logging
+    import app as chatbot
+    logging.disable(logging.CRITICAL)
+    chatbot.OPENER_POOL_CONFIG["enabled"] = False
+    if use_async:
+        import uvicorn
+        uvicorn.run(chatbot.create_asgi_app(), host="127.0.0.1", port=port, log_level="error")
+    else:
+        from werkzeug.serving import make_server
+        make_server("127.0.0.1", port, chatbot.app, threaded=True).serve_forever()
+
+
+async def http_request(host, port, method, path, body=None):
+    """发起一次HTTP请求（Connection: close），返回(状态码, 响应体, 首个SSE事件的耗时, 总耗时)"""
+    start = time.perf_counter()
+    first_event = None
+    reader, writer = await asyncio.open_connection(host, port)
+    payload = json.dumps(body).encode() if body is not None else b""
+    headers = f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n"
+    if body is not None:
+        headers += f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+    writer.write(headers.encode() + b"\r\n" + payload)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    while (await reader.readline()).strip():
+        pass
+    chunks = []
+    async for raw in reader:
+        chunks.append(raw)
+        if first_event is None and raw.startswith(b"data: {\"content\""):
+            first_event = time.perf_counter() - start
+    writer.close()
+    return status, b"".join(chunks).decode("utf-8", "replace"), first_event, time.perf_counter() - start
+
+
+def json_body(text):
+    """取出响应体中的JSON（兼容分块传输编码）"""
+    return json.loads(text[text.index("{"):text.rindex("}") + 1])
+
+
+async def run_trainee(host, port, turns, samples, errors):
+    def record(endpoint, status, elapsed, ok=True):
+        if status >= 400 or not ok:
+            errors.append({"endpoint": endpoint, "status": status})
+        else:
+            samples.setdefault(endpoint, []).append(elapsed)
+
+    status, text, _, elapsed = await http_request(host, port, "POST", "/api/start_chat", {})
+    record("start_chat", status, elapsed)
+    if status >= 400:
+        return
+    session_id = json_body(text)["session_id"]
+
+    for turn in range(turns):
+        query = urlencode({"session_id": session_id, "message": TRAINEE_MESSAGES[turn % len(TRAINEE_MESSAGES)]})
+        status, text, first_event, elapsed = await http_request(host, port, "GET", f"/api/send_message?{query}")
+        ok = '"done": true' in text
+        record("send_message", status, elapsed, ok)
+        if ok and first_event is not None:
+            samples.setdefault("send_message_ttft", []).append(first_event)
+
+    status, text, _, elapsed = await http_request(host, port, "POST", "/api/end_chat", {"session_id": session_id})
+    record("end_chat", status, elapsed)
+    if status >= 400:
+        return
+    job_id = json_body(text)["job_id"]
+    # 与页面一样轮询评分状态，从调用end_chat开始计时，到查询到评分结果为止
+    wait_start = time.perf_counter()
+    while True:
+        await asyncio.sleep(EVALUATION_POLL_SECONDS)
+        status, text, _, _ = await http_request(
+            host, port, "GET", f"/api/evaluation/{job_id}?session_id={session_id}")
+        if status >= 400 or json_body(text).get("status") in ("completed", "failed"):
+            break
+    record("evaluation", status, elapsed + time.perf_counter() - wait_start, '"completed"' in text)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def summarize(samples, wall_seconds):
+    report = {}
+    for endpoint, values in sorted(samples.items()):
+        report[endpoint] = {
+            "count": len(values),
+            "requests_per_second": round(len(values) / wall_seconds, 2),
+            "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+            "max_ms": round(max(values) * 1000, 1),
+        }
+    return report
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+async def wait_until_ready(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"服务在{timeout}秒内未就绪: {host}:{port}")
+
+
+async def run(args, host, port):
+    await wait_until_ready(host, port)
+    samples, errors = {}, []
+    semaphore = asyncio.Semaphore(args.trainees)
+
+    async def trainee():
+        async with semaphore:
+            await run_trainee(host, port, args.turns, samples, errors)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[trainee() for _ in range(args.trainees * args.rounds)])
+    return samples, errors, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端压测")
+    parser.add_argument("--trainees", type=int, default=50, help="并发学员数")
+    parser.add_argument("--rounds", type=int, default=1, help="每个并发位依次完成的对话数")
+    parser.add_argument("--turns", type=int, default=5, help="每场对话发送的消息轮数")
+    parser.add_argument("--url", help="压测已运行的服务，不启动子进程")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="子进程使用异步服务模式")
+    parser.add_argument("--port", type=int, default=5077)
+    parser.add_argument("--first-token-seconds", type=float, default=0.3, help="模拟后端的首token延迟")
+    parser.add_argument("--tokens-per-second", type=float, default=50, help="模拟后端的输出速率")
+    parser.add_argument("--output", help="结果JSON路径，默认为 loadtest_<时间>.json")
+    args = parser.parse_args()
+
+    mock_env = {"MODEL_BACKEND": "mock", "MOCK_FIRST_TOKEN_SECONDS": str(args.first_token_seconds),
+                "MOCK_TOKENS_PER_SECOND": str(args.tokens_per_second)}
+    server, workdir = None, None
+    if args.url:
+        parsed = urlsplit(args.url)
+        host, port = parsed.hostname, parsed.port or 80
+    else:
+        host, port = "127.0.0.1", args.port
+        workdir = tempfile.mkdtemp(prefix="hr_chatbot_loadtest_")
+        shutil.copy(os.path.join(ROOT, "product_config.json"), workdir)
+        server = multiprocessing.get_context("spawn").Process(
+            target=serve, args=(workdir, port, args.use_async, mock_env), daemon=True)
+        server.start()
+
+    try:
+        samples, errors, wall = asyncio.run(run(args, host, port))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "git_revision": git_revision(),
+            "target": args.url or ("async" if args.use_async else "threaded"),
+            "trainees": args.trainees,
+            "rounds": args.rounds,
+            "turns": args.turns,
+            "mock_backend": None if args.url else mock_env,
+            "wall_seconds": round(wall, 3),
+        },
+        "endpoints": summarize(samples, wall),
+        "errors": len(errors),
+        "error_samples": errors[:20],
+    }
+
+    print(f"{'接口':<20}{'次数':>8}{'req/s':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for endpoint, stats in result["endpoints"].items():
+        print(f"{endpoint:<20}{stats['count']:>8}{stats['requests_per_second']:>10}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    print(f"总耗时{wall:.2f}秒，错误{len(errors)}个")
+
+    output = args.output or f"loadtest_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存: {output}")
+
+
+if __name__ == '__main__':
+    main()
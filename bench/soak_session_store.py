@@ -0,0 +1,89 @@
+"""内存会话存储浸泡测试
+
+持续模拟训练流量（新建会话、多轮消息、部分正常结束、部分中途放弃），
+按固定间隔采样进程RSS和存储状态，验证内存不随累计会话数增长。
+默认使用较小的容量和空闲时间，以便在几分钟内覆盖多轮淘汰；
+24小时浸泡可用 --duration 86400 运行。
+
+用法（在项目根目录运行）:
+    python bench/soak_session_store.py --duration 300 --rate 200
+"""
+import os
+import sys
+import time
+import uuid
+import random
+import logging
+import argparse
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as chatbot
+
+
+def rss_mb():
+    """读取当前进程RSS（Linux）"""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="内存会话存储浸泡测试")
+    parser.add_argument("--duration", type=int, default=300, help="运行时长（秒）")
+    parser.add_argument("--rate", type=int, default=200, help="每秒新建会话数")
+    parser.add_argument("--turns", type=int, default=10, help="每个会话的消息轮数")
+    parser.add_argument("--max-sessions", type=int, default=500)
+    parser.add_argument("--idle-ttl", type=int, default=20, help="空闲淘汰时间（秒）")
+    parser.add_argument("--spill-ttl", type=int, default=120, help="已写出会话的过期删除时间（秒）")
+    parser.add_argument("--sample-interval", type=int, default=10)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    spill_dir = tempfile.mkdtemp(prefix="session_spill_")
+    store = chatbot.InMemorySessionStore(dict(chatbot.SESSION_STORE_CONFIG, max_sessions=args.max_sessions,
+                                      idle_ttl_seconds=args.idle_ttl, sweep_interval_seconds=1,
+                                      spill_dir=spill_dir, spill_ttl_seconds=args.spill_ttl))
+    active = []
+    created = 0
+    start = time.monotonic()
+    next_sample = start
+    print(f"{'elapsed_s':>9} {'created':>9} {'in_memory':>9} {'spill_files':>11} {'rss_mb':>8}")
+    while time.monotonic() - start < args.duration:
+        tick = time.monotonic()
+        for _ in range(args.rate):
+            session_id = str(uuid.uuid4())
+            store.save({
+                'id': session_id,
+                'messages': [{'role': 'patient', 'content': '最近腰酸，晚上老起夜' * 5}],
+                'timestamp': datetime.now().isoformat(),
+                'status': 'active',
+                'target_product': '汇仁肾宝片'
+            })
+            active.append(session_id)
+            created += 1
+        # 随机推进一部分会话：追加消息、正常结束或直接放弃
+        for session_id in random.sample(active, min(len(active), args.rate)):
+            session = store.get(session_id)
+            if session is None:
+                active.remove(session_id)
+                continue
+            session['messages'].append({'role': 'customer-service', 'content': '您好，建议您试试汇仁肾宝片' * 3})
+            if len(session['messages']) >= args.turns or random.random() < 0.1:
+                if random.random() < 0.7:
+                    session['status'] = 'completed'
+                active.remove(session_id)
+        if time.monotonic() >= next_sample:
+            spill_files = len(os.listdir(spill_dir))
+            print(f"{time.monotonic() - start:9.0f} {created:9d} {len(store):9d} {spill_files:11d} {rss_mb():8.1f}")
+            next_sample += args.sample_interval
+        time.sleep(max(0.0, 1 - (time.monotonic() - tick)))
+    print(f"存储状态: {store.snapshot()}")
+
+
+if __name__ == '__main__':
+    main()
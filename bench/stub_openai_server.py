@@ -0,0 +1,147 @@
+"""本地OpenAI兼容桩服务（chat.completions）
+
+用于在不访问Azure的情况下验证批量评分、压测等功能：
+- 评分请求（system提示词包含"评估"）返回固定的评分JSON，其余请求返回固定的患者回复
+- 支持 stream=true，按 --chunk-delay 间隔逐块返回
+- 可按 --latency 注入响应延迟，按 --error-rate 随机返回429（带Retry-After）或500；
+  --error-mode even 时按请求顺序均匀地注入错误（如0.5为失败、成功交替），429和500轮流出现，结果可复现
+- 可按 --prefill-ms-per-1k 模拟提示词越长首token越慢（按字符数计，每千字增加的延迟）
+
+用法:
+    python bench/stub_openai_server.py --port 8001 --latency 0.2 --error-rate 0.1
+    python app.py rescore --base-url http://127.0.0.1:8001/v1 --rps 20
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STUB_EVALUATION = {
+    "total_score": 80,
+    "professionalism": 82,
+    "communication": 80,
+    "problem_solving": 78,
+    "service_attitude": 80,
+    "strengths": ["回应及时"],
+    "improvements": ["可以更主动询问顾客需求"],
+    "overall_comment": "桩服务返回的固定评价。"
+}
+STUB_REPLY = "嗯，我最近确实老是腰酸，晚上还得起来好几次，这个药大概多少钱啊？"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    options = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+
+        prompt_tokens = sum(len(m.get("content", "")) for m in request.get("messages", []))
+        time.sleep(self.options.latency + prompt_tokens / 1000 * self.options.prefill_ms_per_1k / 1000)
+        inject, rate_limited = self._inject_error()
+        if inject:
+            if rate_limited:
+                self._send_json(429, {"error": {"message": "rate limited"}}, {"Retry-After": "0.1"})
+            else:
+                self._send_json(500, {"error": {"message": "injected failure"}})
+            return
+
+        system_prompt = request.get("messages", [{}])[0].get("content", "")
+        content = json.dumps(STUB_EVALUATION, ensure_ascii=False) if "评估" in system_prompt else STUB_REPLY
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content),
+                 "total_tokens": prompt_tokens + len(content)}
+        base = {"id": "chatcmpl-stub", "created": int(time.time()), "model": request.get("model", "stub")}
+
+        if not request.get("stream"):
+            self._send_json(200, dict(base, object="chat.completion", usage=usage, choices=[{
+                "index": 0, "finish_reason": "stop",
+                "message": {"role": "assistant", "content": content}
+            }]))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pieces = [content[i:i + self.options.chunk_chars] for i in range(0, len(content), self.options.chunk_chars)]
+        for piece in pieces:
+            time.sleep(self.options.chunk_delay)
+            self._write_chunk(dict(base, object="chat.completion.chunk", choices=[{
+                "index": 0, "finish_reason": None, "delta": {"content": piece}
+            }]))
+        self._write_chunk(dict(base, object="chat.completion.chunk", choices=[{
+            "index": 0, "finish_reason": "stop", "delta": {}
+        }]))
+        self._write_raw(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _inject_error(self):
+        """返回(是否注入错误, 是否为429)"""
+        options = self.options
+        if options.error_mode != "even":
+            return random.random() < options.error_rate, random.random() < 0.5
+        with options.lock:
+            n = options.requests
+            options.requests += 1
+            inject = int((n + 1) * options.error_rate) > int(n * options.error_rate)
+            if inject:
+                options.errors += 1
+            return inject, options.errors % 2 == 0
+
+    def _write_chunk(self, payload):
+        self._write_raw(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8'))
+
+    def _write_raw(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+def make_server(port, latency=0.0, error_rate=0.0, chunk_delay=0.02, chunk_chars=2, prefill_ms_per_1k=0.0,
+                error_mode="random"):
+    """创建桩服务（不启动），便于在脚本中以线程方式运行"""
+    options = argparse.Namespace(latency=latency, error_rate=error_rate, chunk_delay=chunk_delay,
+                                 chunk_chars=chunk_chars, prefill_ms_per_1k=prefill_ms_per_1k,
+                                 error_mode=error_mode, lock=threading.Lock(), requests=0, errors=0)
+    handler = type("ConfiguredStubHandler", (StubHandler,), {"options": options})
+    return ThreadingHTTPServer(("127.0.0.1", port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地OpenAI兼容桩服务")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求的固定延迟（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回429/500的比例")
+    parser.add_argument("--error-mode", choices=["random", "even"], default="random",
+                        help="random: 每个请求按比例随机出错; even: 按请求顺序均匀出错")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="流式响应块间隔（秒）")
+    parser.add_argument("--chunk-chars", type=int, default=2, help="每个流式响应块的字符数")
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=0.0, help="每千字提示词增加的首token延迟（毫秒）")
+    args = parser.parse_args()
+
+    server = make_server(args.port, args.latency, args.error_rate, args.chunk_delay, args.chunk_chars,
+                         args.prefill_ms_per_1k, args.error_mode)
+    print(f"桩服务已启动: http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()